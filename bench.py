@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread, Barrier
+from typing import Dict, List, Any, Callable, Tuple, Optional
+
+from client.models.remotefile import RemoteFile
+from client.models.remotefolder import RemoteFolder
+from client.models.remotesystem import RemoteFileSystem
+from exttypes import asserttype
+from models import FileSystem
+from models.durability import Durability
+from models.file import FileHandle
+from network import network
+from server.headless import Server
+
+HOST = '127.0.0.1'
+MIXES = ('metadata', 'small', 'stream')
+# Files each client keeps for the small reads and writes
+SMALL_FILES = 16
+
+# Runs one operation, returns its name and the bytes of contents it moved
+Operation = Callable[[], Tuple[str, int]]
+
+
+class Client:
+    """A synthetic client working in a folder of its own"""
+    rfs: RemoteFileSystem
+    path: str
+    rng: random.Random
+    args: argparse.Namespace
+    latencies: Dict[str, List[float]]
+    transferred: int
+    errors: int
+    __handles: List[FileHandle]
+    __step: int
+
+    def __init__(self, rfs: RemoteFileSystem, index: int, args: argparse.Namespace) -> None:
+        self.rfs = rfs
+        self.path = f'/bench/c{index}'
+        self.rng = random.Random(args.seed + index)
+        self.args = args
+        self.latencies = {}
+        self.transferred = 0
+        self.errors = 0
+        self.__handles = []
+        self.__step = 0
+
+        rfs.create_directory(self.path)
+        if args.mix == 'small':
+            folder = self.folder()
+            for i in range(SMALL_FILES):
+                handle = folder.open_file(f's{i}', 'rw')
+                handle.write('x' * args.size * 2)
+                self.__handles.append(handle)
+
+    def close(self) -> None:
+        for handle in self.__handles:
+            handle.close()
+        self.rfs.close()
+
+    def folder(self) -> RemoteFolder:
+        return RemoteFolder(self.rfs.conn, self.rfs.stat(self.path))
+
+    def operation(self) -> Operation:
+        return getattr(self, f'_{self.args.mix}')
+
+    def run(self, deadline: float) -> None:
+        operation = self.operation()
+        while time.monotonic() < deadline:
+            began = time.perf_counter()
+            try:
+                name, size = operation()
+            except Exception as e:
+                print(f'{type(e).__name__}: {e}', file=sys.stderr)
+                self.errors += 1
+                continue
+            self.latencies.setdefault(name, []).append(time.perf_counter() - began)
+            self.transferred += size
+
+    def _metadata(self) -> Tuple[str, int]:
+        # Create, look up, list and delete in turn, so the folder stays small
+        step, self.__step = self.__step, self.__step + 1
+        name = f'm{step // 4}'
+        if step % 4 == 0:
+            self.rfs.create_file(self.path, name)
+            return 'create_file', 0
+        if step % 4 == 1:
+            self.rfs.stat(self.path)
+            return 'stat', 0
+        if step % 4 == 2:
+            self.rfs.readdir(self.path)
+            return 'readdir', 0
+        self.rfs.delete_file(self.path, name)
+        return 'delete_file', 0
+
+    def _small(self) -> Tuple[str, int]:
+        handle = self.rng.choice(self.__handles)
+        handle.seek(self.rng.randrange(self.args.size))
+        if self.rng.random() < self.args.reads:
+            return 'read', len(handle.read(self.args.size))
+        return 'write', handle.write('y' * self.args.size)
+
+    def _stream(self) -> Tuple[str, int]:
+        # Write the file and read it back in turn
+        step, self.__step = self.__step, self.__step + 1
+        handle = self.folder().open_file('big', 'wb')
+        file = asserttype(RemoteFile, handle.file)
+        handle.close()
+        if step % 2 == 0:
+            chunk = bytes(self.args.chunk)
+            return 'write_stream', file.write_stream(chunk for _ in range(self.args.stream_size // self.args.chunk))
+        return 'read_stream', sum(len(data) for data in file.read_stream(chunk=self.args.chunk))
+
+
+def free_port() -> int:
+    with socket.socket() as soc:
+        soc.bind((HOST, 0))
+        return soc.getsockname()[1]
+
+
+def start_server(path: str, args: argparse.Namespace, secret: Optional[str] = None) -> Tuple[FileSystem, int]:
+    """Serve a scratch file system on localhost, the server lives until the process exits"""
+    durability = Durability.group() if args.durability == 'group' else Durability.immediate()
+    fs = FileSystem.load(path=path, durability=durability)
+    port = free_port()
+    Thread(
+        target=lambda: Server(id=1, ip=HOST, port=port, fs=fs, verbose=False, secret=secret),
+        name='Bench-Server', daemon=True
+    ).start()
+    while True:
+        soc = network.create_connection(HOST, port)
+        if soc is not None:
+            soc.close()
+            return fs, port
+        time.sleep(0.05)
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    """Exact quantiles in milliseconds"""
+    if len(latencies) == 0:
+        return {}
+
+    latencies = sorted(latencies)
+    at = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {
+        'count': len(latencies),
+        'mean': sum(latencies) / len(latencies) * 1000,
+        'p50': at(0.50),
+        'p95': at(0.95),
+        'p99': at(0.99),
+        'max': latencies[-1] * 1000,
+    }
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    secret = secrets.token_hex(16)
+    fs, port = start_server(os.path.join(scratch, 'fs.dat'), args, secret)
+    try:
+        return drive(port, args, secret)
+    finally:
+        fs.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def drive(port: int, args: argparse.Namespace, secret: Optional[str] = None) -> Dict[str, Any]:
+    setup = RemoteFileSystem(HOST, port, secret=secret)
+    setup.create_directory('/bench')
+    clients = [Client(RemoteFileSystem(HOST, port, secret=secret), i, args) for i in range(args.clients)]
+
+    barrier = Barrier(args.clients + 1)
+    deadline: List[float] = []
+
+    def work(client: Client) -> None:
+        barrier.wait()
+        client.run(deadline[0])
+
+    threads = [Thread(target=work, args=(client,), daemon=True) for client in clients]
+    for thread in threads:
+        thread.start()
+    began = time.monotonic()
+    deadline.append(began + args.duration)
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - began
+
+    latencies: Dict[str, List[float]] = {}
+    for client in clients:
+        for name, values in client.latencies.items():
+            latencies.setdefault(name, []).extend(values)
+    every = [value for values in latencies.values() for value in values]
+    result = {
+        'mix': args.mix,
+        'clients': args.clients,
+        'duration': elapsed,
+        'ops': len(every),
+        'ops_per_sec': len(every) / elapsed,
+        'errors': sum(client.errors for client in clients),
+        'bytes': sum(client.transferred for client in clients),
+        'bytes_per_sec': sum(client.transferred for client in clients) / elapsed,
+        'latency_ms': percentiles(every),
+        'operations': {name: percentiles(values) for name, values in sorted(latencies.items())},
+        'server': setup.stats(),
+    }
+
+    for client in clients:
+        client.close()
+    setup.close()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Drive a scratch headless server with synthetic clients')
+    parser.add_argument('--mix', choices=MIXES, action='append', help='Workloads to run, all by default')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds each workload runs')
+    parser.add_argument('--size', type=int, default=256, help='Bytes of a small read or write')
+    parser.add_argument('--reads', type=float, default=0.5, help='Share of reads among small operations')
+    parser.add_argument('--stream-size', type=int, default=4 * 1024 * 1024, help='Bytes of a streamed file')
+    parser.add_argument('--chunk', type=int, default=64 * 1024, help='Bytes of a streamed chunk')
+    parser.add_argument('--durability', choices=('immediate', 'group'), default='group')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench.json', help='File the results are written to as json')
+    args = parser.parse_args()
+
+    mixes = args.mix or MIXES
+    config = {**vars(args), 'mix': list(mixes)}
+    results = []
+    for mix in mixes:
+        args.mix = mix
+        result = run(args)
+        print(
+            f"{mix}: {result['ops_per_sec']:.1f} ops/s, {result['bytes_per_sec'] / 1024 / 1024:.2f} MiB/s, "
+            f"p50 {result['latency_ms'].get('p50', 0):.2f} ms, p99 {result['latency_ms'].get('p99', 0):.2f} ms, "
+            f"{result['errors']} errors"
+        )
+        results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump({'time': time.time(), 'config': config, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+from __future__ import annotations
+
+import asyncio
+from io import BytesIO
+from itertools import count
+from typing import Dict, Any, List, Iterator, Optional, Tuple, Union, Sequence
+
+from client.models.connection import POOL_SIZE
+from exttypes import asserttype
+from models.delta import Splice
+from models.folder import READDIR_LIMIT
+from models.memory import Memory
+from models.quota import Quota, Usage
+from models.stub import Stub, Listing, FOLDER
+from network import network, codec
+from services.authservice import AuthService
+
+
+class AsyncConnection:
+    """A persistent stream that multiplexes requests by id, see Connection
+
+    Any number of tasks may await calls at the same time, a reader task
+    hands every reply to the future of its request
+    """
+    __reader: asyncio.StreamReader
+    __writer: asyncio.StreamWriter
+    __ids: Iterator[int]
+    __pending: Dict[int, asyncio.Future]
+    __task: asyncio.Task
+    __closed: bool
+    # The user every request of the connection runs as
+    user: str
+
+    def __init__(
+            self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, user: Optional[str] = None,
+            secret: Optional[str] = None
+    ) -> None:
+        self.__reader = reader
+        self.__writer = writer
+        self.__ids = count(1)
+        self.__pending = {}
+        self.__closed = False
+        self.user = user if user is not None else AuthService.current().name
+        # Every connection starts by naming the user the requests run as, see Connection
+        auth = ('auth', self.user) if secret is None else ('auth', self.user, secret)
+        network.write_frame(writer, 0, network.encode_parameter(*auth))
+        self.__task = asyncio.get_running_loop().create_task(self.__read())
+
+    @staticmethod
+    async def open(ip: str, port: int, user: Optional[str] = None, secret: Optional[str] = None) -> AsyncConnection:
+        reader, writer = await asyncio.open_connection(ip, port)
+        return AsyncConnection(reader, writer, user, secret)
+
+    @property
+    def closed(self) -> bool:
+        return self.__closed
+
+    @property
+    def pending(self) -> int:
+        return len(self.__pending)
+
+    async def call(self, *params: Any) -> Any:
+        """Send the request and wait for its reply, errors of the server are raised here"""
+        if self.__closed:
+            raise ConnectionError("Connection closed")
+
+        rid = next(self.__ids)
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[rid] = future
+        try:
+            network.write_frame(self.__writer, rid, codec.encode_parts(*params))
+            await self.__writer.drain()
+        except OSError:
+            self.__pending.pop(rid, None)
+            raise
+        return await future
+
+    async def close(self) -> None:
+        if self.__closed:
+            return
+
+        self.__closed = True
+        pending, self.__pending = self.__pending, {}
+        self.__writer.close()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed"))
+        if asyncio.current_task() is not self.__task:
+            self.__task.cancel()
+        try:
+            await self.__writer.wait_closed()
+        except OSError:
+            pass
+
+    async def __read(self) -> None:
+        try:
+            while True:
+                frame = await network.read_frame(self.__reader)
+                if frame is None:
+                    break
+
+                rid, payload = frame
+                future = self.__pending.pop(rid, None)
+                # Notices the server sends on its own have no request to answer
+                if future is None or future.done():
+                    continue
+                try:
+                    reply = network.decode_parameter(payload)[0]
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                if isinstance(reply, BaseException):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except OSError:
+            pass
+        await self.close()
+
+
+class AsyncConnectionPool:
+    """Hands out persistent connections, see ConnectionPool"""
+    ip: str
+    port: int
+    size: int
+    user: str
+    secret: Optional[str]
+    __connections: List[AsyncConnection]
+    # Created by the loop that first uses the pool, before 3.10 a lock is
+    # bound to the loop running when it is created
+    __lock: Optional[asyncio.Lock]
+
+    def __init__(
+            self, ip: str, port: int, size: int = POOL_SIZE, user: Optional[str] = None, secret: Optional[str] = None
+    ) -> None:
+        self.ip = ip
+        self.port = port
+        self.size = size
+        self.user = user if user is not None else AuthService.current().name
+        self.secret = secret
+        self.__connections = []
+        self.__lock = None
+
+    async def acquire(self) -> AsyncConnection:
+        """The least busy connection, another one is opened while all are busy"""
+        async with self.__locked():
+            self.__connections = [c for c in self.__connections if not c.closed]
+            if len(self.__connections) > 0:
+                conn = min(self.__connections, key=lambda c: c.pending)
+                if conn.pending == 0 or len(self.__connections) >= self.size:
+                    return conn
+
+            conn = await AsyncConnection.open(self.ip, self.port, self.user, self.secret)
+            self.__connections.append(conn)
+            return conn
+
+    async def call(self, *params: Any) -> Any:
+        return await (await self.acquire()).call(*params)
+
+    async def close(self) -> None:
+        async with self.__locked():
+            connections, self.__connections = self.__connections, []
+        for conn in connections:
+            await conn.close()
+
+    def __locked(self) -> asyncio.Lock:
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        return self.__lock
+
+
+class AsyncRemoteFile:
+    """A file known from its stub, see RemoteFile, every method is awaited"""
+    conn: AsyncConnectionPool
+    stub: Stub
+    name: str
+    ino: Optional[int]
+    version: int
+    binary: bool
+
+    def __init__(self, conn: AsyncConnectionPool, stub: Stub) -> None:
+        self.conn = conn
+        self.stub = stub
+        self.name = stub.name
+        self.ino = stub.ino
+        self.version = stub.version
+        self.binary = stub.binary
+
+    def path(self) -> str:
+        return self.stub.path
+
+    async def read(self, start: int = 0, end: int = -1) -> Union[str, bytes]:
+        return await self.conn.call(*self.__address('read'), start, end)
+
+    async def write(self, contents: Union[str, bytes], start: int = 0) -> None:
+        if self.ino is not None:
+            await self.conn.call(*self.__address('write'), contents, start)
+        else:
+            await self.conn.call(*self.__address('write'), contents, start, False)
+
+    async def patch(self, splices: Sequence[Splice], version: Optional[int] = None) -> int:
+        self.version = await self.conn.call(*self.__address('patch'), list(splices), version)
+        return self.version
+
+    async def move(self, start: int, end: int, target: int) -> None:
+        await self.conn.call(*self.__address('move'), start, end, target)
+
+    async def truncate(self, end: int) -> None:
+        await self.conn.call(*self.__address('truncate'), end)
+
+    async def size(self) -> int:
+        return await self.conn.call(*self.__address('size'))
+
+    def __address(self, command: str) -> Tuple[Any, ...]:
+        if self.ino is not None:
+            return 'fs', f'{command}_inode', self.ino
+        return 'fs', f'{command}_contents', self.stub.parent, self.name
+
+
+class AsyncRemoteFolder:
+    """A folder known from its stub, see RemoteFolder, every method is awaited"""
+    conn: AsyncConnectionPool
+    stub: Stub
+    name: str
+    ino: Optional[int]
+    version: int
+
+    def __init__(self, conn: AsyncConnectionPool, stub: Stub) -> None:
+        self.conn = conn
+        self.stub = stub
+        self.name = stub.name
+        self.ino = stub.ino
+        self.version = stub.version
+
+    def path(self) -> str:
+        return self.stub.path
+
+    def usage(self) -> Tuple[int, int, int]:
+        return self.stub.size, self.stub.files, self.stub.folders + 1
+
+    async def nodes(self) -> Dict[str, Union[AsyncRemoteFolder, AsyncRemoteFile]]:
+        stub = self.stub
+        if stub.children is None:
+            stub = asserttype(Stub, await self.conn.call('fs', 'stat', self.path()))
+        return {child.name: async_remote_node(self.conn, child) for child in stub.children or ()}
+
+    async def readdir(
+            self, cursor: Optional[str] = None, limit: int = READDIR_LIMIT, version: Optional[int] = None,
+            ino: Optional[int] = None
+    ) -> Optional[Listing]:
+        listing = await self.conn.call('fs', 'readdir', self.path(), cursor, limit, version, ino)
+        return None if listing is None else asserttype(Listing, listing)
+
+    async def create_file(self, name: str) -> None:
+        await self.conn.call('fs', 'create_file', self.path(), name)
+
+    async def open_file(self, name: str, mode: str = 'r') -> AsyncRemoteFile:
+        """The file, created unless the mode only reads, the mode isn't enforced on the returned file"""
+        return AsyncRemoteFile(self.conn, asserttype(Stub, await self.conn.call('fs', 'open_file', self.path(), name, mode)))
+
+    async def get_file(self, name: str) -> AsyncRemoteFile:
+        return await self.open_file(name, 'r')
+
+    async def delete_file(self, name: str) -> None:
+        await self.conn.call('fs', 'delete_file', self.path(), name)
+
+
+def async_remote_node(conn: AsyncConnectionPool, stub: Stub) -> Union[AsyncRemoteFolder, AsyncRemoteFile]:
+    return AsyncRemoteFolder(conn, stub) if stub.kind == FOLDER else AsyncRemoteFile(conn, stub)
+
+
+class AsyncRemoteFileSystem:
+    """The asyncio counterpart of RemoteFileSystem
+
+    Methods mirror FileSystem as coroutines, root and current become
+    coroutine methods. Requests of concurrent tasks share the pooled
+    connections instead of needing a thread each
+    """
+    ip: str
+    port: int
+    conn: AsyncConnectionPool
+
+    def __init__(self, ip: str, port: int, size: int = POOL_SIZE, secret: Optional[str] = None) -> None:
+        self.ip = ip
+        self.port = port
+        self.conn = AsyncConnectionPool(ip, port, size, secret=secret)
+
+    async def __aenter__(self) -> AsyncRemoteFileSystem:
+        return self
+
+    async def __aexit__(self, *_: Any) -> None:
+        await self.close()
+
+    async def root(self) -> AsyncRemoteFolder:
+        return AsyncRemoteFolder(self.conn, asserttype(Stub, await self.conn.call('fs', 'root')))
+
+    async def current(self) -> AsyncRemoteFolder:
+        return AsyncRemoteFolder(self.conn, asserttype(Stub, await self.conn.call('fs', 'current')))
+
+    async def change_directory(self, path: str) -> AsyncRemoteFolder:
+        return AsyncRemoteFolder(self.conn, asserttype(Stub, await self.conn.call('fs', 'change_directory', path)))
+
+    async def create_directory(self, path: str) -> None:
+        await self.conn.call('fs', 'create_directory', path)
+
+    async def move(self, src: str, dest: str) -> None:
+        await self.conn.call('fs', 'move', src, dest)
+
+    async def delete(self, path: str) -> None:
+        await self.conn.call('fs', 'delete', path)
+
+    async def create_file(self, path: str, name: str) -> None:
+        await self.conn.call('fs', 'create_file', path, name)
+
+    async def delete_file(self, path: str, name: str) -> None:
+        await self.conn.call('fs', 'delete_file', path, name)
+
+    async def write_contents(self, path: str, name: str, contents: Union[str, bytes], start: int = 0) -> None:
+        await self.conn.call('fs', 'write_contents', path, name, contents, start, False)
+
+    async def read_contents(self, path: str, name: str, start: int = 0, end: int = -1) -> Union[str, bytes]:
+        return await self.conn.call('fs', 'read_contents', path, name, start, end)
+
+    async def stat(self, path: str) -> Stub:
+        return asserttype(Stub, await self.conn.call('fs', 'stat', path))
+
+    async def readdir(
+            self, path: str, cursor: Optional[str] = None, limit: int = READDIR_LIMIT, version: Optional[int] = None,
+            ino: Optional[int] = None
+    ) -> Optional[Listing]:
+        listing = await self.conn.call('fs', 'readdir', path, cursor, limit, version, ino)
+        return None if listing is None else asserttype(Listing, listing)
+
+    async def usage(self, path: str) -> Tuple[int, int, int]:
+        return await self.conn.call('fs', 'usage', path)
+
+    async def lookup(self, path: str) -> int:
+        return await self.conn.call('fs', 'lookup', path)
+
+    async def set_quota(
+            self, size: Optional[int] = None, inodes: Optional[int] = None,
+            path: Optional[str] = None, user: Optional[str] = None
+    ) -> None:
+        await self.conn.call('fs', 'set_quota', size, inodes, path, user)
+
+    async def quota(self, path: Optional[str] = None, user: Optional[str] = None) -> Tuple[Optional[Quota], Usage]:
+        return await self.conn.call('fs', 'quota', path, user)
+
+    async def batch(self, ops: Sequence[Sequence[Any]]) -> List[Any]:
+        """Apply the operations, each a command and its parameters, in one request
+
+        Like Batch, the result of an operation that failed is its exception
+        """
+        return await self.conn.call('fs', 'batch', [tuple(op) for op in ops])
+
+    async def save(self) -> None:
+        await self.conn.call('fs', 'save')
+
+    async def sync(self) -> None:
+        await self.conn.call('fs', 'sync')
+
+    async def memory_map(self) -> Memory:
+        return Memory(BytesIO(asserttype(bytes, await self.conn.call('fs', 'memory_map'))))
+
+    async def close(self) -> None:
+        await self.conn.close()
@@ -0,0 +1,74 @@
+from concurrent.futures import Future
+from typing import Any, List, Tuple, Union
+
+from client.models.connection import ConnectionPool
+
+
+class Batch:
+    """Queues operations and sends them to the server as a single request
+
+    Every queued call returns a future that is resolved with the result or
+    the error of its operation once the batch is sent
+    """
+    conn: ConnectionPool
+    __ops: List[Tuple[Any, ...]]
+    __futures: List[Future]
+
+    def __init__(self, conn: ConnectionPool) -> None:
+        self.conn = conn
+        self.__ops = []
+        self.__futures = []
+
+    def __len__(self) -> int:
+        return len(self.__ops)
+
+    def submit(self, *params: Any) -> Future:
+        future: Future = Future()
+        self.__ops.append(params)
+        self.__futures.append(future)
+        return future
+
+    def create_directory(self, path: str) -> Future:
+        return self.submit('create_directory', path)
+
+    def delete(self, path: str) -> Future:
+        return self.submit('delete', path)
+
+    def move(self, src: str, dest: str) -> Future:
+        return self.submit('move', src, dest)
+
+    def create_file(self, path: str, name: str) -> Future:
+        return self.submit('create_file', path, name)
+
+    def delete_file(self, path: str, name: str) -> Future:
+        return self.submit('delete_file', path, name)
+
+    def write_contents(self, path: str, name: str, contents: Union[str, bytes], start: int = 0) -> Future:
+        return self.submit('write_contents', path, name, contents, start, False)
+
+    def write_inode(self, ino: int, contents: Union[str, bytes], start: int = 0) -> Future:
+        return self.submit('write_inode', ino, contents, start)
+
+    def flush(self) -> None:
+        ops, futures = self.__ops, self.__futures
+        self.__ops, self.__futures = [], []
+        if len(ops) == 0:
+            return
+
+        try:
+            results = self.conn.call('fs', 'batch', ops)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            raise
+
+        for future, result in zip(futures, results):
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def cancel(self) -> None:
+        for future in self.__futures:
+            future.cancel()
+        self.__ops, self.__futures = [], []
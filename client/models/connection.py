@@ -1,22 +1,201 @@
+import logging
+from concurrent.futures import Future
+from itertools import count
 from socket import socket
-from typing import Optional
+from threading import Lock, Thread
+from typing import Dict, Any, List, Iterator, Optional, Callable, Sequence
 
-from exttypes import notnone
-from network import network
+from network import network, codec
+from network.bufferpool import default_pool
+from services.authservice import AuthService
+
+log = logging.getLogger('Connection')
+
+# Number of sockets a pool keeps open to the server
+POOL_SIZE = 4
+
+# Bytes received so far, size of the reply and size of the last packet
+Progress = Callable[[int, int, int], None]
 
 
 class Connection:
-    __ip: str
-    __port: int
-    __soc: Optional[socket]
+    """A persistent socket that multiplexes requests by id
+
+    Any number of threads may have calls outstanding at the same time,
+    a reader thread hands every reply to the future of its request and
+    the notices the server sends on its own to the push callback
+    """
+    __soc: socket
+    __lock: Lock
+    __ids: Iterator[int]
+    __pending: Dict[int, Future]
+    __progress: Dict[int, Progress]
+    __reader: Thread
+    __closed: bool
+    push: Optional[Callable[[Sequence[Any]], None]]
+    # The user every request of the connection runs as
+    user: str
+
+    def __init__(
+            self, ip: str, port: int, push: Optional[Callable[[Sequence[Any]], None]] = None,
+            user: Optional[str] = None, secret: Optional[str] = None
+    ) -> None:
+        soc = network.create_connection(ip, port)
+        if soc is None:
+            raise ConnectionRefusedError(f"Unable to connect to {ip}:{port}")
+
+        self.__soc = soc
+        self.__lock = Lock()
+        self.__ids = count(1)
+        self.__pending = {}
+        self.__progress = {}
+        self.__closed = False
+        self.push = push
+        self.user = user if user is not None else AuthService.current().name
+        # Every connection starts by naming the user the requests run as, root
+        # has to prove it with the secret the server was started with
+        auth = ('auth', self.user) if secret is None else ('auth', self.user, secret)
+        network.send_frame(soc, 0, network.encode_parameter(*auth))
+
+        self.__reader = Thread(target=self.__read, name=f'Connection-{ip}:{port}', daemon=True)
+        self.__reader.start()
+
+    @property
+    def closed(self) -> bool:
+        return self.__closed
+
+    @property
+    def pending(self) -> int:
+        return len(self.__pending)
+
+    def submit(self, *params: Any, progress: Optional[Progress] = None) -> Future:
+        """Send the request, the progress callback follows the arrival of its reply"""
+        future: Future = Future()
+        with self.__lock:
+            if self.__closed:
+                raise ConnectionError("Connection closed")
+
+            rid = next(self.__ids)
+            self.__pending[rid] = future
+            if progress is not None:
+                self.__progress[rid] = progress
+            try:
+                network.send_frame(self.__soc, rid, codec.encode_parts(*params))
+            except OSError:
+                del self.__pending[rid]
+                self.__progress.pop(rid, None)
+                raise
+        return future
+
+    def call(self, *params: Any, progress: Optional[Progress] = None) -> Any:
+        """Send the request and wait for its reply, errors of the server are raised here"""
+        return self.submit(*params, progress=progress).result()
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__closed:
+                return
+
+            self.__closed = True
+            pending, self.__pending = self.__pending, {}
+            self.__progress = {}
+
+        try:
+            self.__soc.close()
+        finally:
+            for future in pending.values():
+                future.set_exception(ConnectionError("Connection closed"))
+
+    def __read(self) -> None:
+        while True:
+            frame = network.get_frame(self.__soc, self.__progress.get, pool=default_pool)
+            if frame is None:
+                break
+
+            rid, payload = frame
+            if rid == 0:
+                # A notice that can't be decoded or handled is dropped, the
+                # replies that follow it still reach their requests
+                try:
+                    self.__pushed(payload)
+                except Exception as e:
+                    log.warning(f'Dropped a notice from the server: {e}')
+                continue
+
+            self.__progress.pop(rid, None)
+            future = self.__pending.pop(rid, None)
+            try:
+                if future is None:
+                    continue
+                reply = network.decode_parameter(payload)[0]
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            finally:
+                # Decoding copies every field, the buffer can be reused
+                default_pool.release(payload.obj)
+            if isinstance(reply, BaseException):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+
+        self.close()
+
+    def __pushed(self, payload: memoryview) -> None:
+        try:
+            notice = network.decode_parameter(payload)
+        finally:
+            default_pool.release(payload.obj)
+        if self.push is not None:
+            self.push(notice)
+
+
+class ConnectionPool:
+    """Hands out persistent connections, reopening those the server closed
+
+    Connections are opened lazily by whichever thread needs one, they all
+    run as the user that created the pool
+    """
+    ip: str
+    port: int
+    size: int
+    user: str
+    secret: Optional[str]
+    __connections: List[Connection]
+    __lock: Lock
+
+    def __init__(
+            self, ip: str, port: int, size: int = POOL_SIZE, user: Optional[str] = None, secret: Optional[str] = None
+    ) -> None:
+        self.ip = ip
+        self.port = port
+        self.size = size
+        self.user = user if user is not None else AuthService.current().name
+        self.secret = secret
+        self.__connections = []
+        self.__lock = Lock()
+
+    def acquire(self) -> Connection:
+        """The least busy connection, another one is opened while all are busy"""
+        with self.__lock:
+            self.__connections = [c for c in self.__connections if not c.closed]
+            if len(self.__connections) > 0:
+                conn = min(self.__connections, key=lambda c: c.pending)
+                if conn.pending == 0 or len(self.__connections) >= self.size:
+                    return conn
+
+            conn = Connection(self.ip, self.port, user=self.user, secret=self.secret)
+            self.__connections.append(conn)
+            return conn
 
-    def __init__(self, ip: str, port: int) -> None:
-        self.__ip = ip
-        self.__port = port
+    def submit(self, *params: Any, progress: Optional[Progress] = None) -> Future:
+        return self.acquire().submit(*params, progress=progress)
 
-    def __enter__(self) -> socket:
-        self.__soc = network.create_connection(self.__ip, self.__port)
-        return notnone(self.__soc)
+    def call(self, *params: Any, progress: Optional[Progress] = None) -> Any:
+        return self.submit(*params, progress=progress).result()
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.__soc.close()
+    def close(self) -> None:
+        with self.__lock:
+            for conn in self.__connections:
+                conn.close()
+            self.__connections = []
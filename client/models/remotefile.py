@@ -1,46 +1,314 @@
-import pickle
-from typing import Union, Callable
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from threading import Lock, RLock
+from typing import Union, Tuple, Any, Iterator, Iterable, Optional, Deque, Callable, Sequence, List
 
-from client.models.connection import Connection
+from client.models.connection import ConnectionPool, Progress
+from exttypes import asserttype
 from models import File
-from network.network import send_request, encode_parameter, get_request
+from models.delta import Splice, VersionMismatch
+from models.file import CHUNK_SIZE
+from models.stub import Stub
+
+# Chunks requested ahead of the one being consumed
+WINDOW = 8
+# Bytes fetched past a cached read and buffered by cached writes before they are sent
+READ_AHEAD = CHUNK_SIZE
+WRITE_BACK = 1024 * 1024
 
 
 class RemoteFile(File):
-    conn: Callable[[], Connection]
+    """A file known from its stub, the contents stay on the server
+
+    A cached file reads ahead of every read and collects contiguous
+    writes until it is flushed, closed or the buffer fills. Buffered
+    writes are sent as one patch that fails with VersionMismatch if
+    another client changed the file since this one last did, data read
+    ahead is kept until this client writes
+
+    Given the cached stat of the file system and the stub of the folder
+    the file was listed in, the size is answered from the stub for as
+    long as the cache keeps that folder stub
+    """
+    conn: ConnectionPool
+    # The stub the node was made from, Node.stub answers with it
+    meta: Stub
+    changed: Callable[[str], None]
+    cached: bool
+    stat: Optional[Callable[[str], Stub]]
+    # Stub of the parent folder the stub of this file was taken from
+    origin: Optional[Stub]
+    # Size on the server as far as this client knows
+    __size: int
+    # Offset and parts of the buffered writes
+    __pending: Optional[Tuple[int, List[Union[str, bytes]]]]
+    __pending_size: int
+    # Offset and contents read ahead, and whether they reach the end of the file
+    __ahead: Optional[Tuple[int, Union[str, bytes], bool]]
+    __lock: RLock
 
-    def __init__(self, conn: Callable[[], Connection], file: File) -> None:
-        super().__init__(file.name, file.parent, file.read())
+    def __init__(
+            self, conn: ConnectionPool, stub: Stub,
+            changed: Optional[Callable[[str], None]] = None, cached: bool = False,
+            stat: Optional[Callable[[str], Stub]] = None, origin: Optional[Stub] = None
+    ) -> None:
+        super().__init__(stub.name, None, binary=stub.binary)
         self.conn = conn
+        self.meta = stub
+        self.changed = changed if changed is not None else lambda path: None
+        self.cached = cached
+        self.stat = stat
+        self.origin = origin
+        self.ino = stub.ino
+        self.version = stub.version
+        self.__size = stub.size
+        self.__pending = None
+        self.__pending_size = 0
+        self.__ahead = None
+        self.__lock = RLock()
+
+    def path(self) -> str:
+        return self.meta.path
+
+    def stub(self, children: bool = True) -> Stub:
+        return self.meta
 
     def write(self, contents: Union[str, bytes], start: int = 0) -> None:
         self._write(contents, start, True)
 
-    def _write(self, contents: str, start: int = 0, append: bool = False) -> None:
-        with self.conn() as soc:
-            send_request(soc, encode_parameter(
-                'fs', 'write_contents', self.parent.path(), self.name, contents, str(start), str(append)
-            ))
+    def _write(self, contents: Union[str, bytes], start: int = 0, append: bool = False) -> None:
+        if self.cached and not append:
+            self.__buffer(self._coerce(contents), start)
+            return
+
+        with self.__uncached():
+            self.conn.call(*self.__write(contents, start, append))
+        self.changed(self.path())
+
+    def read(self, start: int = 0, end: int = -1) -> Union[str, bytes, memoryview]:
+        if not self.cached:
+            return self.conn.call(*self.__address('read'), start, end)
+
+        with self.__lock:
+            self.flush()
+            ahead = self.__ahead
+            if ahead is not None:
+                offset, data, eof = ahead
+                if offset <= start and (eof or 0 <= end <= offset + len(data)):
+                    return data[start - offset:len(data) if end < 0 else end - offset]
+
+            # Only reads to the end stop at the requested range, the rest is
+            # kept for the reads that follow
+            fetch = -1 if end < 0 else max(end, start + READ_AHEAD)
+            data = self.conn.call(*self.__address('read'), start, fetch)
+            self.__ahead = start, data, fetch < 0 or len(data) < fetch - start
+            return data if end < 0 else data[:end - start]
+
+    def flush(self) -> None:
+        """Send the buffered writes as one patch, they are dropped if it fails
+
+        On VersionMismatch the version and size are caught up with the
+        server before it is raised, so writes after it apply to the file
+        as it is now
+        """
+        with self.__lock:
+            pending, self.__pending, self.__pending_size = self.__pending, None, 0
+            if pending is None:
+                return
+
+            start, parts = pending
+            data: Union[str, bytes] = b''.join(parts) if self.binary else ''.join(parts)
+            size = self.__size
+            if start > size:
+                # Patches can't leave holes, send the zeros a write would leave
+                data = (bytes(start - size) if self.binary else '\0' * (start - size)) + data
+                start = size
+            try:
+                self.version = self.conn.call(
+                    *self.__address('patch'), [(start, min(start + len(data), size), data)], self.version
+                )
+            except VersionMismatch:
+                self.__ahead = None
+                self.__resync()
+                raise
+            self.__size = max(size, start + len(data))
+        self.changed(self.path())
+
+    def read_stream(
+            self, start: int = 0, end: int = -1, chunk: int = CHUNK_SIZE,
+            window: int = WINDOW, progress: Optional[Progress] = None
+    ) -> Iterator[Union[str, bytes]]:
+        """Yield the range in chunks, keeping at most window chunks in flight
+
+        The progress callback gets the bytes received so far, the size of
+        the range and the size of the last packet
+        """
+        self.flush()
+        size = self.size()
+        end = size if end < 0 else min(end, size)
+        received = _Counter(end - start, progress)
+        offsets = iter(range(start, end, chunk))
+        pending: Deque[Future] = deque()
+        while True:
+            while len(pending) < window:
+                offset = next(offsets, None)
+                if offset is None:
+                    break
+                pending.append(self.conn.submit(
+                    *self.__address('read'), offset, min(offset + chunk, end),
+                    progress=received.packet if progress is not None else None
+                ))
+
+            if len(pending) == 0:
+                return
+            yield pending.popleft().result()
+
+    def write_stream(
+            self, chunks: Iterable[Union[str, bytes]], start: int = 0,
+            window: int = WINDOW, progress: Optional[Progress] = None
+    ) -> int:
+        """Write the chunks one after another from start, keeping at most window chunks unacknowledged
+
+        The progress callback gets the bytes written so far, -1 and the size
+        of the last chunk once the server has written it
+        """
+        with self.__uncached():
+            return self.__write_stream(chunks, start, window, progress)
+
+    def __write_stream(
+            self, chunks: Iterable[Union[str, bytes]], start: int, window: int, progress: Optional[Progress]
+    ) -> int:
+        written = _Counter(-1, progress)
+        pending: Deque[Tuple[Future, int]] = deque()
+        offset = start
+        for data in chunks:
+            if len(pending) >= window:
+                _acknowledge(pending, written)
+            pending.append((self.conn.submit(*self.__write(data, offset)), len(data)))
+            offset += len(data)
 
-    def read(self, start: int = 0, end: int = -1) -> Union[str, bytes]:
-        with self.conn() as soc:
-            send_request(soc, encode_parameter(
-                'fs', 'read_contents', self.parent.path(), self.name, str(start), str(end)
-            ))
-            return ''.join(pickle.loads(get_request(soc)))
+        while len(pending) > 0:
+            _acknowledge(pending, written)
+        self.changed(self.path())
+        return offset - start
+
+    def patch(self, splices: Sequence[Splice], version: Optional[int] = None) -> int:
+        with self.__uncached():
+            self.version = self.conn.call(*self.__address('patch'), list(splices), version)
+        self.changed(self.path())
+        return self.version
 
     def move(self, start: int, end: int, target: int) -> None:
-        with self.conn() as soc:
-            send_request(soc, encode_parameter(
-                'fs', 'move_contents', self.parent.path(), self.name, str(start), str(end), str(target)
-            ))
+        with self.__uncached():
+            self.conn.call(*self.__address('move'), start, end, target)
+        self.changed(self.path())
 
     def truncate(self, end: int) -> None:
-        with self.conn() as soc:
-            send_request(soc, encode_parameter(
-                'fs', 'truncate_contents', self.parent.path(), self.name, str(end)
-            ))
+        with self.__uncached():
+            self.conn.call(*self.__address('truncate'), end)
+        self.changed(self.path())
+
+    def size(self) -> int:
+        if not self.cached:
+            stub = self.__listed()
+            return stub.size if stub is not None else self.conn.call(*self.__address('size'))
+
+        with self.__lock:
+            pending = self.__pending
+            return self.__size if pending is None else max(self.__size, pending[0] + self.__pending_size)
+
+    def __buffer(self, contents: Union[str, bytes], start: int) -> None:
+        with self.__lock:
+            self.__ahead = None
+            pending = self.__pending
+            if pending is not None and start != pending[0] + self.__pending_size:
+                self.flush()
+                pending = None
+            if pending is None:
+                pending = self.__pending = start, []
+
+            # The caller may reuse its buffer once the write returns
+            pending[1].append(contents if isinstance(contents, str) else bytes(contents))
+            self.__pending_size += len(contents)
+            if self.__pending_size >= WRITE_BACK:
+                self.flush()
+
+    def __listed(self) -> Optional[Stub]:
+        """The stub of this file in the cached stub of its folder, None without a cache
+
+        The server pushes every change, so the cache only keeps a folder stub
+        while nothing below it changed. A newer folder stub is looked up once
+        and serves every file listed in it
+        """
+        if self.stat is None or self.meta.parent is None:
+            return None
+
+        parent = self.stat(self.meta.parent)
+        if parent is not self.origin:
+            stub = next((child for child in parent.children or () if child.ino == self.ino), None)
+            if stub is None:
+                return None
+            self.meta, self.origin = stub, parent
+        return self.meta
+
+    @contextmanager
+    def __uncached(self) -> Iterator[None]:
+        """Flush before an operation that bypasses the cache and catch up with it afterwards"""
+        if not self.cached:
+            yield
+            return
+
+        with self.__lock:
+            self.flush()
+            self.__ahead = None
+            try:
+                yield
+            finally:
+                self.__resync()
+
+    def __resync(self) -> None:
+        stub = asserttype(Stub, self.conn.call('fs', 'stat', self.path()))
+        self.version, self.__size = stub.version, stub.size
+
+    def __write(self, contents: Union[str, bytes], start: int, append: bool = False) -> Tuple[Any, ...]:
+        if self.ino is not None:
+            return (*self.__address('write'), contents, start)
+        return (*self.__address('write'), contents, start, append)
+
+    def __address(self, command: str) -> Tuple[Any, ...]:
+        # Files opened from the server carry their inode, which saves the
+        # server from resolving the path on every call
+        if self.ino is not None:
+            return 'fs', f'{command}_inode', self.ino
+        return 'fs', f'{command}_contents', self.meta.parent, self.name
+
+
+class _Counter:
+    """Sums the progress of several requests into one for the whole transfer"""
+    total: int
+    done: int
+    progress: Optional[Progress]
+    __lock: Lock
+
+    def __init__(self, total: int, progress: Optional[Progress]) -> None:
+        self.total = total
+        self.done = 0
+        self.progress = progress
+        self.__lock = Lock()
+
+    def packet(self, _: int, __: int, size: int) -> None:
+        self.add(size)
+
+    def add(self, size: int) -> None:
+        with self.__lock:
+            # Replies carry a few bytes of framing on top of the contents
+            self.done = self.done + size if self.total < 0 else min(self.done + size, self.total)
+            if self.progress is not None:
+                self.progress(self.done, self.total, size)
 
-    def close(self):
-        pass
 
+def _acknowledge(pending: Deque[Tuple[Future, int]], written: _Counter) -> None:
+    future, size = pending.popleft()
+    future.result()
+    written.add(size)
@@ -1,30 +1,120 @@
-import pickle
+from dataclasses import replace
+from typing import Dict, Optional, Callable, Tuple
 
-from client.models.connection import Connection
+from client.models.connection import ConnectionPool
 from client.models.remotefile import RemoteFile
-from exttypes import asserttype, Callable
-from models import Folder, File
-from network.network import encode_parameter, send_request, get_request
+from exttypes import asserttype
+from models import Folder, Node
+from models.file import FileHandle, open_handle
+from models.folder import READDIR_LIMIT
+from models.stub import Stub, Listing, FOLDER
 
 
 class RemoteFolder(Folder):
-    conn: Callable[[], Connection]
+    """A folder known from its stub, children are fetched on first access"""
+    conn: ConnectionPool
+    # The stub the node was made from, Node.stub answers with it
+    meta: Stub
+    # Resolves the stub of a path and reports the paths this folder changed,
+    # which lets the file system answer from and keep its cache
+    stat: Callable[[str], Stub]
+    changed: Callable[[str], None]
+    # Whether files are opened with the read-ahead and write-back cache
+    cached: bool
+    # The stat given, None when stubs are fetched on every call
+    __stat: Optional[Callable[[str], Stub]]
+    __nodes: Optional[Dict[str, Node]]
+    # Inode, version and entries of the last complete listing
+    __listing: Optional[Tuple[Optional[int], int, Tuple[Stub, ...]]]
 
-    def __init__(self, conn: Callable[[], Connection], folder: Folder) -> None:
-        super().__init__(folder.name,
-                         asserttype(Folder, folder.parent) if folder.parent is not None else None,
-                         folder.nodes)
+    def __init__(
+            self, conn: ConnectionPool, stub: Stub,
+            stat: Optional[Callable[[str], Stub]] = None, changed: Optional[Callable[[str], None]] = None,
+            cached: bool = False
+    ) -> None:
+        Node.__init__(self, stub.name, None)
         self.conn = conn
+        self.meta = stub
+        self.stat = stat if stat is not None else lambda path: asserttype(Stub, conn.call('fs', 'stat', path))
+        self.__stat = stat
+        self.changed = changed if changed is not None else lambda path: None
+        self.cached = cached
+        self.ino = stub.ino
+        self.version = stub.version
+        self.total_size, self.total_files, self.total_folders = stub.size, stub.files, stub.folders
+        self.__nodes = None
+        self.__listing = None
+
+    @property
+    def nodes(self) -> Dict[str, Node]:
+        if self.__nodes is None:
+            stub = self.meta
+            if stub.children is None:
+                stub = self.stat(self.path())
+            self.__nodes = {
+                child.name: remote_node(self.conn, child, self.__stat, self.changed, self.cached, stub)
+                for child in stub.children or ()
+            }
+        return self.__nodes
+
+    def path(self) -> str:
+        return self.meta.path
+
+    def stub(self, children: bool = True) -> Stub:
+        return self.meta if children or self.meta.children is None else replace(self.meta, children=None)
+
+    def readdir(
+            self, cursor: Optional[str] = None, limit: int = READDIR_LIMIT, version: Optional[int] = None,
+            ino: Optional[int] = None
+    ) -> Optional[Listing]:
+        listing = self.conn.call('fs', 'readdir', self.path(), cursor, limit, version, ino)
+        return None if listing is None else asserttype(Listing, listing)
+
+    def entries(self, limit: int = READDIR_LIMIT) -> Tuple[Stub, ...]:
+        """Every entry sorted by name, fetched in pages of the limit
+
+        Listing an unchanged folder again costs a single not modified reply.
+        Pages continue after the last name even if the folder changes in
+        between, the entries are then kept under the version of the first
+        page, so the next call fetches them again
+        """
+        cached = self.__listing
+        if cached is not None:
+            listing = self.readdir(limit=limit, version=cached[1], ino=cached[0])
+            if listing is None:
+                return cached[2]
+        else:
+            listing = self.readdir(limit=limit)
+
+        listing = asserttype(Listing, listing)
+        ino, version, entries = listing.ino, listing.version, list(listing.entries)
+        while listing.cursor is not None:
+            listing = asserttype(Listing, self.readdir(listing.cursor, limit))
+            entries.extend(listing.entries)
+        self.__listing = ino, version, tuple(entries)
+        return self.__listing[2]
 
     def create_file(self, name: str) -> None:
-        with self.conn() as soc:
-            send_request(soc, encode_parameter('fs', 'create_file', self.path(), name))
+        self.conn.call('fs', 'create_file', self.path(), name)
+        self.changed(self.path() + name)
 
-    def open_file(self, name: str, mode: str = 'r') -> File:
-        with self.conn() as soc:
-            send_request(soc, encode_parameter('fs', 'open_file', self.path(), name, mode))
-            return RemoteFile(self.conn, asserttype(File, pickle.loads(get_request(soc))))
+    def open_file(self, name: str, mode: str = 'r', cached: Optional[bool] = None) -> FileHandle:
+        stub = asserttype(Stub, self.conn.call('fs', 'open_file', self.path(), name, mode))
+        if mode.replace('b', '') != 'r':
+            # Opening for writing may have created the file
+            self.changed(stub.path)
+        return open_handle(RemoteFile(self.conn, stub, self.changed, self.cached if cached is None else cached), mode)
 
     def delete_file(self, name: str) -> None:
-        with self.conn() as soc:
-            send_request(soc, encode_parameter('fs', 'delete_file', self.path(), name))
+        self.conn.call('fs', 'delete_file', self.path(), name)
+        self.changed(self.path() + name)
+
+
+def remote_node(
+        conn: ConnectionPool, stub: Stub,
+        stat: Optional[Callable[[str], Stub]] = None, changed: Optional[Callable[[str], None]] = None,
+        cached: bool = False, parent: Optional[Stub] = None
+) -> Node:
+    if stub.kind == FOLDER:
+        return RemoteFolder(conn, stub, stat, changed, cached)
+    return RemoteFile(conn, stub, changed, cached, stat, parent)
@@ -1,64 +1,209 @@
-import pickle
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Tuple, Optional, Iterator, Sequence, Dict
 
-from client.models.connection import Connection
+from client.models.batch import Batch
+from client.models.connection import ConnectionPool, Connection
+from client.models.remotefile import RemoteFile
 from client.models.remotefolder import RemoteFolder
 from exttypes import asserttype, Any
-from models import FileSystem, Memory, Folder
-from network.network import send_request, get_request, encode_parameter
+from models import FileSystem, Memory, Folder, File
+from models.delta import Splice
+from models.dcache import PathCache
+from models.quota import Quota, Usage
+from models.folder import READDIR_LIMIT
+from models.stub import Stub, Listing, FOLDER
+from models.system import DCACHE_SIZE
 
 
 class RemoteFileSystem(FileSystem):
+    """A file system served over the network
+
+    Folder stubs are cached until the server reports a change below
+    them, listing an unchanged folder again costs no round trip. With
+    cache_files, files are opened with the cache of RemoteFile
+    """
     ip: str
     port: int
+    conn: ConnectionPool
+    stubs: PathCache
+    cache_files: bool
+    # Receives the invalidation notices, the cache is only used while it is open
+    __watch: Connection
+    __current: Optional[str]
 
-    def __init__(self, ip: str, port: int) -> None:
+    def __init__(
+            self, ip: str, port: int, cache_size: int = DCACHE_SIZE, cache_files: bool = False,
+            secret: Optional[str] = None
+    ) -> None:
         super().__init__(Folder("/", None))
         self.ip = ip
         self.port = port
+        self.conn = ConnectionPool(ip, port, secret=secret)
+        self.stubs = PathCache(cache_size)
+        self.cache_files = cache_files
+        self.__current = None
+        self.__watch = Connection(ip, port, push=self.__pushed, user=self.conn.user, secret=secret)
+        self.__watch.call('fs', 'subscribe')
 
     def change_directory(self, path: str) -> Folder:
-        with self.__create_connection() as soc:
-            send_request(soc, encode_parameter('fs', 'change_directory', path))
-            return RemoteFolder(self.__create_connection, asserttype(Folder, pickle.loads(get_request(soc))))
+        generation = self.stubs.generation
+        stub = asserttype(Stub, self.conn.call('fs', 'change_directory', path))
+        self.__current = stub.path
+        self.stubs.put(stub.path, stub, generation)
+        return self.__folder(stub)
 
     def create_directory(self, path: str) -> None:
-        with self.__create_connection() as soc:
-            send_request(soc, encode_parameter('fs', 'create_directory', path))
+        self.conn.call('fs', 'create_directory', path)
+        self.invalidate(path)
 
     def move(self, src: str, dest: str) -> None:
-        with self.__create_connection() as soc:
-            send_request(soc, encode_parameter('fs', 'move', src, dest))
+        try:
+            self.conn.call('fs', 'move', src, dest)
+        finally:
+            self.invalidate(src)
+            self.invalidate(dest)
 
     def delete(self, path: str) -> None:
-        with self.__create_connection() as soc:
-            send_request(soc, encode_parameter('fs', 'delete', path))
+        self.conn.call('fs', 'delete', path)
+        self.invalidate(path)
+
+    def create_file(self, path: str, name: str) -> None:
+        self.conn.call('fs', 'create_file', path, name)
+        self.invalidate(f'{path}/{name}')
+
+    def delete_file(self, path: str, name: str) -> None:
+        self.conn.call('fs', 'delete_file', path, name)
+        self.invalidate(f'{path}/{name}')
 
     def save(self):
-        with self.__create_connection() as soc:
-            send_request(soc, encode_parameter('fs', 'save'))
+        self.conn.call('fs', 'save')
+
+    def patch_file(self, file: File, splices: Sequence[Splice], version: Optional[int] = None) -> int:
+        return asserttype(RemoteFile, file).patch(splices, version)
+
+    def usage(self, path: str) -> Tuple[int, int, int]:
+        return self.conn.call('fs', 'usage', path)
+
+    def stat(self, path: str) -> Stub:
+        if self.__watch.closed:
+            # Changes are no longer reported, nothing cached can be trusted
+            self.stubs.clear()
+            return asserttype(Stub, self.conn.call('fs', 'stat', path))
+
+        key = self.__key(path)
+        if key is None:
+            return asserttype(Stub, self.conn.call('fs', 'stat', path))
+
+        stub = self.stubs.get(key)
+        if stub is not None:
+            return stub
+
+        generation = self.stubs.generation
+        stub = asserttype(Stub, self.conn.call('fs', 'stat', path))
+        if stub.kind == FOLDER:
+            self.stubs.put(key, stub, generation)
+        return stub
+
+    def readdir(
+            self, path: str, cursor: Optional[str] = None, limit: int = READDIR_LIMIT, version: Optional[int] = None,
+            ino: Optional[int] = None
+    ) -> Optional[Listing]:
+        listing = self.conn.call('fs', 'readdir', path, cursor, limit, version, ino)
+        return None if listing is None else asserttype(Listing, listing)
+
+    def invalidate(self, path: str) -> None:
+        """Forget the cached stubs of the path, the folders below it and its ancestors"""
+        key = self.__key(path)
+        if key is None:
+            self.stubs.clear()
+            return
+
+        self.stubs.invalidate(key)
+        # The sizes and counts of every ancestor include the path
+        parts = key.split('/')[1:-1]
+        for i in range(len(parts)):
+            self.stubs.discard('/' + ''.join(f'{part}/' for part in parts[:i]))
+
+    def lookup(self, path: str) -> int:
+        return self.conn.call('fs', 'lookup', path)
+
+    def set_quota(
+            self, size: Optional[int] = None, inodes: Optional[int] = None,
+            path: Optional[str] = None, user: Optional[str] = None
+    ) -> None:
+        self.conn.call('fs', 'set_quota', size, inodes, path, user)
+
+    def quota(self, path: Optional[str] = None, user: Optional[str] = None) -> Tuple[Optional[Quota], Usage]:
+        return self.conn.call('fs', 'quota', path, user)
+
+    @contextmanager
+    def batch(self) -> Iterator[Batch]:
+        """Queue operations and send them in one request when the block ends
+
+        Nothing is sent if the block raises
+        """
+        batch = Batch(self.conn)
+        try:
+            yield batch
+        except BaseException:
+            batch.cancel()
+            raise
+        try:
+            batch.flush()
+        finally:
+            # The queued operations may have touched any path
+            self.stubs.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Request counts, rates and latencies of the server, see server.stats.Stats"""
+        return self.conn.call('fs', 'stats')
+
+    def sync(self) -> None:
+        self.conn.call('fs', 'sync')
+
+    def close(self) -> None:
+        self.__watch.close()
+        self.conn.close()
 
     def memory_map(self) -> Memory:
-        with self.__create_connection() as soc:
-            send_request(soc, encode_parameter('fs', 'memory_map'))
-            return asserttype(Memory, pickle.loads(get_request(soc)))
+        return Memory(BytesIO(asserttype(bytes, self.conn.call('fs', 'memory_map'))))
 
     @property
     def root(self):
-        with self.__create_connection() as soc:
-            send_request(soc, encode_parameter('fs', 'root'))
-            return RemoteFolder(self.__create_connection, asserttype(Folder, pickle.loads(get_request(soc))))
+        return self.__folder(self.stat('/'))
 
     @root.setter
     def root(self, _: Any): pass
 
     @property
     def current(self):
-        with self.__create_connection() as soc:
-            send_request(soc, encode_parameter('fs', 'current'))
-            return RemoteFolder(self.__create_connection, asserttype(Folder, pickle.loads(get_request(soc))))
+        if self.__current is not None:
+            return self.__folder(self.stat(self.__current))
+
+        stub = asserttype(Stub, self.conn.call('fs', 'current'))
+        self.__current = stub.path
+        return self.__folder(stub)
 
     @current.setter
     def current(self, _: Any): pass
 
-    def __create_connection(self) -> Connection:
-        return Connection(self.ip, self.port)
+    def __folder(self, stub: Stub) -> RemoteFolder:
+        return RemoteFolder(self.conn, stub, self.stat, self.invalidate, self.cache_files)
+
+    def __key(self, path: str) -> Optional[str]:
+        # The server resolves relative paths against its current folder, which
+        # every client shares and may have changed since, they are not cached
+        if not path.startswith('/'):
+            return None
+
+        try:
+            parts = self._normalize(path)
+        except IOError:
+            return None
+        return '/' + ''.join(f'{part}/' for part in parts if part != '.')
+
+    def __pushed(self, notice: Sequence[Any]) -> None:
+        if len(notice) == 2 and notice[0] == 'invalidate':
+            for path in notice[1]:
+                self.invalidate(path)
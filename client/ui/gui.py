@@ -1,3 +1,4 @@
+import os
 import sys
 from tkinter import Tk, Entry, Button, Label, N, W, E, messagebox, S
 from traceback import print_exception
@@ -46,7 +47,8 @@ class ClientConfig:
             self.root.destroy()
             try:
                 AuthService.init(Authentication(name))
-                FileManager(RemoteFileSystem(ip, port))
+                # Logging in as root takes the secret of the server, see Server.secret
+                FileManager(RemoteFileSystem(ip, port, secret=os.environ.get('FS_SECRET')))
             except Exception as e:
                 print_exception(e, Exception, sys.stderr)
                 messagebox.showerror('Failed to connect', e)
@@ -2,14 +2,13 @@ from typing import List, Optional, Dict
 
 from interpreter.exception import StatementError
 from interpreter.statement import Statement, FileStatement
-from models import File
-from models.file import Readable, Hybrid
+from models.file import FileHandle
 
-_file_store: List[File] = []
+_file_store: List[FileHandle] = []
 
 
-def _open_file(statement: Statement, name: str) -> File:
-    _f_map: Dict[str, File] = {
+def _open_file(statement: Statement, name: str) -> FileHandle:
+    _f_map: Dict[str, FileHandle] = {
         f.name: f
         for f in _file_store
     }
@@ -27,10 +26,8 @@ class CreateFolder(Statement):
             raise StatementError(self, "Invalid name")
 
     def execute(self) -> None:
-        self.fs.lock.acquire()
         self.pprint(f'Creating folder {self.args[0]}')
         self.fs.create_directory(self.args[0])
-        self.fs.lock.release()
 
 
 class DeleteFolder(Statement):
@@ -41,10 +38,8 @@ class DeleteFolder(Statement):
             raise StatementError(self, "Invalid name")
 
     def execute(self) -> None:
-        self.fs.lock.acquire()
         self.pprint(f'Deleting folder {self.args[0]}')
         self.fs.delete(self.args[0])
-        self.fs.lock.release()
 
 
 class ChangeFolder(Statement):
@@ -55,10 +50,8 @@ class ChangeFolder(Statement):
             raise StatementError(self, "Invalid name")
 
     def execute(self) -> None:
-        self.fs.lock.acquire()
         self.pprint(f'Changed folder from {self.fs.current.name} to {self.args[0]}')
         self.fs.change_directory(self.args[0])
-        self.fs.lock.release()
 
 
 class Move(Statement):
@@ -69,10 +62,8 @@ class Move(Statement):
             raise StatementError(self, "Invalid arguments")
 
     def execute(self) -> None:
-        self.fs.lock.acquire()
         self.pprint(f'Moving {self.args[0]} to {self.args[1]}')
         self.fs.move(self.args[0], self.args[1])
-        self.fs.lock.release()
 
 
 class CreateFile(FileStatement):
@@ -83,7 +74,7 @@ class CreateFile(FileStatement):
 
     def execute(self) -> None:
         super().execute()
-        self.fs.current.create_file(self.args[0])
+        self.fs.create_file(self.fs.current.path(), self.args[0])
 
 
 class DeleteFile(FileStatement):
@@ -100,7 +91,7 @@ class DeleteFile(FileStatement):
         ]: raise StatementError(self, "File is opened")
 
         self.pprint(f'Deleting file {self.args[0]}')
-        self.fs.current.delete_file(self.args[0])
+        self.fs.delete_file(self.fs.current.path(), self.args[0])
 
 
 class OpenFile(FileStatement):
@@ -119,10 +110,8 @@ class OpenFile(FileStatement):
     def execute(self) -> None:
         super().execute()
         src = self.fs.current.open_file(self.name, self.mode)
-        src.lock.acquire()
         self.pprint(f'Opening {src.name} as {type(src)}', is_log=True)
         _file_store.append(src)
-        src.lock.release()
 
 
 class CloseFile(FileStatement):
@@ -141,10 +130,13 @@ class CloseFile(FileStatement):
         self.pprint(f'Closing {self.name}', is_log=True)
         if self.name not in map(lambda x: x.name, _file_store):
             raise StatementError(self, "No such file opened")
+        for f in _file_store:
+            if f.name == self.name:
+                f.close()
         _file_store = [
             f
             for f in _file_store
-            if f.name != self.name
+            if not f.closed
         ]
 
 
@@ -166,14 +158,16 @@ class ReadFile(FileStatement):
 
     def execute(self) -> None:
         super().execute()
-        src: File = _open_file(self, self.name)
-        src.lock.acquire()
+        src: FileHandle = _open_file(self, self.name)
         self.pprint(f'Reading from {src.name}', is_log=True)
-        if not isinstance(src, Readable) and not isinstance(src, Hybrid):
+        if not src.readable():
             raise StatementError(self, "File opened in write-only mode")
 
-        self.pprint(src.read(self.start, self.size))
-        src.lock.release()
+        with src.reading():
+            src.seek(self.start)
+            # The last argument is the offset reading stops at, as with File.read
+            data = src.read(max(self.size - self.start, 0) if self.size >= 0 else -1)
+        self.pprint(data if isinstance(data, str) else bytes(data))
 
 
 class WriteToFile(FileStatement):
@@ -192,19 +186,15 @@ class WriteToFile(FileStatement):
 
     def execute(self) -> None:
         super().execute()
-        src: File = _open_file(self, self.name)
-        src.lock.acquire()
+        src: FileHandle = _open_file(self, self.name)
         self.pprint(f'Writing to {src.name}', is_log=True)
-        if isinstance(src, Readable):
+        if not src.writable():
             raise StatementError(self, "File opened in read-only mode")
 
-        if self.start is not None:
-            src.write(self.contents, start=self.start)
-        else:
+        with src.writing():
+            src.seek(self.start if self.start is not None else 0)
             src.write(self.contents)
 
-        src.lock.release()
-
 
 class TruncateFile(FileStatement):
     name: str
@@ -219,11 +209,23 @@ class TruncateFile(FileStatement):
 
     def execute(self) -> None:
         super().execute()
-        src: File = _open_file(self, self.name)
-        src.lock.acquire()
+        src: FileHandle = _open_file(self, self.name)
         self.pprint(f'Truncating {src.name}', is_log=True)
         src.truncate(self.end)
-        src.lock.release()
+
+
+class DiskUsage(FileStatement):
+    path: str = ''
+    command: str = 'du'
+
+    def initialize(self) -> None:
+        if self.args is not None:
+            self.path = self.args[0].strip()
+
+    def execute(self) -> None:
+        super().execute()
+        size, files, folders = self.fs.usage(self.path or self.fs.current.path())
+        self.pprint(f'{size} bytes, {files} files, {folders} folders')
 
 
 class MemoryMap(FileStatement):
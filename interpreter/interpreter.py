@@ -40,6 +40,7 @@ class Interpreter:
             WriteToFile,
             CloseFile,
             TruncateFile,
+            DiskUsage,
             MemoryMap
         ]
 
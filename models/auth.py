@@ -4,3 +4,8 @@ from dataclasses import dataclass
 @dataclass
 class Authentication:
     name: str
+
+
+ROOT = Authentication('root')
+# Remote connections that never named a user, or claimed root without the secret
+ANONYMOUS = Authentication('anonymous')
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+from typing import Callable, Union, Optional
+from weakref import ref, ReferenceType
+
+Bytes = Union[bytes, bytearray, memoryview]
+
+
+class Buffer:
+    """Binary file storage with the same interface as Rope
+
+    Slices are memoryviews into the underlying bytearray, not copies. A
+    view that is still alive pins the bytearray's size, so a resizing write
+    swaps in a copy and the view keeps the old contents. A write of the same
+    size changes the bytearray in place, which outstanding views then show.
+    Readers that need the range as it was copy it before releasing the lock
+    """
+    data: bytearray
+    # A snapshot sharing the bytearray, the next change copies it while it is alive
+    __shared: Optional[ReferenceType] = None
+
+    def __init__(self, contents: Bytes = b'') -> None:
+        self.data = bytearray(contents)
+
+    def __getstate__(self) -> dict:
+        return {'data': self.data}
+
+    def snapshot(self) -> Buffer:
+        """A copy sharing the bytearray until either of them changes, see Rope.snapshot"""
+        copy = Buffer.__new__(Buffer)
+        copy.data = self.data
+        copy.__shared = self.__shared = ref(copy)
+        return copy
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def slice(self, start: int, end: int) -> memoryview:
+        return memoryview(self.data)[start:end]
+
+    def insert(self, offset: int, contents: Bytes) -> None:
+        self.replace(offset, offset, contents)
+
+    def replace(self, start: int, end: int, contents: Bytes) -> None:
+        def _replace(data: bytearray) -> None:
+            data[start:end] = contents
+
+        self.__mutate(_replace)
+
+    def copy(self, start: int, end: int, target: int) -> None:
+        chunk = self.data[start:end]
+        self.replace(target, target + len(chunk), chunk)
+
+    def truncate(self, end: int) -> None:
+        def _truncate(data: bytearray) -> None:
+            del data[end:]
+
+        self.__mutate(_truncate)
+
+    def __mutate(self, func: Callable[[bytearray], None]) -> None:
+        shared, self.__shared = self.__shared, None
+        if shared is not None and shared() is not None:
+            self.data = bytearray(self.data)
+        try:
+            func(self.data)
+        except BufferError:
+            self.data = bytearray(self.data)
+            func(self.data)
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Dict, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from models.folder import Folder
+
+
+class PathCache:
+    """Bounded LRU cache of normalized absolute paths to folders
+
+    Every invalidation bumps the generation, so a lookup that walked the
+    tree while the structure changed doesn't insert a stale entry
+    """
+    capacity: int
+    hits: int
+    misses: int
+    generation: int
+    __entries: OrderedDict
+    __lock: Lock
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, path: str) -> Optional[Folder]:
+        with self.__lock:
+            folder = self.__entries.get(path)
+            if folder is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__entries.move_to_end(path)
+            return folder
+
+    def put(self, path: str, folder: Folder, generation: int) -> None:
+        with self.__lock:
+            if generation != self.generation or self.capacity <= 0:
+                return
+
+            self.__entries[path] = folder
+            self.__entries.move_to_end(path)
+            while len(self.__entries) > self.capacity:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, path: str) -> None:
+        """Drop the path and every path below it"""
+        with self.__lock:
+            self.generation += 1
+            for key in [k for k in self.__entries if k.startswith(path)]:
+                del self.__entries[key]
+
+    def discard(self, path: str) -> None:
+        """Drop only the path itself"""
+        with self.__lock:
+            self.generation += 1
+            self.__entries.pop(path, None)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.generation += 1
+            self.__entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self.__entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
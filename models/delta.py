@@ -0,0 +1,120 @@
+from bisect import bisect_left
+from typing import List, Tuple, Union, Iterator, Sequence, Dict, Optional
+
+# Length of the blocks of the old contents looked up in the new contents
+BLOCK_SIZE = 64
+
+# Replace [start, end) of the old contents with the text
+Splice = Tuple[int, int, Union[str, bytes]]
+
+
+class VersionMismatch(IOError):
+    """The file changed since the version a patch was computed against"""
+    pass
+
+
+def diff(old: Union[str, bytes], new: Union[str, bytes], block: int = BLOCK_SIZE) -> List[Splice]:
+    """ Compute the splices that turn old into new
+
+    The common prefix and suffix are cut off first, blocks of the old
+    contents left in between are found in the new contents with a rolling
+    checksum, like rsync, so only the ranges around the edits are sent
+
+    :param old: The contents the receiver has
+    :param new: The contents it should have
+    :param block: The length of the matched blocks
+    :return: Non overlapping splices in ascending order of their offsets in old
+    """
+    if block <= 0:
+        raise ValueError(f"Invalid block size: {block}")
+
+    prefix = _common_prefix(old, new)
+    suffix = _common_suffix(old, new, min(len(old), len(new)) - prefix)
+    old_end, new_end = len(old) - suffix, len(new) - suffix
+
+    splices: List[Splice] = []
+    old_pos = new_pos = prefix
+    for old_match, new_match in _matches(old, new, prefix, old_end, new_end, block):
+        if old_match > old_pos or new_match > new_pos:
+            splices.append((old_pos, old_match, new[new_pos:new_match]))
+        old_pos, new_pos = old_match + block, new_match + block
+
+    if old_pos < old_end or new_pos < new_end:
+        splices.append((old_pos, old_end, new[new_pos:new_end]))
+    return splices
+
+
+def _common_prefix(a: Union[str, bytes], b: Union[str, bytes]) -> int:
+    # Comparing slices runs in C, a binary search needs few of them
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a: Union[str, bytes], b: Union[str, bytes], limit: int) -> int:
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _matches(
+        old: Union[str, bytes], new: Union[str, bytes], start: int, old_end: int, new_end: int, block: int
+) -> Iterator[Tuple[int, int]]:
+    """Offsets in old and new of equal blocks, both ascending"""
+    if old_end - start < block or new_end - start < block:
+        return
+
+    index: Dict[int, List[int]] = {}
+    for offset in range(start, old_end - block + 1, block):
+        index.setdefault(_checksum(_values(old[offset:offset + block]))[0], []).append(offset)
+
+    values = _values(new[start:new_end])
+    checksum, a, b = _checksum(values[:block])
+    floor = start
+    pos = start
+    while True:
+        offsets = index.get(checksum)
+        offset = _match(old, new[pos:pos + block], offsets, floor) if offsets is not None else None
+        if offset is not None:
+            yield offset, pos
+            floor, pos = offset + block, pos + block
+            if new_end - pos < block:
+                return
+            checksum, a, b = _checksum(values[pos - start:pos - start + block])
+            continue
+
+        if pos + block >= new_end:
+            return
+        out, into = values[pos - start], values[pos - start + block]
+        a = a - out + into
+        b = b - block * out + a
+        checksum = a | b << 32
+        pos += 1
+
+
+def _match(old: Union[str, bytes], data: Union[str, bytes], offsets: Sequence[int], floor: int) -> Optional[int]:
+    # Blocks are only matched in order, the gaps between them become the splices
+    for offset in offsets[bisect_left(offsets, floor):]:
+        if old[offset:offset + len(data)] == data:
+            return offset
+    return None
+
+
+def _values(contents: Union[str, bytes]) -> Sequence[int]:
+    return contents if isinstance(contents, (bytes, bytearray)) else [ord(c) for c in contents]
+
+
+def _checksum(values: Sequence[int]) -> Tuple[int, int, int]:
+    a = sum(values)
+    b = sum((len(values) - i) * v for i, v in enumerate(values))
+    return a | b << 32, a, b
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from threading import Thread, Event
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from models.system import FileSystem
+
+IMMEDIATE = 'immediate'
+GROUP = 'group'
+MANUAL = 'manual'
+
+
+@dataclass(frozen=True)
+class Durability:
+    mode: str
+    interval: Optional[float] = None
+    ops: Optional[int] = None
+
+    @staticmethod
+    def immediate() -> Durability:
+        return Durability(IMMEDIATE)
+
+    @staticmethod
+    def group(interval: int = 50, ops: int = 128) -> Durability:
+        """Commit the journal every interval milliseconds or every ops records, whichever comes first"""
+        return Durability(GROUP, interval / 1000, ops)
+
+    @staticmethod
+    def manual() -> Durability:
+        return Durability(MANUAL)
+
+
+class Checkpointer(Thread):
+    fs: FileSystem
+    durability: Durability
+    __wakeup: Event
+    __stopped: bool
+
+    def __init__(self, fs: FileSystem, durability: Durability) -> None:
+        super().__init__(name='Checkpointer', daemon=True)
+        self.fs = fs
+        self.durability = durability
+        self.__wakeup = Event()
+        self.__stopped = False
+
+    def notify(self) -> None:
+        self.__wakeup.set()
+
+    def stop(self) -> None:
+        self.__stopped = True
+        self.__wakeup.set()
+        self.join()
+
+    def run(self) -> None:
+        while not self.__stopped:
+            self.__wakeup.wait(self.durability.interval if self.durability.mode == GROUP else None)
+            self.__wakeup.clear()
+            try:
+                journal = self.fs.journal
+                if journal is None:
+                    continue
+
+                if self.durability.mode == GROUP:
+                    journal.sync()
+                if self.fs.should_checkpoint():
+                    self.fs.save()
+            except OSError as e:
+                print(f'Checkpoint failed: {e}')
@@ -1,134 +1,323 @@
-from abc import abstractmethod
-from io import UnsupportedOperation
-from typing import Union, Any, Optional
+from __future__ import annotations
 
+from io import UnsupportedOperation, RawIOBase, SEEK_SET, SEEK_CUR, SEEK_END
+from typing import Union, Any, Optional, Iterator, Tuple, Sequence
+
+from models.buffer import Buffer
+from models.delta import Splice, VersionMismatch
 from models.node import Node
+from models.rope import Rope
+from models.stub import Stub, FILE
+
+CHUNK_SIZE = 64 * 1024
+MODES = ('r', 'w', 'a', 'rw', 'ra')
 
 
 class File(Node):
-    contents: Union[bytes, str]
+    contents: Union[Rope, Buffer]
 
-    def __init__(self, name: str, parent: Node, contents: Union[bytes, str] = "") -> None:
+    def __init__(self, name: str, parent: Node, contents: Union[bytes, str] = "", binary: bool = False) -> None:
         super().__init__(name, parent)
-        self.contents = contents
+        if binary:
+            self.contents = Buffer(contents.encode('utf-8') if isinstance(contents, str) else contents)
+        else:
+            self.contents = Rope(contents)
 
-    def write(self, contents: Union[str, bytes], start: int = 0) -> None:
-        # A small issue while adding the type signatures
-        # The protected method only support str but the public supports
-        # the union of str and bytes
-        # TODO: Fix this mess
-        self._write(str(contents), start)
+    def __setstate__(self, state: dict) -> None:
+        # Files pickled before the rope was introduced store plain strings
+        if not isinstance(state.get('contents'), (Rope, Buffer)):
+            state['contents'] = Rope(state.get('contents', ''))
+        super().__setstate__(state)
 
-    def _write(self, contents: str, start: int = 0, append: bool = False) -> None:
-        self.contents = self.contents[:start + 1] + \
-                        contents + \
-                        self.contents[(start if append else start + len(contents)):]
+    @property
+    def binary(self) -> bool:
+        return isinstance(self.contents, Buffer)
 
-    def read(self, start: int = 0, end: int = -1) -> Union[str, bytes]:
-        return self.contents[start:] if end < 0 else self.contents[start:end]
+    def write(self, contents: Union[str, bytes], start: int = 0) -> None:
+        self._write(self._coerce(contents), start)
+
+    def _write(self, contents: Union[str, bytes], start: int = 0, append: bool = False) -> None:
+        with self.writing():
+            end = start if append else start + len(contents)
+            gap = start - len(self.contents)
+            self._charge_resize(self._spliced(start, end, len(contents)) + max(gap, 0))
+            if gap > 0:
+                # Writing past the end leaves a hole of zeros, like pwrite, so
+                # writes to separate ranges land right in whatever order they run
+                self.contents.insert(len(self.contents), _zeros(self.binary, gap))
+            self.contents.replace(start, end, contents)
+            self.version += 1
+
+    def patch(self, splices: Sequence[Splice], version: Optional[int] = None) -> int:
+        """Apply the splices of delta.diff at once, only while the file is at the version
+
+        :return: The version after the patch
+        """
+        with self.writing():
+            if version is not None and version != self.version:
+                raise VersionMismatch(f"Version mismatch: expected {version}, found {self.version}")
+
+            size = len(self.contents)
+            splices = [(start, end, self._coerce(contents)) for start, end, contents in splices]
+            last = 0
+            for start, end, contents in splices:
+                if not last <= start <= end <= size:
+                    raise IOError(f"Invalid splice: {start}, {end}")
+                last = end
+            self._charge_resize(size + sum(len(contents) - (end - start) for start, end, contents in splices))
+            # Later splices first, so the offsets of the earlier ones stay valid
+            for start, end, contents in reversed(splices):
+                self.contents.replace(start, end, contents)
+            self.version += 1
+            return self.version
+
+    def snapshot(self, parent: Optional[Node] = None) -> File:
+        copy = super().snapshot(parent)
+        copy.contents = self.contents.snapshot()
+        return copy
+
+    def _coerce(self, contents: Any) -> Union[str, bytes]:
+        """Convert the contents to the type stored by this file
+
+        Binary files accept str (utf-8) and any object supporting the buffer
+        protocol without copying it, text files decode buffers as utf-8
+        """
+        if self.binary:
+            return contents.encode('utf-8') if isinstance(contents, str) else memoryview(contents).cast('B')
+        if isinstance(contents, (bytes, bytearray, memoryview)):
+            return bytes(contents).decode('utf-8')
+        return str(contents)
+
+    def read(self, start: int = 0, end: int = -1) -> Union[str, bytes, memoryview]:
+        with self.reading():
+            start, end, _ = slice(start, None if end < 0 else end).indices(len(self.contents))
+            return self.contents.slice(start, end)
 
     def move(self, start: int, end: int, target: int) -> None:
-        _mov = self.contents[start:end]
-        self.write(_mov, target)
+        with self.writing():
+            start, end, _ = slice(start, end).indices(len(self.contents))
+            self._charge_resize(self._spliced(target, target + max(end - start, 0), max(end - start, 0)))
+            self.contents.copy(start, end, target)
+            self.version += 1
 
     def truncate(self, end: int) -> None:
-        self.contents = self.contents[:end]
+        with self.writing():
+            end = slice(0, end).indices(len(self.contents))[1]
+            self._charge_resize(end)
+            self.contents.truncate(end)
+            self.version += 1
 
-    @abstractmethod
-    def close(self):
-        ...
+    def flush(self) -> None:
+        """Writes apply immediately, only files buffering them have to send them"""
+        pass
 
+    def size(self) -> int:
+        return len(self.contents)
 
-class Readable(File):
-    file: Optional[File]
+    def usage(self) -> Tuple[int, int, int]:
+        return len(self.contents), 1, 0
 
-    def __init__(self, file: File):
-        super().__init__(file.name, file.parent, file.read())
-        self.file = file
+    def cost(self) -> Tuple[int, int]:
+        return len(self.contents), 1
 
-    def read(self, start: int = 0, end: int = -1) -> Union[str, bytes]:
-        return self.file.read(start, end)
+    def stub(self, children: bool = True) -> Stub:
+        return Stub(
+            self.name, FILE, self.path(), self.parent.path() if self.parent is not None else None,
+            self.ino, self.version, len(self.contents), self.binary
+        )
 
-    def write(self, contents: Union[str, bytes], start: int = 0, append: bool = False) -> None:
-        raise UnsupportedOperation("Not writable")
+    def _spliced(self, start: int, end: int, length: int) -> int:
+        """The size after replacing [start, end) with length items"""
+        size = len(self.contents)
+        start = min(start, size)
+        return size - (min(max(end, start), size) - start) + length
 
-    def move(self, start: int, end: int, target: Any) -> None:
-        raise UnsupportedOperation("Not writable")
+    def _charge_resize(self, size: int) -> None:
+        # Quotas are checked before the contents change, so a rejected
+        # write leaves the file untouched
+        self._propagate(size - len(self.contents), 0, 0, owner=self.owner)
 
-    def truncate(self, end: int) -> None:
-        raise UnsupportedOperation("Not writable")
 
-    def close(self):
-        self.file = None
+def _zeros(binary: bool, size: int) -> Union[str, bytes]:
+    return bytes(size) if binary else '\0' * size
 
 
-class Writeable(File):
+class FileHandle(RawIOBase):
+    """A cursor over a File that reads and writes through to it
+
+    Opening a handle never copies the contents, reads only materialize the
+    requested range. Binary files return memoryviews and support readinto.
+    Changes to a file of a FileSystem go through it, so they are journaled
+    """
     file: Optional[File]
+    append: bool
+    _readable: bool = False
+    _writable: bool = False
+    __pos: int
 
-    def __init__(self, file: File):
-        super().__init__(file.name, file.parent, file.read())
+    def __init__(self, file: File, append: bool = False) -> None:
+        super().__init__()
         self.file = file
+        self.append = append
+        self.__pos = 0
+
+    @property
+    def name(self) -> str:
+        return self._file().name
+
+    def reading(self):
+        return self._file().reading()
+
+    def writing(self):
+        return self._file().writing()
+
+    def readable(self) -> bool:
+        return self._readable
+
+    def writable(self) -> bool:
+        return self._writable
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__pos
+
+    def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+        if whence == SEEK_SET:
+            pos = offset
+        elif whence == SEEK_CUR:
+            pos = self.__pos + offset
+        elif whence == SEEK_END:
+            pos = self._file().size() + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+
+        self.__pos = pos
+        return pos
+
+    def read(self, size: int = -1) -> Union[str, bytes, memoryview]:
+        if not self._readable:
+            raise UnsupportedOperation("Not readable")
+
+        data = self._file().read(self.__pos, -1 if size is None or size < 0 else self.__pos + size)
+        self.__pos += len(data)
+        return data
+
+    def readall(self) -> Union[str, bytes]:
+        data = self.read()
+        return data if isinstance(data, str) else bytes(data)
+
+    def readinto(self, buffer: Any) -> int:
+        if not self._file().binary:
+            raise UnsupportedOperation("Not a binary file")
+
+        view = memoryview(buffer).cast('B')
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def write(self, contents: Any) -> int:
+        if not self._writable:
+            raise UnsupportedOperation("Not writable")
+
+        file = self._file()
+        contents = file._coerce(contents)
+        if self.append:
+            self.__pos = file.size()
+        system = file._system()
+        if system is not None:
+            system.write_inode(system.register(file), contents, self.__pos)
+        else:
+            file._write(contents, self.__pos)
+        self.__pos += len(contents)
+        return len(contents)
 
-    def write(self, contents: Union[str, bytes], start: int = 0) -> None:
-        self.file._write(contents, start)
-
-    def read(self, start: int = 0, end: int = -1) -> Union[str, bytes]:
-        raise UnsupportedOperation("Not readable")
-
-    def move(self, start: int, end: int, target: Any) -> None:
-        self.file.move(start, end, target)
-
-    def truncate(self, end: int) -> None:
-        self.file.truncate(end)
-
-    def close(self):
+    def move(self, start: int, end: int, target: int) -> None:
+        if not self._writable:
+            raise UnsupportedOperation("Not writable")
+
+        file = self._file()
+        system = file._system()
+        if system is not None:
+            system.move_inode(system.register(file), start, end, target)
+        else:
+            file.move(start, end, target)
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        if not self._writable:
+            raise UnsupportedOperation("Not writable")
+
+        size = self.__pos if size is None else size
+        file = self._file()
+        system = file._system()
+        if system is not None:
+            system.truncate_inode(system.register(file), size)
+        else:
+            file.truncate(size)
+        return size
+
+    def chunks(self, size: int = CHUNK_SIZE) -> Iterator[Union[str, bytes, memoryview]]:
+        while True:
+            data = self.read(size)
+            if len(data) == 0:
+                return
+            yield data
+
+    def __iter__(self) -> Iterator[Union[str, bytes, memoryview]]:
+        return self.chunks()
+
+    def flush(self) -> None:
+        super().flush()
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self) -> None:
+        # Closing flushes the handle, and with it the file, first
+        super().close()
         self.file = None
 
+    def _file(self) -> File:
+        if self.file is None:
+            raise ValueError("I/O operation on closed file")
+        return self.file
 
-class Appendable(File):
-    file: Optional[File]
 
-    def __init__(self, file: File):
-        super().__init__(file.name, file.parent, file.read())
-        self.file = file
+class Readable(FileHandle):
+    _readable = True
 
-    def write(self, contents: Union[str, bytes], start: int = 0) -> None:
-        self.file._write(contents, start, True)
 
-    def read(self, start: int = 0, end: int = -1) -> Union[str, bytes]:
-        raise UnsupportedOperation("Not readable")
+class Writeable(FileHandle):
+    _writable = True
 
-    def move(self, start: int, end: int, target: Any) -> None:
-        self.file.move(start, end, target)
 
-    def truncate(self, end: int) -> None:
-        self.file.truncate(end)
+class Appendable(FileHandle):
+    _writable = True
 
-    def close(self):
-        self.file = None
+    def __init__(self, file: File, append: bool = True) -> None:
+        super().__init__(file, append)
 
 
-class Hybrid(File):
-    file: Optional[File]
+class Hybrid(FileHandle):
+    _readable = True
+    _writable = True
 
-    def __init__(self, file: File):
-        super().__init__(file.name, file.parent, file.read())
-        self.file = file
 
-    def write(self, contents: Union[str, bytes], start: int = 0) -> None:
-        self.file.write(contents, start)
-
-    def _write(self, contents: str, start: int = 0, append: bool = False) -> None:
-        self.file._write(contents, start, append)
+def open_handle(file: File, mode: str) -> FileHandle:
+    mode = mode.replace('b', '')
+    if mode not in MODES:
+        raise IOError(f"Invalid mode: {mode}")
 
-    def read(self, start: int = 0, end: int = -1) -> Union[str, bytes]:
-        return self.file.read(start, end)
-
-    def move(self, start: int, end: int, target: int) -> None:
-        self.file.move(start, end, target)
+    if mode == 'r':
+        return Readable(file)
+    elif mode == 'w':
+        return Writeable(file)
+    elif mode == 'a':
+        return Appendable(file)
+    elif mode == 'rw':
+        return Hybrid(file)
 
-    def truncate(self, end: int) -> None:
-        self.file.truncate(end)
-
-    def close(self):
-        self.file = None
+    return Hybrid(file, append=True)
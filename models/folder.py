@@ -1,14 +1,32 @@
 from __future__ import annotations
 
-from typing import Optional, Dict
+from bisect import bisect_right
+from typing import Optional, Dict, Tuple, Iterator, TYPE_CHECKING
 
 from exttypes import asserttype
-from models.file import File, Readable, Writeable, Appendable, Hybrid
+from models.file import File, FileHandle, MODES, open_handle
 from models.node import Node
+from models.quota import Quota, QuotaTable, Usage
+from models.stub import Stub, Listing, FOLDER
+
+if TYPE_CHECKING:
+    from models.system import FileSystem
+
+# Entries per page of a folder listing
+READDIR_LIMIT = 256
 
 
 class Folder(Node):
     nodes: Dict[str, Node]
+    # Running totals of the whole subtree below this folder
+    total_size: int = 0
+    total_files: int = 0
+    total_folders: int = 0
+    quota: Optional[Quota] = None
+    # Per user accounting, only kept on the root
+    quotas: Optional[QuotaTable] = None
+    # The file system files opened below journal their changes to, only set on the root
+    system: Optional[FileSystem] = None
 
     def __init__(self, name: str, parent: Optional[Folder], nodes: Optional[Dict[str, Node]] = None) -> None:
         super().__init__(name, parent)
@@ -16,31 +34,138 @@ class Folder(Node):
             nodes = {}
 
         self.nodes = nodes
+        self.recount()
 
-    def create_file(self, name: str) -> None:
-        self.nodes[name] = File(name, self)
+    def __getstate__(self) -> dict:
+        state = super().__getstate__()
+        state.pop('system', None)
+        return state
 
-    def open_file(self, name: str, mode: str = 'r') -> File:
-        try:
-            if mode == 'r':
-                if name in self.nodes:
-                    return Readable(asserttype(File, self.nodes[name]))
+    def snapshot(self, parent: Optional[Node] = None) -> Folder:
+        copy = super().snapshot(parent)
+        copy.nodes = {name: node.snapshot(copy) for name, node in self.nodes.items()}
+        if self.quotas is not None:
+            copy.quotas = QuotaTable(
+                dict(self.quotas.quotas),
+                {user: Usage(usage.size, usage.inodes) for user, usage in self.quotas.usage.items()}
+            )
+        return copy
+
+    def usage(self) -> Tuple[int, int, int]:
+        return self.total_size, self.total_files, self.total_folders + 1
+
+    def stub(self, children: bool = True) -> Stub:
+        with self.reading():
+            return Stub(
+                self.name, FOLDER, self.path(), self.parent.path() if self.parent is not None else None,
+                self.ino, self.version, self.total_size, False, self.total_files, self.total_folders,
+                tuple(node.stub(False) for node in self.nodes.values()) if children else None
+            )
+
+    def readdir(
+            self, cursor: Optional[str] = None, limit: int = READDIR_LIMIT, version: Optional[int] = None,
+            ino: Optional[int] = None
+    ) -> Optional[Listing]:
+        """The page of entries after the cursor, None if the folder is still at the version
+
+        Given the inode as well, a folder created again at the path is never taken for the old one
+        """
+        if limit <= 0:
+            raise IOError(f"Invalid limit: {limit}")
+
+        with self.reading():
+            if version == self.version and (ino is None or ino == self.ino):
+                return None
+
+            names = sorted(self.nodes)
+            start = 0 if cursor is None else bisect_right(names, cursor)
+            page = names[start:start + limit]
+            return Listing(
+                self.path(), self.version, tuple(self.nodes[name].stub(False) for name in page),
+                page[-1] if start + limit < len(names) else None, self.ino
+            )
+
+    def walk(self) -> Iterator[Node]:
+        yield self
+        for node in list(self.nodes.values()):
+            yield from node.walk()
+
+    def recount(self) -> None:
+        self.total_size = self.total_files = self.total_folders = 0
+        for node in self.nodes.values():
+            if isinstance(node, Folder):
+                node.recount()
+
+            size, files, folders = node.usage()
+            self.total_size += size
+            self.total_files += files
+            self.total_folders += folders
 
+    def attach(self, node: Node, charge: bool = True) -> None:
+        """Insert the node, replacing any node with the same name
+
+        A charged node is new and counts against the quota of its owner,
+        moved nodes are only checked against the quotas of the folders
+        """
+        with self.writing():
+            replaced = self.nodes.get(node.name)
+            if replaced is not None:
+                self.detach(node.name)
+
+            parent = node.parent
+            node.parent = self
+            try:
+                node._propagate(*node.usage(), owner=node.owner if charge else None)
+            except IOError:
+                # Put back what was there before, it fitted already
+                node.parent = parent
+                if replaced is not None:
+                    replaced._propagate(*replaced.usage(), check=False)
+                    replaced._charge()
+                    self.nodes[node.name] = replaced
+                raise
+
+            self.nodes[node.name] = node
+            self.version += 1
+
+    def detach(self, name: str, charge: bool = True) -> Node:
+        with self.writing():
+            node = self.nodes[name]
+            size, files, folders = node.usage()
+            node._propagate(-size, -files, -folders)
+            if charge:
+                node._charge(-1)
+            del self.nodes[name]
+            self.version += 1
+            return node
+
+    def create_file(self, name: str, binary: bool = False) -> None:
+        self.attach(File(name, self, binary=binary))
+
+    def open_file(self, name: str, mode: str = 'r') -> FileHandle:
+        if mode.replace('b', '') not in MODES:
+            raise IOError(f"Invalid mode: {mode}")
+
+        if name not in self.nodes:
+            if mode.replace('b', '') == 'r':
                 raise IOError("No such file")
 
-            if name not in self.nodes:
-                self.create_file(name)
-
-            if mode == 'w':
-                return Writeable(asserttype(File, self.nodes[name]))
-            elif mode == 'a':
-                return Appendable(Writeable(asserttype(File, self.nodes[name])))
-            elif mode == 'rw':
-                return Hybrid(asserttype(File, self.nodes[name]))
-            elif mode == 'ra':
-                return Appendable(Hybrid(asserttype(File, self.nodes[name])))
+            system = self._system()
+            if system is not None:
+                system.create_file(self.path(), name, 'b' in mode)
+            else:
+                self.create_file(name, 'b' in mode)
+
+        return open_handle(self.get_file(name), mode)
+
+    def get_file(self, name: str) -> File:
+        if name not in self.nodes:
+            raise IOError("No such file")
+
+        try:
+            return asserttype(File, self.nodes[name])
         except AssertionError:
             raise IOError("Is directory")
 
     def delete_file(self, name: str) -> None:
-        self.nodes.pop(name)
+        self.detach(name)
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import os
+import pickle
+import struct
+from threading import Lock
+from typing import Iterator, Tuple, Any, BinaryIO, Optional
+
+# Sequence number, operation, arguments and the user that issued it
+Record = Tuple[int, str, Tuple[Any, ...], Optional[str]]
+
+_HEADER = struct.Struct("I")
+
+
+class Journal:
+    path: str
+    size: int
+    pending: int
+    __file: BinaryIO
+    __lock: Lock
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.pending = 0
+        self.__lock = Lock()
+        self.__file = open(path, 'ab')
+        self.size = self.__file.tell()
+
+    def append(self, seq: int, op: str, args: Tuple[Any, ...], user: Optional[str] = None) -> None:
+        record = pickle.dumps((seq, op, args, user), 3)
+        with self.__lock:
+            self.__file.write(_HEADER.pack(len(record)) + record)
+            self.size += _HEADER.size + len(record)
+            self.pending += 1
+
+    def sync(self) -> None:
+        with self.__lock:
+            if self.pending == 0:
+                return
+
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.pending = 0
+
+    def records(self) -> Iterator[Record]:
+        offset = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+
+                record = f.read(_HEADER.unpack(header)[0])
+                try:
+                    entry = pickle.loads(record)
+                except Exception:
+                    # Torn write at the tail, everything after it is garbage
+                    break
+
+                offset = f.tell()
+                # Records written before users were tracked have no user
+                yield entry if len(entry) == 4 else (*entry, None)
+
+        if offset != self.size:
+            self.__file.truncate(offset)
+            self.size = offset
+
+    def discard(self, offset: int) -> None:
+        """Drop every record before offset, keeping the ones appended after it"""
+        with self.__lock:
+            self.__file.flush()
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                tail = f.read()
+
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.__file.close()
+            os.replace(tmp, self.path)
+            self.__file = open(self.path, 'ab')
+            self.size = len(tail)
+            self.pending = 0
+
+    def close(self) -> None:
+        self.sync()
+        self.__file.close()
+
+
+def journal_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.journal'
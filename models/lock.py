@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+from threading import Condition, get_ident
+from time import monotonic
+from typing import Dict, Callable, Optional, List, Tuple
+
+# Intent shared, intent exclusive, shared and exclusive modes
+IS = 'IS'
+IX = 'IX'
+S = 'S'
+X = 'X'
+
+_COMPATIBLE: Dict[str, frozenset] = {
+    IS: frozenset((IS, IX, S)),
+    IX: frozenset((IS, IX)),
+    S: frozenset((IS, S)),
+    X: frozenset(),
+}
+
+
+class NodeLock:
+    """A reentrant multi-mode lock used for hierarchical locking of nodes
+
+    A thread never conflicts with the modes it already holds, so nested
+    acquisitions (and upgrades while being the only holder) succeed. Without
+    a mode it behaves like an exclusive threading.Lock
+
+    Waiting acquisitions are served in arrival order, a new acquisition queues
+    behind every waiting one it is incompatible with even when the holders
+    would allow it. So a shared lock on a busy folder is granted once the
+    writers that came first are done instead of never. Threads already holding
+    the lock skip the queue, they are what the queue waits for
+    """
+    __cond: Condition
+    __holders: Dict[int, Dict[str, int]]
+    # Blocked acquisitions in arrival order, as (thread, mode)
+    __waiting: List[Tuple[int, str]]
+    # Called with the seconds an acquisition waited for other threads
+    waited: Optional[Callable[[float], None]] = None
+
+    def __init__(self) -> None:
+        self.__cond = Condition()
+        self.__holders = {}
+        self.__waiting = []
+
+    def acquire(self, mode: str = X, blocking: bool = True, timeout: float = -1) -> bool:
+        me = get_ident()
+        deadline = None if timeout < 0 else monotonic() + timeout
+        with self.__cond:
+            # Only contended acquisitions read the clock
+            began = None
+            ticket = None
+            while not self.__grantable(me, mode, ticket):
+                if not blocking:
+                    return False
+                if ticket is None:
+                    began = monotonic()
+                    ticket = (me, mode)
+                    self.__waiting.append(ticket)
+                if deadline is None:
+                    self.__cond.wait()
+                elif not self.__cond.wait(deadline - monotonic()):
+                    self.__dequeue(ticket)
+                    return False
+            if ticket is not None:
+                self.__dequeue(ticket)
+
+            waited = NodeLock.waited
+            if began is not None and waited is not None:
+                waited(monotonic() - began)
+            held = self.__holders.setdefault(me, {})
+            held[mode] = held.get(mode, 0) + 1
+            return True
+
+    def release(self, mode: str = X) -> None:
+        me = get_ident()
+        with self.__cond:
+            held = self.__holders.get(me, {})
+            if held.get(mode, 0) == 0:
+                raise RuntimeError(f"Releasing un-acquired {mode} lock")
+
+            held[mode] -= 1
+            if held[mode] == 0:
+                del held[mode]
+            if len(held) == 0:
+                del self.__holders[me]
+            self.__cond.notify_all()
+
+    def locked(self) -> bool:
+        return len(self.__holders) > 0
+
+    def __enter__(self) -> NodeLock:
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.release()
+
+    def __grantable(self, me: int, mode: str, ticket: Optional[Tuple[int, str]]) -> bool:
+        compatible = _COMPATIBLE[mode]
+        if not all(
+            held in compatible
+            for owner, modes in self.__holders.items() if owner != me
+            for held in modes
+        ):
+            return False
+        if me in self.__holders:
+            return True
+
+        for waiter in self.__waiting:
+            if waiter is ticket:
+                return True
+            if waiter[1] not in compatible:
+                return False
+        return True
+
+    def __dequeue(self, ticket: Tuple[int, str]) -> None:
+        # Identity, two waits of the same thread and mode are equal tuples
+        for i, waiter in enumerate(self.__waiting):
+            if waiter is ticket:
+                del self.__waiting[i]
+                break
+        # Acquisitions queued behind it may be grantable now
+        self.__cond.notify_all()
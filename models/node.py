@@ -1,20 +1,166 @@
 from __future__ import annotations
 
+from contextlib import contextmanager
 from threading import Lock
+from typing import Iterator, List, Tuple, Optional, TYPE_CHECKING
+
+from models.lock import NodeLock, IS, IX, S, X
+from models.quota import Usage
+from models.stub import Stub
+from models.auth import ROOT
+# Imported as a module, services.authservice itself imports the models
+from services import authservice
+
+if TYPE_CHECKING:
+    from models.system import FileSystem
+
+# Guards the running totals of folders, updates from different subtrees
+# meet at their common ancestors
+_totals_lock = Lock()
 
 
 class Node:
     name: str
     parent: Node
-    lock: Lock = Lock()
+    lock: NodeLock
+    ino: Optional[int] = None
+    owner: str = ROOT.name
+    # Bumped on every change, lets clients tell whether their copy is stale.
+    # Folders are also bumped by every change below them, their stubs and
+    # listings carry the totals and versions of their children
+    version: int = 0
 
     def __init__(self, name: str, parent: Node) -> None:
         super().__init__()
         self.name = name
         self.parent = parent
+        self.lock = NodeLock()
+        self.owner = authservice.AuthService.current().name
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop('lock', None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = NodeLock()
 
     def path(self) -> str:
         if self.parent is None:
             return '/'
 
         return self.parent.path() + self.name + '/'
+
+    def usage(self) -> Tuple[int, int, int]:
+        """Bytes, files and folders this node adds to the totals of its parent"""
+        return 0, 0, 0
+
+    def cost(self) -> Tuple[int, int]:
+        """Bytes and inodes this node itself is charged to its owner"""
+        return 0, 1
+
+    def stub(self, children: bool = True) -> Stub:
+        raise NotImplementedError()
+
+    def snapshot(self, parent: Optional[Node] = None) -> Node:
+        """A detached copy of the subtree to pickle while the tree goes on changing
+
+        The caller holds a shared lock covering the subtree, the copy has
+        no locks and shares every value that is replaced rather than changed
+        """
+        copy = self.__class__.__new__(self.__class__)
+        copy.__dict__.update(self.__getstate__())
+        copy.parent = parent
+        return copy
+
+    def walk(self) -> Iterator[Node]:
+        yield self
+
+    def _propagate(self, size: int, files: int, folders: int, owner: Optional[str] = None,
+                   check: bool = True) -> None:
+        """Add the deltas to the totals of every folder above this node
+
+        Growth is checked against the quotas of those folders and, when an
+        owner is charged, against the owner's quota before anything changes
+        """
+        with _totals_lock:
+            chain = self.ancestors()
+            table = chain[0].quotas if len(chain) > 0 else None
+            if check and (size > 0 or files + folders > 0):
+                for node in chain:
+                    if node.quota is not None:
+                        used = Usage(node.total_size, node.total_files + node.total_folders)
+                        node.quota.check(used, size, files + folders, node.path())
+                if owner is not None and table is not None:
+                    table.check(owner, size, files + folders)
+
+            for node in chain:
+                node.total_size += size
+                node.total_files += files
+                node.total_folders += folders
+                node.version += 1
+            if owner is not None and table is not None:
+                table.charge(owner, size, files + folders)
+
+    def _charge(self, sign: int = 1) -> None:
+        """Add (or with -1 remove) the usage of every node in this subtree to their owners"""
+        chain = self.ancestors()
+        table = chain[0].quotas if len(chain) > 0 else None
+        if table is None:
+            return
+
+        with _totals_lock:
+            for node in self.walk():
+                size, inodes = node.cost()
+                table.charge(node.owner, sign * size, sign * inodes)
+
+    def _system(self) -> Optional[FileSystem]:
+        """The file system journaling the changes of this tree, None if there is none"""
+        chain = self.ancestors()
+        return getattr(chain[0] if len(chain) > 0 else self, 'system', None)
+
+    def ancestors(self) -> List[Node]:
+        """The chain of parents, starting from the root"""
+        chain = []
+        node = self.parent
+        while node is not None:
+            chain.append(node)
+            node = node.parent
+        chain.reverse()
+        return chain
+
+    def reading(self):
+        return self._locking(S)
+
+    def writing(self):
+        return self._locking(X)
+
+    @contextmanager
+    def _locking(self, mode: str) -> Iterator[None]:
+        # Intent locks are taken from the root downwards, so a shared or
+        # exclusive lock on a folder covers its whole subtree
+        intent = IS if mode == S else IX
+        while True:
+            held: List[Tuple[Node, str]] = []
+            chain = self.ancestors()
+            for node in chain:
+                node.lock.acquire(intent)
+                held.append((node, intent))
+            self.lock.acquire(mode)
+            held.append((self, mode))
+
+            # The node may have been moved while waiting, retry on the new chain
+            if self.ancestors() == chain:
+                break
+            _release(held)
+
+        try:
+            yield
+        finally:
+            _release(held)
+
+
+def _release(held: List[Tuple[Node, str]]) -> None:
+    for node, mode in reversed(held):
+        node.lock.release(mode)
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Optional, Dict
+
+
+class QuotaExceeded(IOError):
+    pass
+
+
+@dataclass
+class Usage:
+    size: int = 0
+    inodes: int = 0
+
+
+@dataclass
+class Quota:
+    size: Optional[int] = None
+    inodes: Optional[int] = None
+
+    def check(self, usage: Usage, size: int, inodes: int, owner: str) -> None:
+        """Raise if growing the usage by the deltas goes over the limits"""
+        if size > 0 and self.size is not None and usage.size + size > self.size:
+            raise QuotaExceeded(f'Quota exceeded for {owner}: {usage.size + size} > {self.size} bytes')
+        if inodes > 0 and self.inodes is not None and usage.inodes + inodes > self.inodes:
+            raise QuotaExceeded(f'Quota exceeded for {owner}: {usage.inodes + inodes} > {self.inodes} inodes')
+
+
+@dataclass
+class QuotaTable:
+    """Per user limits and the usage charged to each user"""
+    quotas: Dict[str, Quota] = field(default_factory=dict)
+    usage: Dict[str, Usage] = field(default_factory=dict)
+
+    def check(self, user: str, size: int, inodes: int) -> None:
+        quota = self.quotas.get(user)
+        if quota is not None:
+            quota.check(self.usage.get(user, Usage()), size, inodes, user)
+
+    def charge(self, user: str, size: int, inodes: int) -> None:
+        usage = self.usage.setdefault(user, Usage())
+        usage.size += size
+        usage.inodes += inodes
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import random
+from typing import Optional, Tuple, Union, Iterator
+
+Text = Union[str, bytes]
+
+
+class _Piece:
+    """A node of the treap, referencing a range of an immutable buffer
+
+    The tree is ordered by position (implicit key) and balanced by priority,
+    so splitting a piece never copies the underlying buffer
+    """
+    __slots__ = ('buf', 'start', 'length', 'size', 'priority', 'left', 'right')
+
+    buf: Text
+    start: int
+    length: int
+    size: int
+    priority: float
+    left: Optional[_Piece]
+    right: Optional[_Piece]
+
+    def __init__(self, buf: Text, start: int, length: int, priority: Optional[float] = None) -> None:
+        self.buf = buf
+        self.start = start
+        self.length = length
+        self.size = length
+        self.priority = random.random() if priority is None else priority
+        self.left = None
+        self.right = None
+
+
+def _size(node: Optional[_Piece]) -> int:
+    return node.size if node is not None else 0
+
+
+def _update(node: _Piece) -> _Piece:
+    node.size = _size(node.left) + node.length + _size(node.right)
+    return node
+
+
+def _split(node: Optional[_Piece], k: int) -> Tuple[Optional[_Piece], Optional[_Piece]]:
+    if node is None:
+        return None, None
+
+    left_size = _size(node.left)
+    if k <= left_size:
+        left, node.left = _split(node.left, k)
+        return left, _update(node)
+
+    if k >= left_size + node.length:
+        node.right, right = _split(node.right, k - left_size - node.length)
+        return _update(node), right
+
+    # The split point falls inside this piece, the right half keeps the
+    # priority so it is still a valid root for the old right subtree
+    offset = k - left_size
+    rest = _Piece(node.buf, node.start + offset, node.length - offset, node.priority)
+    rest.right, node.right = node.right, None
+    node.length = offset
+    return _update(node), _update(rest)
+
+
+def _merge(left: Optional[_Piece], right: Optional[_Piece]) -> Optional[_Piece]:
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return _update(left)
+
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+
+def _pieces(node: Optional[_Piece], start: int, end: int) -> Iterator[Tuple[Text, int, int]]:
+    """Yield (buffer, start, end) ranges covering [start, end) in order"""
+    if node is None or start >= end or start >= node.size or end <= 0:
+        return
+
+    left_size = _size(node.left)
+    yield from _pieces(node.left, start, end)
+
+    lo, hi = max(start - left_size, 0), min(end - left_size, node.length)
+    if lo < hi:
+        yield node.buf, node.start + lo, node.start + hi
+
+    yield from _pieces(node.right, start - left_size - node.length, end - left_size - node.length)
+
+
+class Rope:
+    empty: Text
+    __root: Optional[_Piece]
+
+    def __init__(self, contents: Text = "") -> None:
+        self.empty = contents[:0]
+        self.__root = self.__leaf(contents)
+
+    def __len__(self) -> int:
+        return _size(self.__root)
+
+    def __getstate__(self) -> Tuple[Text]:
+        return self.slice(0, len(self)),
+
+    def __setstate__(self, state: Tuple[Text]) -> None:
+        self.empty = state[0][:0]
+        self.__root = self.__leaf(state[0])
+
+    def snapshot(self) -> Rope:
+        """A copy sharing the buffers, only the pieces referencing them are copied"""
+        copy = Rope(self.empty)
+        for buf, lo, hi in _pieces(self.__root, 0, len(self)):
+            copy.__root = _merge(copy.__root, _Piece(buf, lo, hi - lo))
+        return copy
+
+    def slice(self, start: int, end: int) -> Text:
+        return self.empty.join(buf[lo:hi] for buf, lo, hi in _pieces(self.__root, start, end))
+
+    def insert(self, offset: int, contents: Text) -> None:
+        self.replace(offset, offset, contents)
+
+    def replace(self, start: int, end: int, contents: Text) -> None:
+        self.__splice(start, end, self.__leaf(contents))
+
+    def copy(self, start: int, end: int, target: int) -> None:
+        """Overwrite the range at target with [start, end) by sharing the buffers"""
+        tree: Optional[_Piece] = None
+        size = 0
+        for buf, lo, hi in list(_pieces(self.__root, start, end)):
+            tree = _merge(tree, _Piece(buf, lo, hi - lo))
+            size += hi - lo
+
+        self.__splice(target, target + size, tree)
+
+    def truncate(self, end: int) -> None:
+        self.__root, _ = _split(self.__root, end)
+
+    def __splice(self, start: int, end: int, tree: Optional[_Piece]) -> None:
+        left, rest = _split(self.__root, start)
+        _, right = _split(rest, end - start)
+        self.__root = _merge(_merge(left, tree), right)
+
+    @staticmethod
+    def __leaf(contents: Text) -> Optional[_Piece]:
+        return _Piece(contents, 0, len(contents)) if len(contents) > 0 else None
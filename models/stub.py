@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+FILE = 'file'
+FOLDER = 'folder'
+
+
+@dataclass(frozen=True)
+class Stub:
+    """Metadata of a node, sent instead of the node and everything it references
+
+    Folders list their children as stubs without grandchildren, the
+    contents of files are never included
+    """
+    name: str
+    kind: str
+    path: str
+    parent: Optional[str]
+    ino: Optional[int]
+    version: int
+    size: int
+    binary: bool = False
+    files: int = 0
+    folders: int = 0
+    children: Optional[Tuple[Stub, ...]] = None
+
+
+@dataclass(frozen=True)
+class Listing:
+    """One page of the entries of a folder, sorted by name
+
+    The cursor is the last name on the page, None on the last page, and
+    the version changes whenever an entry is added, removed or changed.
+    Versions of a folder that was deleted and created again start over,
+    only the inode tells the two apart
+    """
+    path: str
+    version: int
+    entries: Tuple[Stub, ...]
+    cursor: Optional[str] = None
+    ino: Optional[int] = None
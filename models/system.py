@@ -1,43 +1,129 @@
 from __future__ import annotations
 
+import atexit
 import io
 import logging
+import os
 import pickle
-from threading import Lock
-from typing import Optional
+from threading import Lock, local
+from time import monotonic
+from contextlib import nullcontext, contextmanager
+from typing import Optional, Any, Union, List, Dict, Tuple, Iterator, Callable, Sequence
 
 from exttypes import asserttype, notnone
 from models import Node, File
-from models.folder import Folder
+from models.auth import Authentication, ROOT
+from models.dcache import PathCache
+from models.delta import Splice
+from models.durability import Durability, Checkpointer, IMMEDIATE, GROUP
+from models.folder import Folder, READDIR_LIMIT
+from models.journal import Journal, journal_path
+from models.lock import NodeLock
 from models.memory import Memory
+from models.quota import Quota, QuotaTable, Usage
 from models.runmem import RuntimeMemory
+from models.stub import Stub, Listing
+# Imported as a module, services.authservice itself imports the models
+from services import authservice
 from services.memservice import MemoryService
 
 log = logging.getLogger('FileSystem')
 
+FS_PATH = 'fs.dat'
+# Size of the journal in bytes after which it is folded into a checkpoint
+CHECKPOINT_SIZE = 16 * 1024 * 1024
+# Number of resolved folder paths kept by the path cache
+DCACHE_SIZE = 4096
+
 
 class FileSystem:
     root: Folder
     current: Folder
-    lock: Lock = Lock()
+    seq: int = 0
+    next_ino: int = 1
+    path: str = FS_PATH
+    journal: Optional[Journal] = None
+    durability: Durability = Durability.immediate()
+    checkpointer: Optional[Checkpointer] = None
+    dcache: PathCache
+    inodes: Dict[int, Node]
+    watchers: List[Callable[[str], None]]
+    # Called with the seconds every save took
+    on_save: Optional[Callable[[float], None]] = None
 
     @staticmethod
-    def load(memory: RuntimeMemory = RuntimeMemory()) -> FileSystem:
+    def load(
+            memory: RuntimeMemory = RuntimeMemory(),
+            path: str = FS_PATH,
+            durability: Durability = Durability.immediate(),
+            cache_size: int = DCACHE_SIZE
+    ) -> FileSystem:
         fs: FileSystem
+        found = True
         try:
-            with open('fs.dat', 'rb') as f:
+            with open(path, 'rb') as f:
                 fs = pickle.load(f)
         except IOError:
-            print('WARN: fs.dat not found')
+            print(f'WARN: {path} not found')
             fs = FileSystem(Folder('root', None))
+            found = False
+
+        fs.path = path
+        fs.dcache = PathCache(cache_size)
+        fs.index()
+        fs.journal = Journal(journal_path(path))
+        replayed = fs.replay()
+        if not found or replayed > 0:
             fs.save()
 
+        fs.durability = durability
+        fs.checkpointer = Checkpointer(fs, durability)
+        fs.checkpointer.start()
+        atexit.register(fs.close)
+
         MemoryService.init(memory)
         return fs
 
     def __init__(self, root: Folder) -> None:
         self.root = root
         self.current = root
+        self.dcache = PathCache(DCACHE_SIZE)
+        self.inodes = {}
+        self.__seq_lock = Lock()
+        self.__save_lock = Lock()
+        self.__ino_lock = Lock()
+        self.__batch = local()
+        self.watchers = []
+        if root.quotas is None:
+            root.quotas = QuotaTable()
+        root.system = self
+        self.register(root)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        for key in (
+                'journal', 'durability', 'checkpointer', 'dcache', 'inodes', 'watchers', 'on_save',
+                '_FileSystem__seq_lock', '_FileSystem__save_lock', '_FileSystem__ino_lock',
+                '_FileSystem__batch'
+        ):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.dcache = PathCache(DCACHE_SIZE)
+        self.inodes = {}
+        self.__seq_lock = Lock()
+        self.__save_lock = Lock()
+        self.__ino_lock = Lock()
+        self.__batch = local()
+        self.watchers = []
+        self.root.system = self
+
+    @property
+    def lock(self) -> NodeLock:
+        """Lock of the root folder, acquiring it exclusively blocks the whole tree"""
+        return self.root.lock
 
     def change_directory(self, path: str) -> Folder:
         log.debug(f'change_directory: path = {path}')
@@ -47,32 +133,439 @@ class FileSystem:
     def create_directory(self, path: str) -> None:
         log.debug(f'create_directory: path = {path}')
         name = path.rsplit('/', maxsplit=1)[-1]
-        parent = self._get_parent(path)
-        parent.nodes[name] = Folder(name, parent)
-        self.save()
+        self._commit('create_directory', self._get_parent(path).path() + name, self._allocate())
 
     def move(self, src: str, dest: str) -> None:
         log.debug(f'move_directory: src = {src} => dest = {dest}')
-        _src, _dest = self._get_node(src), self.get_folder(dest)
-        asserttype(Folder, _src.parent).nodes.pop(_src.name)
-        _src.parent = _dest
-        _dest.nodes[_src.name] = _src
-        self.save()
+        self._commit('move', self._get_node(src).path(), self.get_folder(dest).path())
 
     def delete(self, path: str) -> None:
-        node = self._get_node(path)
         try:
-            if isinstance(node, File) or (isinstance(node, Folder) and len(node.nodes) == 0):
-                asserttype(Folder, node.parent).nodes.pop(node.name)
-            else:
-                raise IOError('Not empty')
+            self._commit('delete', self._get_node(path).path())
         except KeyError:
             raise IOError('Not found')
-        self.save()
+
+    def create_file(self, path: str, name: str, binary: bool = False) -> None:
+        log.debug(f'create_file: path = {path}, name = {name}')
+        self._commit('create_file', self.get_folder(path).path(), name, binary, self._allocate())
+
+    def delete_file(self, path: str, name: str) -> None:
+        log.debug(f'delete_file: path = {path}, name = {name}')
+        self._commit('delete_file', self.get_folder(path).path(), name)
+
+    def write_contents(self, path: str, name: str, contents: Union[str, bytes], start: int = 0) -> None:
+        if not isinstance(contents, str):
+            contents = bytes(contents)
+        folder = self.get_folder(path)
+        # Writing to a missing file creates it, which needs an inode
+        ino = self._allocate() if name not in folder.nodes else None
+        self._commit('write_contents', folder.path(), name, contents, start, ino)
+
+    def move_contents(self, path: str, name: str, start: int, end: int, target: int) -> None:
+        self._commit('move_contents', self.get_folder(path).path(), name, start, end, target)
+
+    def truncate_contents(self, path: str, name: str, end: int) -> None:
+        self._commit('truncate_contents', self.get_folder(path).path(), name, end)
+
+    def lookup(self, path: str) -> int:
+        """Resolve the path once, the returned inode number stays valid across renames"""
+        node = self.root if len(self._normalize(path)) == 0 else self._get_node(path)
+        return self.register(node)
+
+    def stat(self, path: str) -> Stub:
+        """Metadata of the node at the path, folders include their children"""
+        node = self.root if len(self._normalize(path)) == 0 else self._get_node(path)
+        self.register(node)
+        return node.stub()
+
+    def readdir(
+            self, path: str, cursor: Optional[str] = None, limit: int = READDIR_LIMIT, version: Optional[int] = None,
+            ino: Optional[int] = None
+    ) -> Optional[Listing]:
+        """One page of the folder at the path, see Folder.readdir"""
+        return self.get_folder(path).readdir(cursor, limit, version, ino)
+
+    def inode(self, ino: int) -> Node:
+        try:
+            return self.inodes[ino]
+        except KeyError:
+            raise IOError(f'Stale inode {ino}')
+
+    def read_inode(self, ino: int, start: int = 0, end: int = -1) -> Union[str, bytes, memoryview]:
+        return asserttype(File, self.inode(ino)).read(start, end)
+
+    def write_inode(self, ino: int, contents: Union[str, bytes], start: int = 0) -> None:
+        if not isinstance(contents, str):
+            contents = bytes(contents)
+        self._commit('write_inode', ino, contents, start)
+
+    def patch_inode(self, ino: int, splices: Sequence[Splice], version: Optional[int] = None) -> int:
+        """Apply the splices atomically if the file is still at the version, see File.patch"""
+        # Journal records are pickled, which buffers like memoryview don't support
+        splices = [(start, end, c if isinstance(c, str) else bytes(c)) for start, end, c in splices]
+        return self._commit('patch_inode', ino, splices, version)
+
+    def patch_contents(self, path: str, name: str, splices: Sequence[Splice], version: Optional[int] = None) -> int:
+        return self.patch_inode(self.register(self.get_folder(path).get_file(name)), splices, version)
+
+    def patch_file(self, file: File, splices: Sequence[Splice], version: Optional[int] = None) -> int:
+        return self.patch_inode(self.register(file), splices, version)
+
+    def move_inode(self, ino: int, start: int, end: int, target: int) -> None:
+        self._commit('move_inode', ino, start, end, target)
+
+    def truncate_inode(self, ino: int, end: int) -> None:
+        self._commit('truncate_inode', ino, end)
+
+    def set_quota(
+            self, size: Optional[int] = None, inodes: Optional[int] = None,
+            path: Optional[str] = None, user: Optional[str] = None
+    ) -> None:
+        """Limit the bytes and inodes below a folder or owned by a user, None lifts a limit
+
+        Only root may change quotas, users would otherwise lift their own
+        """
+        if authservice.AuthService.current().name != ROOT.name:
+            raise PermissionError('Only root may set quotas')
+        if (path is None) == (user is None):
+            raise IOError('Quota needs either a path or a user')
+        self._commit('set_quota', self.get_folder(path).path() if path is not None else None, user, size, inodes)
+
+    def quota(self, path: Optional[str] = None, user: Optional[str] = None) -> Tuple[Optional[Quota], Usage]:
+        """The limits and the current usage of a folder or a user"""
+        if user is not None:
+            table = notnone(self.root.quotas)
+            return table.quotas.get(user), table.usage.get(user, Usage())
+
+        folder = self.get_folder(path or '')
+        return folder.quota, Usage(folder.total_size, folder.total_files + folder.total_folders)
+
+    def register(self, node: Node) -> int:
+        if node.ino is None:
+            node.ino = self._allocate()
+        self.inodes[node.ino] = node
+        return node.ino
+
+    def usage(self, path: str) -> Tuple[int, int, int]:
+        """Bytes, files and folders stored at or below the path"""
+        node = self.root if len(self._normalize(path)) == 0 else self._get_node(path)
+        if isinstance(node, Folder):
+            return node.total_size, node.total_files, node.total_folders
+        return node.usage()
+
+    def index(self) -> None:
+        """Rebuild the inode table, the folder totals and the usage of every user
+
+        Nodes from images that predate inodes get numbered here
+        """
+        self.root.recount()
+        if self.root.quotas is None:
+            self.root.quotas = QuotaTable()
+        table = self.root.quotas
+        table.usage = {}
+        for node in self.root.walk():
+            if node is not self.root:
+                table.charge(node.owner, *node.cost())
+
+        self.inodes = {}
+        stack: List[Node] = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.ino is not None:
+                self.next_ino = max(self.next_ino, node.ino + 1)
+            if isinstance(node, Folder):
+                stack.extend(node.nodes.values())
+
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            self.register(node)
+            if isinstance(node, Folder):
+                stack.extend(node.nodes.values())
 
     def save(self):
-        with open('fs.dat', 'wb') as f:
-            pickle.dump(self, f, 3)
+        with self.__save_lock:
+            began = monotonic()
+            # Writers only wait for a detached copy of the tree, which shares the
+            # contents instead of copying them. Pickling and writing the image
+            # out happen while other threads keep committing to the journal
+            with self.root.reading():
+                snapshot = self.snapshot()
+                journal = self.journal
+                if journal is not None:
+                    journal.sync()
+                offset = journal.size if journal is not None else None
+
+            image = pickle.dumps(snapshot, 3)
+
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(image)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+            if journal is not None:
+                journal.discard(notnone(offset))
+
+            on_save = self.on_save
+            if on_save is not None:
+                on_save(monotonic() - began)
+
+    def snapshot(self) -> FileSystem:
+        """A copy of the file system to pickle, taken under a shared lock of the root, see Node.snapshot"""
+        snapshot = FileSystem.__new__(FileSystem)
+        snapshot.__dict__.update(self.__getstate__())
+        snapshot.root = asserttype(Folder, self.root.snapshot())
+        current = snapshot.root
+        for name in self._normalize(self.current.path()):
+            node = current.nodes.get(name)
+            if not isinstance(node, Folder):
+                # The current folder was deleted, the image starts at the root
+                current = snapshot.root
+                break
+            current = node
+        snapshot.current = current
+        return snapshot
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Run several operations under one exclusive lock of the tree
+
+        Operations inside still reach the journal one by one, but it is
+        synced (or the image saved) once when the outermost batch ends
+        """
+        with self.root.writing():
+            self.__batch.depth = getattr(self.__batch, 'depth', 0) + 1
+            try:
+                yield
+            finally:
+                self.__batch.depth -= 1
+
+        if self.__batch.depth == 0:
+            self._persist()
+
+    def sync(self) -> None:
+        if self.journal is not None:
+            self.journal.sync()
+
+    def close(self) -> None:
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpointer = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def should_checkpoint(self) -> bool:
+        return self.journal is not None and self.journal.size > CHECKPOINT_SIZE
+
+    def replay(self) -> int:
+        """Apply the journaled records newer than the image
+
+        A record that no longer applies, e.g. one naming an inode that is
+        gone, is logged and skipped rather than stopping the load
+
+        :return: The number of records read, applied or skipped
+        """
+        count = 0
+        for seq, op, args, user in notnone(self.journal).records():
+            if seq <= self.seq:
+                continue
+
+            log.debug(f'replay: seq = {seq}, op = {op}')
+            # Nodes created by the record are owned by the user that issued it
+            with authservice.AuthService.impersonate(Authentication(user)) if user is not None else nullcontext():
+                try:
+                    self._apply(op, *args)
+                except (IOError, KeyError, AssertionError) as e:
+                    log.warning(f'replay: skipped seq = {seq}, op = {op}: {e}')
+            self.seq = seq
+            count += 1
+
+        return count
+
+    def watch(self, watcher: Callable[[str], None]) -> None:
+        """Call the watcher with the path of the node each committed operation changed"""
+        self.watchers.append(watcher)
+
+    def unwatch(self, watcher: Callable[[str], None]) -> None:
+        self.watchers.remove(watcher)
+
+    def _commit(self, op: str, *args: Any) -> Any:
+        # The record is appended while the target is still locked, so
+        # conflicting operations reach the journal in the order they applied
+        target = self._target(op, *args)
+        with target.writing():
+            result = self._apply(op, *args)
+            changed = target.path()
+            journal = self.journal
+            if journal is not None:
+                with self.__seq_lock:
+                    self.seq += 1
+                    journal.append(self.seq, op, args, authservice.AuthService.current().name)
+
+        for watcher in list(self.watchers):
+            watcher(changed)
+        if getattr(self.__batch, 'depth', 0) == 0:
+            self._persist()
+        return result
+
+    def _persist(self) -> None:
+        """Make the committed operations durable as the policy asks"""
+        journal = self.journal
+        if journal is None:
+            self.save()
+            return
+
+        if self.durability.mode == IMMEDIATE:
+            journal.sync()
+        elif self.durability.mode == GROUP and journal.pending >= notnone(self.durability.ops):
+            notnone(self.checkpointer).notify()
+
+        if self.should_checkpoint():
+            if self.checkpointer is not None:
+                self.checkpointer.notify()
+            else:
+                self.save()
+
+    def _apply(self, op: str, *args: Any) -> Any:
+        return getattr(self, f'_apply_{op}')(*args)
+
+    def _allocate(self) -> int:
+        with self.__ino_lock:
+            ino = self.next_ino
+            self.next_ino += 1
+            return ino
+
+    def _adopt(self, node: Node, ino: Optional[int]) -> None:
+        """Register a node created by an operation under the inode recorded for it"""
+        if ino is not None:
+            node.ino = ino
+            with self.__ino_lock:
+                self.next_ino = max(self.next_ino, ino + 1)
+        self.register(node)
+
+    def _unregister(self, node: Optional[Node]) -> None:
+        stack = [node] if node is not None else []
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.ino is not None:
+                self.inodes.pop(node.ino, None)
+            if isinstance(node, Folder):
+                stack.extend(node.nodes.values())
+
+    def _target(self, op: str, *args: Any) -> Node:
+        """The node that has to be locked exclusively to apply the operation"""
+        if op in ('create_directory', 'delete'):
+            return self._get_parent(args[0])
+        if op == 'set_quota':
+            # User quotas are read by every write, so they change with the tree stopped
+            return self.root if args[0] is None else self.get_folder(args[0])
+        if op == 'move':
+            return _common_ancestor(notnone(self._get_node(args[0]).parent), self.get_folder(args[1]))
+        if op.endswith('_inode'):
+            return self.inode(args[0])
+
+        folder = self.get_folder(args[0])
+        if op in ('create_file', 'delete_file') or args[1] not in folder.nodes:
+            return folder
+        return folder.nodes[args[1]]
+
+    def _apply_create_directory(self, path: str, ino: Optional[int] = None) -> None:
+        name = path.rsplit('/', maxsplit=1)[-1]
+        parent = self._get_parent(path)
+        self.dcache.invalidate(parent.path() + name + '/')
+        replaced = parent.nodes.get(name)
+        parent.attach(Folder(name, parent))
+        self._unregister(replaced)
+        self._adopt(parent.nodes[name], ino)
+
+    def _apply_move(self, src: str, dest: str) -> None:
+        _src, _dest = self._get_node(src), self.get_folder(dest)
+        if _src is _dest or _src in _dest.ancestors():
+            raise IOError('Cannot move a folder into itself')
+
+        self.dcache.invalidate(_src.path())
+        self.dcache.invalidate(_dest.path() + _src.name + '/')
+        replaced = _dest.nodes.get(_src.name)
+        parent = asserttype(Folder, _src.parent)
+        node = parent.detach(_src.name, charge=False)
+        try:
+            _dest.attach(node, charge=False)
+        except IOError:
+            parent.attach(node, charge=False)
+            raise
+        self._unregister(replaced)
+
+    def _apply_delete(self, path: str) -> None:
+        node = self._get_node(path)
+        if isinstance(node, File) or (isinstance(node, Folder) and len(node.nodes) == 0):
+            self.dcache.invalidate(node.path())
+            asserttype(Folder, node.parent).detach(node.name)
+            self._unregister(node)
+        else:
+            raise IOError('Not empty')
+
+    def _apply_create_file(self, path: str, name: str, binary: bool = False, ino: Optional[int] = None) -> None:
+        folder = self.get_folder(path)
+        self.dcache.invalidate(folder.path() + name + '/')
+        replaced = folder.nodes.get(name)
+        folder.create_file(name, binary)
+        self._unregister(replaced)
+        self._adopt(folder.nodes[name], ino)
+
+    def _apply_delete_file(self, path: str, name: str) -> None:
+        folder = self.get_folder(path)
+        self.dcache.invalidate(folder.path() + name + '/')
+        self._unregister(folder.nodes.get(name))
+        folder.delete_file(name)
+
+    def _apply_write_contents(
+            self, path: str, name: str, contents: Union[str, bytes], start: int, ino: Optional[int] = None
+    ) -> None:
+        folder = self.get_folder(path)
+        if name in folder.nodes:
+            folder.get_file(name).write(contents, start)
+            return
+
+        folder.create_file(name)
+        try:
+            folder.get_file(name).write(contents, start)
+        except IOError:
+            # Nothing reaches the journal for a failed write, so neither may the file
+            folder.detach(name)
+            raise
+        self._adopt(folder.nodes[name], ino)
+
+    def _apply_set_quota(
+            self, path: Optional[str], user: Optional[str], size: Optional[int], inodes: Optional[int]
+    ) -> None:
+        quota = Quota(size, inodes) if size is not None or inodes is not None else None
+        if path is not None:
+            self.get_folder(path).quota = quota
+        elif quota is not None:
+            notnone(self.root.quotas).quotas[notnone(user)] = quota
+        else:
+            notnone(self.root.quotas).quotas.pop(notnone(user), None)
+
+    def _apply_write_inode(self, ino: int, contents: Union[str, bytes], start: int) -> None:
+        asserttype(File, self.inode(ino)).write(contents, start)
+
+    def _apply_patch_inode(self, ino: int, splices: Sequence[Splice], version: Optional[int]) -> int:
+        return asserttype(File, self.inode(ino)).patch(splices, version)
+
+    def _apply_move_inode(self, ino: int, start: int, end: int, target: int) -> None:
+        asserttype(File, self.inode(ino)).move(start, end, target)
+
+    def _apply_truncate_inode(self, ino: int, end: int) -> None:
+        asserttype(File, self.inode(ino)).truncate(end)
+
+    def _apply_move_contents(self, path: str, name: str, start: int, end: int, target: int) -> None:
+        self.get_folder(path).get_file(name).move(start, end, target)
+
+    def _apply_truncate_contents(self, path: str, name: str, end: int) -> None:
+        self.get_folder(path).get_file(name).truncate(end)
 
     def _get_node(self, path: str) -> Node:
         return self._get_parent(path).nodes[
@@ -80,31 +573,39 @@ class FileSystem:
         ]
 
     def get_folder(self, path) -> Folder:
-        def resolve_folder() -> Folder:
-            return self.current if folder is None else folder
-
-        folder: Optional[Folder] = None
         if len(path) == 0:
-            log.debug(f'_get_folder: path = {path}, returning self.root')
             return self.root
 
-        if path.startswith('/'):
-            folder = self.root
-            path = path[1:]
+        parts = self._normalize(path)
+        key = ''.join(f'/{p}' for p in parts) + '/'
+        cached = self.dcache.get(key)
+        if cached is not None:
+            return cached
 
-        log.debug(f'_get_folder: path = {path}, resolved = {resolve_folder().path()}')
-        for node in [i for i in path.split('/') if i != '']:
+        generation = self.dcache.generation
+        log.debug(f'_get_folder: path = {path}, resolved = {key}')
+        folder = self.root
+        for node in parts:
             try:
-                if node == '..':
-                    folder = asserttype(Folder, resolve_folder().parent)
-                elif node in resolve_folder().nodes:
-                    folder = asserttype(Folder, resolve_folder().nodes[node])
-                else:
-                    raise IOError(f"{path} Not found")
+                folder = asserttype(Folder, folder.nodes[node])
+            except KeyError:
+                raise IOError(f"{path} Not found")
             except AssertionError:
                 raise IOError(f"Is File")
 
-        return notnone(folder)
+        self.dcache.put(key, folder, generation)
+        return folder
+
+    def _normalize(self, path: str) -> List[str]:
+        parts = [] if path.startswith('/') else [p for p in self.current.path().split('/') if p != '']
+        for node in path.split('/'):
+            if node == '..':
+                if len(parts) == 0:
+                    raise IOError(f"Is File")
+                parts.pop()
+            elif node != '':
+                parts.append(node)
+        return parts
 
     def _get_parent(self, path: str) -> Folder:
         parent = self.root if path.startswith('/') else self.current
@@ -126,4 +627,15 @@ class FileSystem:
         return parent
 
     def memory_map(self) -> Memory:
-        return Memory(io.BytesIO(pickle.dumps(self, 3)))
+        # Pickled from a snapshot like save, the live tree changes while it is walked
+        with self.root.reading():
+            snapshot = self.snapshot()
+        return Memory(io.BytesIO(pickle.dumps(snapshot, 3)))
+
+
+def _common_ancestor(a: Node, b: Node) -> Node:
+    chain = set(map(id, a.ancestors() + [a]))
+    for node in reversed(b.ancestors() + [b]):
+        if id(node) in chain:
+            return node
+    raise IOError('Nodes are not in the same tree')
@@ -0,0 +1,57 @@
+from threading import Lock
+from typing import Dict, List
+
+# Smallest and largest pooled buffer, larger requests get a buffer of their own
+MIN_SIZE = 4 * 1024
+MAX_SIZE = 64 * 1024 * 1024
+# Free buffers kept per size class
+DEPTH = 8
+
+
+class BufferPool:
+    """Reusable receive buffers grouped in power of two size classes
+
+    A buffer is at least as large as requested, callers work on a
+    memoryview of the length they need and give the buffer back once
+    nothing refers to it anymore
+    """
+    min_size: int
+    max_size: int
+    depth: int
+    __free: Dict[int, List[bytearray]]
+    __lock: Lock
+
+    def __init__(self, min_size: int = MIN_SIZE, max_size: int = MAX_SIZE, depth: int = DEPTH) -> None:
+        self.min_size = min_size
+        self.max_size = max_size
+        self.depth = depth
+        self.__free = {}
+        self.__lock = Lock()
+
+    def acquire(self, size: int) -> bytearray:
+        capacity = self.__class_of(size)
+        if capacity > self.max_size:
+            return bytearray(size)
+
+        with self.__lock:
+            free = self.__free.get(capacity)
+            if free:
+                return free.pop()
+        return bytearray(capacity)
+
+    def release(self, buffer: bytearray) -> None:
+        capacity = len(buffer)
+        # Only buffers handed out by acquire have the size of their class
+        if capacity > self.max_size or capacity != self.__class_of(capacity):
+            return
+
+        with self.__lock:
+            free = self.__free.setdefault(capacity, [])
+            if len(free) < self.depth:
+                free.append(buffer)
+
+    def __class_of(self, size: int) -> int:
+        return max(self.min_size, 1 << max(size - 1, 0).bit_length())
+
+
+default_pool = BufferPool()
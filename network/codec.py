@@ -0,0 +1,196 @@
+import struct
+from dataclasses import fields
+from io import UnsupportedOperation
+from typing import Any, List, Tuple, Dict, Type
+
+from models.delta import VersionMismatch
+from models.quota import Quota, Usage, QuotaExceeded
+from models.stub import Stub, Listing
+
+# Bumped whenever the layout of the fields changes
+VERSION = 2
+
+_NONE = 0
+_FALSE = 1
+_TRUE = 2
+_INT = 3
+_STR = 4
+_BYTES = 5
+_LIST = 6
+_TUPLE = 7
+_FLOAT = 8
+_DICT = 9
+# Exceptions in replies, sent as their type name and arguments
+_ERROR = 10
+# Metadata records in replies, sent as the tuple of their fields
+_STUB = 11
+_LISTING = 12
+_QUOTA = 13
+_USAGE = 14
+
+_TAG = struct.Struct("!B")
+_FIXED = struct.Struct("!Bq")
+_DOUBLE = struct.Struct("!Bd")
+_SIZED = struct.Struct("!BI")
+_INT_RANGE = range(-2 ** 63, 2 ** 63)
+# Deepest nesting of lists, tuples, dicts and records decoded, well past
+# anything sent, so a message can't exhaust the stack of the reader
+MAX_DEPTH = 64
+
+_RECORDS: Dict[int, Type[Any]] = {_STUB: Stub, _LISTING: Listing, _QUOTA: Quota, _USAGE: Usage}
+_RECORD_TAGS = {cls: tag for tag, cls in _RECORDS.items()}
+_NESTED = frozenset((_LIST, _TUPLE, _DICT, _ERROR, *_RECORDS))
+# Errors are rebuilt by name, anything else arrives as an OSError naming it
+_ERRORS: Dict[str, Type[BaseException]] = {
+    cls.__name__: cls for cls in (
+        OSError, FileNotFoundError, FileExistsError, IsADirectoryError, NotADirectoryError, PermissionError,
+        ConnectionError, TimeoutError, UnsupportedOperation, QuotaExceeded, VersionMismatch,
+        KeyError, ValueError, TypeError, IndexError, AssertionError, NotImplementedError
+    )
+}
+
+
+def encode(*values: Any) -> bytes:
+    """ Encode the values as typed fields behind a version byte
+
+    Strings and binary contents are stored length prefixed, so they may
+    contain any byte and binary contents are copied exactly once
+
+    :param values: The values to encode
+    :return: bytes representation of the values
+    :raises TypeError: On a value without a field type
+    """
+    return b''.join(encode_parts(*values))
+
+
+def encode_parts(*values: Any) -> List[Any]:
+    """ Encode the values like codec.encode, without joining the parts
+
+    Binary contents are referenced rather than copied, so the parts can
+    be sent with scatter-gather IO, see network.send_frame
+
+    :param values: The values to encode
+    :return: The bytes-like parts of the encoding in order
+    """
+    parts: List[Any] = [_TAG.pack(VERSION)]
+    for value in values:
+        _encode(value, parts)
+    return parts
+
+
+def decode(data: bytes) -> List[Any]:
+    """ Decode the fields written by codec.encode
+
+    Only the field types above are understood, decoding never runs code
+    named by the message, so it is safe on untrusted input
+
+    :param data: The bytes to decode
+    :return: The decoded values
+    :raises IOError: On an unknown version or malformed data
+    """
+    view = memoryview(data)
+    if len(view) == 0 or view[0] != VERSION:
+        raise IOError(f"Unsupported protocol version: {view[0] if len(view) > 0 else None}")
+
+    values = []
+    offset = _TAG.size
+    try:
+        while offset < len(view):
+            value, offset = _decode(view, offset, 0)
+            values.append(value)
+    except (struct.error, IndexError, UnicodeDecodeError, TypeError, ValueError) as e:
+        raise IOError(f"Malformed message: {e}")
+    return values
+
+
+def _encode(value: Any, parts: List[Any]) -> None:
+    if value is None:
+        parts.append(_TAG.pack(_NONE))
+    elif value is True or value is False:
+        parts.append(_TAG.pack(_TRUE if value else _FALSE))
+    elif type(value) is int and value in _INT_RANGE:
+        parts.append(_FIXED.pack(_INT, value))
+    elif type(value) is float:
+        parts.append(_DOUBLE.pack(_FLOAT, value))
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        parts.append(_SIZED.pack(_STR, len(data)))
+        parts.append(data)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        data = memoryview(value).cast('B')
+        parts.append(_SIZED.pack(_BYTES, len(data)))
+        parts.append(data)
+    elif type(value) in (list, tuple):
+        parts.append(_SIZED.pack(_LIST if type(value) is list else _TUPLE, len(value)))
+        for item in value:
+            _encode(item, parts)
+    elif type(value) is dict:
+        parts.append(_SIZED.pack(_DICT, len(value)))
+        for key, item in value.items():
+            _encode(key, parts)
+            _encode(item, parts)
+    elif type(value) in _RECORD_TAGS:
+        # Fields are taken one level deep, children of a stub are records of their own
+        items = tuple(getattr(value, field.name) for field in fields(value))
+        parts.append(_SIZED.pack(_RECORD_TAGS[type(value)], len(items)))
+        for item in items:
+            _encode(item, parts)
+    elif isinstance(value, BaseException):
+        args = value.args
+        if not all(arg is None or type(arg) in (str, int, bool, float) for arg in args):
+            args = (str(value),)
+        name = type(value).__name__ if type(value).__name__ in _ERRORS else 'OSError'
+        if name == 'OSError' and type(value) is not OSError:
+            args = (f'{type(value).__name__}: {value}',)
+        parts.append(_SIZED.pack(_ERROR, 2))
+        _encode(name, parts)
+        _encode(args, parts)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+def _decode(view: memoryview, offset: int, depth: int) -> Tuple[Any, int]:
+    tag = view[offset]
+    if tag == _NONE:
+        return None, offset + _TAG.size
+    if tag == _FALSE or tag == _TRUE:
+        return tag == _TRUE, offset + _TAG.size
+    if tag == _INT:
+        return _FIXED.unpack_from(view, offset)[1], offset + _FIXED.size
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(view, offset)[1], offset + _DOUBLE.size
+
+    size = _SIZED.unpack_from(view, offset)[1]
+    offset += _SIZED.size
+    if tag in _NESTED and depth >= MAX_DEPTH:
+        raise IOError(f"Malformed message: nested deeper than {MAX_DEPTH}")
+    if tag in (_LIST, _TUPLE, _ERROR) or tag in _RECORDS:
+        items = []
+        for _ in range(size):
+            item, offset = _decode(view, offset, depth + 1)
+            items.append(item)
+        if tag == _LIST:
+            return items, offset
+        if tag == _TUPLE:
+            return tuple(items), offset
+        if tag == _ERROR:
+            if len(items) != 2 or type(items[0]) is not str or type(items[1]) not in (list, tuple):
+                raise IOError("Malformed message: an error is sent as its name and arguments")
+            name, args = items
+            return _ERRORS.get(name, OSError)(*args), offset
+        return _RECORDS[tag](*items), offset
+    if tag == _DICT:
+        items = {}
+        for _ in range(size):
+            key, offset = _decode(view, offset, depth + 1)
+            items[key], offset = _decode(view, offset, depth + 1)
+        return items, offset
+
+    if offset + size > len(view):
+        raise IndexError("Field exceeds the message")
+    data = view[offset:offset + size]
+    if tag == _STR:
+        return str(data, 'utf-8'), offset + size
+    if tag == _BYTES:
+        return bytes(data), offset + size
+    raise IOError(f"Unknown field type: {tag}")
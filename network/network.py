@@ -1,13 +1,24 @@
+import asyncio
 import json
 import platform
 import socket
 import struct
 import subprocess
 from time import sleep
-from typing import Optional, Sequence, Callable
+from typing import Optional, Sequence, Callable, Tuple, Any, Union
 from urllib.request import urlopen
 
 from exttypes.nullsafe import notnone
+from network import codec
+from network.bufferpool import BufferPool
+
+_FRAME = struct.Struct("I")
+# Size of the frame followed by the request id
+_HEADER = struct.Struct("II")
+# Most buffers a single sendmsg accepts on common platforms
+_IOV_MAX = 1024
+# Largest frame accepted, a larger size in a header closes the connection
+MAX_FRAME = 256 * 1024 * 1024
 
 
 def get_local_ip() -> str:
@@ -106,6 +117,9 @@ def recv_bytes(
 
     Not indented to be used directly, see network.get_request
 
+    The buffer is allocated once at the full size, callers receiving a
+    size from the peer check it first, see network.get_frame
+
     :param soc: The socket to listen from
     :param size: The size of the data to receive
     :param wait: To retry on failure or not
@@ -113,54 +127,82 @@ def recv_bytes(
     :param progress: The callback to notify on progress changes
     :return: The received data or None on OSError
     """
-    data = bytearray()
-    while len(data) < size:
-        packet: Optional[bytes] = None
+    data = bytearray(size)
+    if not recv_into(soc, memoryview(data), wait, retries, progress):
+        return None
+    return data
+
+
+def recv_into(
+        soc: socket.socket,
+        view: memoryview,
+        wait: bool = True,
+        retries: int = 3,
+        progress: Optional[Callable[[int, int, int], None]] = None
+) -> bool:
+    """ Fill the view with bytes from the socket
+
+    Packets are received straight into the view, so receiving allocates
+    nothing in proportion to the size, see network.recv_bytes
+
+    :param soc: The socket to listen from
+    :param view: The memory to fill, all of it is filled
+    :param wait: To retry on failure or not
+    :param retries: Total number of retries
+    :param progress: The callback to notify on progress changes
+    :return: False on OSError or when the connection is closed
+    """
+    size = len(view)
+    received = 0
+    while received < size:
+        count: Optional[int] = None
         try:
-            packet = soc.recv(size - len(data))
+            count = soc.recv_into(view[received:])
             if progress is not None:
-                progress(len(data), size, len(packet))
+                progress(received, size, count)
         except OSError as e:
             if wait:
                 retries -= 1
                 sleep(0.1)
             else:
                 raise e
-        if packet is None or packet == b'' or retries <= 0:
-            return None
-        data.extend(packet)
-    return data
+        if count is None or count == 0 or retries <= 0:
+            return False
+        received += count
+    return True
 
 
-def encode_parameter(*param: str) -> bytes:
-    """ Convert the given string parameters to bytes
+def encode_parameter(*param: Any) -> bytes:
+    """ Convert the given parameters to bytes, see network.codec
 
-    :param param: Given parameters
+    :param param: Given parameters, str, bytes, int, bool, None or sequences of them
     :return: bytes representation of the params
     """
-    return "::".join(param).encode("utf-8")
+    return codec.encode(*param)
 
 
-def decode_parameter(param: bytes) -> Sequence[str]:
-    """ Convert the given bytes to a sequence of string
+def decode_parameter(param: bytes) -> Sequence[Any]:
+    """ Convert the given bytes back to the sequence of parameters
 
     :param param: The bytes to decode
     :return: The output sequence
     """
-    return param.decode("utf-8").split("::")
+    return codec.decode(param)
 
 
 def get_request(soc: socket.socket,
-                progress: Optional[Callable[[int, int, int], None]] = None) -> Optional[bytes]:
+                progress: Optional[Callable[[int, int, int], None]] = None,
+                wait: bool = True) -> Optional[bytearray]:
     """ Provides higher level call to recv_bytes with auto size management
 
     :param soc: The given socket to receive request from
     :param progress: The progress callback
+    :param wait: To retry on failure or raise, see network.recv_bytes
     :return: The bytes from request or None on error
     """
     try:
-        size = struct.unpack("I", notnone(recv_bytes(soc, 4)))
-        return bytes(notnone(recv_bytes(soc, size[0], progress=progress)))
+        size = struct.unpack("I", notnone(recv_bytes(soc, 4, wait=wait)))
+        return recv_bytes(soc, size[0], wait=wait, progress=progress)
     except (TypeError, AssertionError):
         return None
 
@@ -173,6 +215,133 @@ def send_request(soc: socket.socket, param: bytes) -> None:
     :return: None
     """
     try:
-        soc.sendall(struct.pack("I", len(param)) + param)
+        send_parts(soc, [struct.pack("I", len(param)), param])
     except OSError:
         pass
+
+
+def get_frame(soc: socket.socket,
+              progress: Optional[Callable[[int], Optional[Callable[[int, int, int], None]]]] = None,
+              wait: bool = True,
+              pool: Optional[BufferPool] = None,
+              max_size: int = MAX_FRAME) -> Optional[Tuple[int, Union[bytearray, memoryview]]]:
+    """ Receive a request tagged with its request id
+
+    Persistent connections carry several outstanding requests at once,
+    the id pairs every reply with the request it answers. The payload is
+    returned as received, without copying it into bytes
+
+    :param soc: The given socket to receive the frame from
+    :param progress: Gives the progress callback of a request id, see network.recv_bytes
+    :param wait: To retry on failure or raise, see network.recv_bytes
+    :param pool: Receive into a buffer of the pool, the payload is then a memoryview
+                 of it which is given back with pool.release(payload.obj) once decoded
+    :param max_size: The largest payload accepted, the size is checked before
+                     anything is allocated for it
+    :return: The request id and the payload or None when the connection is closed
+             or the frame is too large
+    """
+    header = recv_bytes(soc, _HEADER.size, wait=wait)
+    if header is None:
+        return None
+
+    size, rid = _HEADER.unpack(header)
+    if size < _FRAME.size or size - _FRAME.size > max_size:
+        return None
+    size -= _FRAME.size
+    if pool is None or size > pool.max_size:
+        # Frames the pool doesn't keep buffers for get one of their own, the
+        # size was checked against max_size above
+        data = recv_bytes(soc, size, wait=wait, progress=progress(rid) if progress is not None else None)
+        if data is None:
+            return None
+        return rid, memoryview(data) if pool is not None else data
+
+    buffer = pool.acquire(size)
+    view = memoryview(buffer)[:size]
+    try:
+        received = recv_into(soc, view, wait=wait, progress=progress(rid) if progress is not None else None)
+    except OSError:
+        pool.release(buffer)
+        raise
+    if not received:
+        pool.release(buffer)
+        return None
+    return rid, view
+
+
+def send_frame(soc: socket.socket, rid: int, param: Union[bytes, Sequence[Any]]) -> None:
+    """ Send the payload tagged with the request id, see network.get_frame
+
+    Unlike network.send_request failures are raised, the caller has to
+    know a reply will never arrive
+
+    :param soc: The socket to send data to
+    :param rid: The request id
+    :param param: The bytes to send, or the parts of them as given by codec.encode_parts
+    :return: None
+    """
+    parts = [param] if isinstance(param, (bytes, bytearray, memoryview)) else list(param)
+    size = sum(memoryview(part).nbytes for part in parts)
+    send_parts(soc, [_HEADER.pack(_FRAME.size + size, rid), *parts])
+
+
+async def read_frame(reader: asyncio.StreamReader, max_size: int = MAX_FRAME) -> Optional[Tuple[int, bytes]]:
+    """ Receive a frame from an asyncio stream, see network.get_frame
+
+    :param reader: The stream to read the frame from
+    :param max_size: The largest payload accepted
+    :return: The request id and the payload or None when the connection is closed
+             or the frame is too large
+    """
+    try:
+        size, rid = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+        if size < _FRAME.size or size - _FRAME.size > max_size:
+            return None
+        return rid, await reader.readexactly(size - _FRAME.size)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def write_frame(writer: asyncio.StreamWriter, rid: int, param: Union[bytes, Sequence[Any]]) -> None:
+    """ Queue a frame on an asyncio stream, see network.send_frame
+
+    Nothing awaits in between, so frames written by concurrent tasks never
+    interleave. The caller drains the writer
+
+    :param writer: The stream to write the frame to
+    :param rid: The request id
+    :param param: The bytes to send, or the parts of them as given by codec.encode_parts
+    :return: None
+    """
+    parts = [param] if isinstance(param, (bytes, bytearray, memoryview)) else list(param)
+    size = sum(memoryview(part).nbytes for part in parts)
+    writer.writelines([_HEADER.pack(_FRAME.size + size, rid), *parts])
+
+
+def send_parts(soc: socket.socket, parts: Sequence[Any]) -> None:
+    """ Send the buffers one after another without joining them
+
+    Uses scatter-gather sendmsg where the platform has it, so a header and
+    a large payload go out in one call without being copied together
+
+    :param soc: The socket to send data to
+    :param parts: The bytes-like objects to send
+    :return: None
+    """
+    views = [memoryview(part).cast('B') for part in parts if memoryview(part).nbytes > 0]
+    if not hasattr(soc, 'sendmsg'):
+        for view in views:
+            soc.sendall(view)
+        return
+
+    i = 0
+    while i < len(views):
+        sent = soc.sendmsg(views[i:i + _IOV_MAX])
+        while sent > 0:
+            if sent >= len(views[i]):
+                sent -= len(views[i])
+                i += 1
+            else:
+                views[i] = views[i][sent:]
+                sent = 0
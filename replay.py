@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import secrets
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import Future
+from threading import Lock, BoundedSemaphore
+from typing import Dict, List, Any, Deque, Sequence, Tuple, Optional
+
+from bench import HOST, start_server, percentiles
+from client.models.connection import Connection
+from network import codec
+from server.stats import command_of, size_of
+from server.trace import Record, read_trace, inodes_of
+
+
+class Replay:
+    """Re-issues traced requests in the order the server received them
+
+    Every traced client gets a connection of its own, authenticated as
+    the user it ran as, and its requests are sent one after another. The
+    window bounds the requests in flight across clients, with a window of
+    one the whole trace is replayed strictly in order.
+
+    Inodes are numbered by the server in the order files are created, so
+    the inodes a traced reply named are mapped to the ones the replayed
+    reply names and later requests are rewritten to use them
+    """
+    ip: str
+    port: int
+    speed: float
+    paced: bool
+    latencies: Dict[str, List[float]]
+    errors: int
+    # Replies whose error or size differs from the traced one
+    divergent: int
+    window: int
+    # Sent along by connections of root, see Server.secret
+    secret: Optional[str]
+    __connections: Dict[int, Connection]
+    __window: BoundedSemaphore
+    __lock: Lock
+    # Requests of a client waiting for its previous reply, with their index in the trace
+    __queues: Dict[int, Deque[Tuple[int, Record]]]
+    # Index of the first traced reply naming an inode and the replayed inode,
+    # resolved once the replayed reply arrived
+    __inodes: Dict[int, Tuple[int, Future]]
+
+    def __init__(
+            self, ip: str, port: int, paced: bool = False, speed: float = 1.0, window: int = 1,
+            secret: Optional[str] = None
+    ) -> None:
+        self.ip = ip
+        self.port = port
+        self.secret = secret
+        self.paced = paced
+        self.speed = speed
+        self.latencies = {}
+        self.errors = 0
+        self.divergent = 0
+        self.window = window
+        self.__connections = {}
+        self.__window = BoundedSemaphore(window)
+        self.__lock = Lock()
+        self.__queues = {}
+        self.__inodes = {}
+
+    def run(self, records: List[Record]) -> float:
+        """Issue the records and wait for every reply, returns the seconds it took"""
+        records = sorted(records, key=lambda record: record.received)
+        began = time.monotonic()
+        first = records[0].received if len(records) > 0 else 0
+        # The first reply sent about the node itself maps its inode, a listing
+        # of its folder may be sent earlier and miss the node when replayed
+        named = sorted(
+            (position > 0 or record.params[1] == 'readdir', record.received + record.latency, index, ino)
+            for index, record in enumerate(records) for position, (_, ino) in enumerate(record.inodes)
+        )
+        for _, _, index, ino in named:
+            if ino not in self.__inodes:
+                self.__inodes[ino] = index, Future()
+
+        for index, record in enumerate(records):
+            if self.paced:
+                delay = (record.received - first) / 1e9 / self.speed - (time.monotonic() - began)
+                if delay > 0:
+                    time.sleep(delay)
+            self.__window.acquire()
+            self.__enqueue(index, record)
+
+        # Every permit is back once the last reply arrived
+        for _ in range(self.window):
+            self.__window.acquire()
+        return time.monotonic() - began
+
+    def close(self) -> None:
+        for conn in self.__connections.values():
+            conn.close()
+
+    def __enqueue(self, index: int, record: Record) -> None:
+        with self.__lock:
+            queue = self.__queues.get(record.client)
+            if queue is not None:
+                queue.append((index, record))
+                return
+            self.__queues[record.client] = deque()
+        self.__submit(index, record)
+
+    def __submit(self, index: int, record: Record) -> None:
+        # An inode named by an earlier reply that is still in flight, on another connection
+        for ino in _inodes_used(record.params):
+            named = self.__inodes.get(ino)
+            if named is not None and named[0] < index and not named[1].done():
+                named[1].add_done_callback(lambda _: self.__submit(index, record))
+                return
+
+        sent = time.perf_counter()
+        try:
+            future = self.__connection(record).submit(*self.__mapped(index, record.params))
+        except Exception as e:
+            failed: Future = Future()
+            failed.set_exception(e)
+            self.__answered(index, record, sent, failed)
+            return
+        future.add_done_callback(lambda done: self.__answered(index, record, sent, done))
+
+    def __answered(self, index: int, record: Record, sent: float, future: Future) -> None:
+        latency = time.perf_counter() - sent
+        error = future.exception() is not None
+        reply = future.exception() if error else future.result()
+        try:
+            size = size_of(codec.encode_parts(reply))
+        except Exception:
+            size = -1
+
+        replayed = dict(inodes_of(record.params, reply)) if not error else {}
+        for path, ino in record.inodes:
+            named, mapped = self.__inodes[ino]
+            if named == index:
+                # A failed reply names nothing, the traced inode is the best guess
+                mapped.set_result(replayed.get(path, ino))
+
+        with self.__lock:
+            self.latencies.setdefault(command_of(record.params), []).append(latency)
+            self.errors += error
+            self.divergent += error != record.error or (not error and size != record.size)
+            queue = self.__queues[record.client]
+            following = queue.popleft() if len(queue) > 0 else None
+            if following is None:
+                del self.__queues[record.client]
+        self.__window.release()
+        if following is not None:
+            self.__submit(*following)
+
+    def __mapped(self, index: int, params: Sequence[Any]) -> List[Any]:
+        """The request with the traced inodes replaced, inodes no earlier reply named are kept"""
+        params = list(params)
+        if len(params) > 2 and params[1] == 'batch':
+            params[2] = [self.__mapped(index, ('fs', *op))[1:] for op in params[2]]
+        elif len(params) > 2 and str(params[1]).endswith('_inode'):
+            named = self.__inodes.get(params[2])
+            if named is not None and named[0] < index:
+                params[2] = named[1].result()
+        return params
+
+    def __connection(self, record: Record) -> Connection:
+        conn = self.__connections.get(record.client)
+        if conn is None or conn.closed:
+            conn = self.__connections[record.client] = Connection(
+                self.ip, self.port, user=record.user, secret=self.secret
+            )
+        return conn
+
+
+def _inodes_used(params: Sequence[Any]) -> List[int]:
+    """The inodes the request operates on, see Replay.__mapped"""
+    if len(params) > 2 and params[1] == 'batch':
+        return [ino for op in params[2] for ino in _inodes_used(('fs', *op))]
+    if len(params) > 2 and str(params[1]).endswith('_inode') and type(params[2]) is int:
+        return [params[2]]
+    return []
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replay a request trace recorded by the headless server')
+    parser.add_argument('trace', help='Trace file written by Server(trace=...)')
+    parser.add_argument('--pace', choices=('fast', 'original'), default='fast',
+                        help='Issue requests as fast as possible or at their recorded times')
+    parser.add_argument('--speed', type=float, default=1.0, help='Speed up of the original pacing')
+    parser.add_argument('--window', type=int, default=1,
+                        help='Requests in flight across clients, 1 replays strictly in order')
+    parser.add_argument('--host', help='Replay against a running server instead of a scratch one')
+    parser.add_argument('--port', type=int, default=5500)
+    parser.add_argument('--secret', help='Secret of the running server, replays requests of root as root')
+    parser.add_argument('--image', help='fs.dat the scratch server starts from, empty by default')
+    parser.add_argument('--durability', choices=('immediate', 'group'), default='group')
+    parser.add_argument('--output', help='File the results are written to as json')
+    args = parser.parse_args()
+
+    records = list(read_trace(args.trace))
+    scratch = None
+    fs = None
+    ip, port, secret = args.host, args.port, args.secret
+    if ip is None:
+        secret = secrets.token_hex(16)
+        scratch = tempfile.mkdtemp(prefix='replay-')
+        path = os.path.join(scratch, 'fs.dat')
+        if args.image is not None:
+            shutil.copyfile(args.image, path)
+        fs, port = start_server(path, args, secret)
+        ip = HOST
+
+    replay = Replay(ip, port, args.pace == 'original', args.speed, args.window, secret)
+    try:
+        elapsed = replay.run(records)
+    finally:
+        replay.close()
+        if fs is not None:
+            fs.close()
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    every = [value for values in replay.latencies.values() for value in values]
+    result: Dict[str, Any] = {
+        'trace': args.trace,
+        'pace': args.pace,
+        'requests': len(records),
+        'duration': elapsed,
+        'ops_per_sec': len(records) / elapsed if elapsed > 0 else 0.0,
+        'errors': replay.errors,
+        'divergent': replay.divergent,
+        'latency_ms': percentiles(every),
+        'operations': {name: percentiles(values) for name, values in sorted(replay.latencies.items())},
+    }
+    print(
+        f"{len(records)} requests in {elapsed:.2f}s, {result['ops_per_sec']:.1f} ops/s, "
+        f"p50 {result['latency_ms'].get('p50', 0):.2f} ms, p99 {result['latency_ms'].get('p99', 0):.2f} ms, "
+        f"{replay.errors} errors, {replay.divergent} divergent"
+    )
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,365 @@
 import datetime
-import pickle
-from typing import Optional, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from hmac import compare_digest
+from itertools import count
+from queue import Queue
+from socket import socket, timeout
+from threading import BoundedSemaphore, Lock, Thread
+from time import monotonic, time_ns
+from typing import Optional, Sequence, Any, Dict, Iterator, Union
 
-from exttypes.nullsafe import notnone
-from models import FileSystem
-from network import network
+from exttypes.nullsafe import asserttype
+from models import FileSystem, File
+from models.auth import Authentication, ROOT, ANONYMOUS
+from models.lock import NodeLock
+from network import network, codec
+from network.bufferpool import default_pool
+from server.stats import Stats, command_of, size_of
+from server.trace import TraceWriter, Record, inodes_of
+from services.authservice import AuthService
+
+# Number of requests executed at the same time
+WORKERS = 16
+# Requests read but not yet answered, reading from clients pauses beyond it
+MAX_REQUESTS = 64
+# Number of open client connections, accepting blocks beyond it
+MAX_CONNECTIONS = 256
+# Seconds a connection may stay silent before it is closed
+TIMEOUT = 60.0
+# Largest request accepted, a larger one closes its connection
+MAX_FRAME = network.MAX_FRAME
+
+_log_lock = Lock()
 
 
 class Server:
     id: int
+    ip: str
     port: int
     fs: FileSystem
-    request: Optional[str] = None
+    timeout: float
+    max_frame: int
+    # Print every request and reply
+    verbose: bool
+    stats: Stats
+    # Records every answered request when given a trace file
+    trace: Optional[TraceWriter]
+    # Proves a connection naming root is allowed to, without it nobody is
+    secret: Optional[str]
+    __clients: Iterator[int]
+    __pool: ThreadPoolExecutor
+    __slots: BoundedSemaphore
+    __connections: BoundedSemaphore
+    __subscribers: Dict[socket, Lock]
+    __changes: Queue
 
-    def __init__(self, *, id: int, port: int, fs: FileSystem = FileSystem.load()):
+    def __init__(
+            self, *, id: int, port: int, fs: Optional[FileSystem] = None, ip: Optional[str] = None,
+            workers: int = WORKERS, max_requests: int = MAX_REQUESTS,
+            max_connections: int = MAX_CONNECTIONS, timeout: float = TIMEOUT, max_frame: int = MAX_FRAME,
+            stats_interval: Optional[float] = None, verbose: bool = True, trace: Optional[str] = None,
+            secret: Optional[str] = None
+    ):
         self.id = id
+        self.ip = ip if ip is not None else network.get_local_ip()
         self.port = port
-        self.fs = fs
+        # Loaded lazily so importing the module doesn't open a second journal
+        self.fs = fs if fs is not None else FileSystem.load()
+        self.timeout = timeout
+        self.max_frame = max_frame
+        self.verbose = verbose
+        self.stats = Stats()
+        # Lock waits are counted by every lock of the process
+        NodeLock.waited = self.stats.waited
+        self.fs.on_save = self.stats.saved
+        if stats_interval is not None:
+            self.stats.start(stats_interval)
+        self.trace = TraceWriter(trace) if trace is not None else None
+        self.secret = secret
+        self.__clients = count(1)
+        self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'Server-{id}')
+        self.__slots = BoundedSemaphore(max(max_requests, workers))
+        self.__connections = BoundedSemaphore(max_connections)
+        self.__subscribers = {}
+        self.__changes = Queue()
+        self.fs.watch(self.__changes.put)
+        Thread(target=self._notify, name=f'Notifier-{id}', daemon=True).start()
 
         self._start()
 
     def _start(self):
-        with network.create_server_connection(network.get_local_ip(), self.port) as soc:
+        with network.create_server_connection(self.ip, self.port) as soc:
+            soc.listen()
             while True:
-                self.request = None
+                # Wait for a free slot first, so a flood of clients queues up
+                # in the listen backlog instead of in memory
+                self.__connections.acquire()
                 try:
-                    soc.listen()
-                    if soc:
-                        c_soc, _ = soc.accept()
-                        code = self.execute(network.decode_parameter(
-                            notnone(network.get_request(c_soc))
-                        ))
-                        if code is not None:
-                            print(f'=> {code}')
-                            network.send_request(c_soc, pickle.dumps(code))
-
-                        c_soc.close()
-                except (OSError, AssertionError) as e:
-                    print(f"Error occurred: {e}")
-                    with open('log_server.log', 'a+') as f:
-                        f.write(f'[{datetime.datetime.now()}] ERROR {type(e)}: {e}\n')
-
-    def execute(self, _params: Sequence[str]):
+                    c_soc, addr = soc.accept()
+                except OSError as e:
+                    self.__connections.release()
+                    self._log(e)
+                    continue
+
+                c_soc.settimeout(self.timeout)
+                Thread(target=self._serve, args=(c_soc,), name=f'Client-{addr}', daemon=True).start()
+
+    def _serve(self, c_soc: socket) -> None:
+        """Read the requests of a connection until the client closes it
+
+        Requests run on the worker pool, so a slow request doesn't hold back
+        the ones behind it, replies carry the id of their request
+        """
+        # Connections run as nobody in particular until they name a user
+        user, named = ANONYMOUS.name, False
+        client = next(self.__clients)
+        write = Lock()
+        try:
+            with c_soc:
+                while True:
+                    try:
+                        frame = network.get_frame(c_soc, wait=False, pool=default_pool, max_size=self.max_frame)
+                    except timeout:
+                        # Subscribers only listen, their silence is expected
+                        if c_soc in self.__subscribers:
+                            continue
+                        raise
+                    if frame is None:
+                        break
+
+                    rid, payload = frame
+                    received, size = monotonic(), len(payload)
+                    try:
+                        params = network.decode_parameter(payload)
+                    finally:
+                        # Decoding copies every field, the buffer can be reused
+                        default_pool.release(payload.obj)
+                    if params[0] == 'auth':
+                        # The user is named once, before the first request
+                        if named:
+                            raise OSError('Connection already authenticated')
+                        user, named = self._authenticate(params), True
+                        continue
+                    named = True
+                    if list(params) == ['fs', 'subscribe']:
+                        self.__subscribers[c_soc] = write
+                        with write:
+                            network.send_frame(c_soc, rid, codec.encode_parts(None))
+                        continue
+
+                    self.__slots.acquire()
+                    self.__pool.submit(self._reply, c_soc, write, rid, client, user, params, received, size)
+        except timeout:
+            pass
+        except Exception as e:
+            self._log(e)
+        finally:
+            self.__subscribers.pop(c_soc, None)
+            self.__connections.release()
+
+    def _authenticate(self, params: Sequence[Any]) -> str:
+        """The user an auth frame names, root only with the secret of the server
+
+        Any other name is taken as given, it only decides whose quota is charged
+        """
+        name = params[1] if len(params) > 1 else None
+        if type(name) is not str or name == '':
+            raise OSError(f'Invalid user: {name!r}')
+        if name != ROOT.name:
+            return name
+
+        secret = params[2] if len(params) > 2 else None
+        if self.secret is None or type(secret) is not str or not compare_digest(secret, self.secret):
+            self._log(OSError('Root claimed without the secret, running as anonymous'))
+            return ANONYMOUS.name
+        return name
+
+    def _notify(self) -> None:
+        """Push the paths changed by committed operations to the subscribers
+
+        Pushes use request id 0, which no request is ever given. Changes
+        that queued up while sending are coalesced into one push
+        """
+        while True:
+            paths = {self.__changes.get()}
+            while not self.__changes.empty():
+                paths.add(self.__changes.get_nowait())
+            if len(self.__subscribers) == 0:
+                continue
+
+            payload = codec.encode_parts('invalidate', sorted(paths))
+            for c_soc, write in list(self.__subscribers.items()):
+                try:
+                    with write:
+                        network.send_frame(c_soc, 0, payload)
+                except OSError as e:
+                    self.__subscribers.pop(c_soc, None)
+                    self._log(e)
+
+    def _reply(
+            self, c_soc: socket, write: Lock, rid: int, client: int, user: str, params: Sequence[str],
+            received: float, size: int
+    ) -> None:
+        error, sent, code = False, 0, None
+        try:
+            try:
+                with AuthService.impersonate(Authentication(user)):
+                    code = self.execute(params)
+                if code is not None and self.verbose:
+                    print(f'=> {code}')
+                payload = codec.encode_parts(code)
+            except Exception as e:
+                # The client raises the error of its request
+                self._log(e)
+                error = True
+                payload = codec.encode_parts(e)
+
+            with write:
+                network.send_frame(c_soc, rid, payload)
+            sent = size_of(payload)
+        except Exception as e:
+            self._log(e)
+            error = True
+        finally:
+            self.__slots.release()
+            latency = monotonic() - received
+            self.stats.record(command_of(params), latency, size, sent, error)
+            trace = self.trace
+            if trace is not None:
+                nanos = int(latency * 1e9)
+                record = Record(time_ns() - nanos, client, user, params, nanos, sent, error, inodes_of(params, code))
+                self._trace(trace, record)
+
+    def _trace(self, trace: TraceWriter, record: Record) -> None:
+        try:
+            trace.record(record)
+        except Exception as e:
+            # A trace that can't be written is given up, the requests go on
+            self._log(e)
+            trace.close()
+            self.trace = None
+
+    @staticmethod
+    def _read(file: File, start: int, end: int) -> Union[str, bytes]:
+        # Binary ranges are views of the file's bytearray, which writes change
+        # in place. The range is copied while the file is still locked, the
+        # reply then references that copy, see codec.encode_parts
+        with file.reading():
+            data = file.read(start, end)
+            return data if isinstance(data, str) else bytes(data)
+
+    @staticmethod
+    def _log(e: Exception) -> None:
+        print(f"Error occurred: {e}")
+        with _log_lock, open('log_server.log', 'a+') as f:
+            f.write(f'[{datetime.datetime.now()}] ERROR {type(e)}: {e}\n')
+
+    def execute(self, _params: Sequence[Any]):
         _type, *params = _params
         if _type != 'fs':
             raise OSError(f"Invalid starting sequence: {_type}")
 
-        print(*_params)
+        if self.verbose:
+            print(*_params)
 
+        # Nodes are answered with stubs, pickling a node would drag the
+        # whole tree and every file's contents along
         if params[0] == 'change_directory':
-            return self.fs.change_directory(params[1])
+            return self.fs.change_directory(params[1]).stub()
         elif params[0] == 'create_directory':
             self.fs.create_directory(params[1])
         elif params[0] == 'move':
             self.fs.move(params[1], params[2])
         elif params[0] == 'delete':
             self.fs.delete(params[1])
+        elif params[0] == 'batch':
+            # One lock of the tree and one sync for all of them, a failing
+            # operation answers with its error and the rest still run
+            results = []
+            with self.fs.batch():
+                for op in params[1]:
+                    try:
+                        results.append(self.execute(('fs', *op)))
+                    except Exception as e:
+                        results.append(e)
+            return results
+        elif params[0] == 'stats':
+            return self.stats.snapshot()
         elif params[0] == 'save':
             self.fs.save()
+        elif params[0] == 'sync':
+            self.fs.sync()
         elif params[0] == 'memory_map':
-            return self.fs.memory_map()
+            # Sent as the image itself, the client wraps it again
+            return self.fs.memory_map().file.getvalue()
         elif params[0] == 'root':
-            return self.fs.root
+            return self.fs.root.stub()
         elif params[0] == 'current':
-            return self.fs.current
+            return self.fs.current.stub()
+        elif params[0] == 'stat':
+            return self.fs.stat(params[1])
+        elif params[0] == 'readdir':
+            path, cursor, limit, version = params[1], params[2], params[3], params[4]
+            # Traces recorded before the inode was sent lack it
+            ino = params[5] if len(params) > 5 else None
+            return self.fs.readdir(path, cursor, limit, version, ino)
         elif params[0] == 'create_file':
             path, name = params[1], params[2]
-            self.fs.get_folder(path).create_file(name)
+            self.fs.create_file(path, name)
         elif params[0] == 'open_file':
             path, name, mode = params[1], params[2], params[3]
-            return self.fs.get_folder(path).open_file(name, mode)
+            folder = self.fs.get_folder(path)
+            folder.open_file(name, mode).close()
+            file = folder.get_file(name)
+            self.fs.register(file)
+            return file.stub()
         elif params[0] == 'delete_file':
             path, name = params[1], params[2]
-            self.fs.get_folder(path).delete_file(name)
-            self.fs.save()
+            self.fs.delete_file(path, name)
         elif params[0] == 'write_contents':
-            path, name, contents, start, append = params[1], params[2], params[3], int(params[4]), bool(params[5])
-            self.fs.get_folder(path).open_file(name, 'rw').write(contents, start)
-            self.fs.save()
+            path, name, contents, start, append = params[1], params[2], params[3], params[4], params[5]
+            self.fs.write_contents(path, name, contents, start)
         elif params[0] == 'read_contents':
-            path, name, start, end = params[1], params[2], int(params[3]), int(params[4])
-            return self.fs.get_folder(path).open_file(name, 'rw').read(start, end)
+            path, name, start, end = params[1], params[2], params[3], params[4]
+            return self._read(self.fs.get_folder(path).get_file(name), start, end)
+        elif params[0] == 'size_contents':
+            path, name = params[1], params[2]
+            return self.fs.get_folder(path).get_file(name).size()
         elif params[0] == 'move_contents':
-            path, name, start, end, target = params[1], params[2], int(params[3]), int(params[4]), int(params[5])
-            self.fs.get_folder(path).open_file(name, 'rw').move(start, end, target)
-            self.fs.save()
+            path, name, start, end, target = params[1], params[2], params[3], params[4], params[5]
+            self.fs.move_contents(path, name, start, end, target)
+        elif params[0] == 'patch_contents':
+            path, name, splices, version = params[1], params[2], params[3], params[4]
+            return self.fs.patch_contents(path, name, splices, version)
         elif params[0] == 'truncate_contents':
-            path, name, end = params[1], params[2], int(params[3])
-            self.fs.get_folder(path).open_file(name, 'rw').truncate(end)
-            self.fs.save()
+            path, name, end = params[1], params[2], params[3]
+            self.fs.truncate_contents(path, name, end)
+        elif params[0] == 'usage':
+            return self.fs.usage(params[1])
+        elif params[0] == 'lookup':
+            return self.fs.lookup(params[1])
+        elif params[0] == 'read_inode':
+            ino, start, end = params[1], params[2], params[3]
+            return self._read(asserttype(File, self.fs.inode(ino)), start, end)
+        elif params[0] == 'write_inode':
+            ino, contents, start = params[1], params[2], params[3]
+            self.fs.write_inode(ino, contents, start)
+        elif params[0] == 'patch_inode':
+            ino, splices, version = params[1], params[2], params[3]
+            return self.fs.patch_inode(ino, splices, version)
+        elif params[0] == 'move_inode':
+            ino, start, end, target = params[1], params[2], params[3], params[4]
+            self.fs.move_inode(ino, start, end, target)
+        elif params[0] == 'truncate_inode':
+            ino, end = params[1], params[2]
+            self.fs.truncate_inode(ino, end)
+        elif params[0] == 'set_quota':
+            size, inodes, path, user = params[1], params[2], params[3], params[4]
+            self.fs.set_quota(size, inodes, path, user)
+        elif params[0] == 'quota':
+            path, user = params[1], params[2]
+            return self.fs.quota(path, user)
+        elif params[0] == 'size_inode':
+            return asserttype(File, self.fs.inode(params[1])).size()
         else:
-            raise OSError(f'Invalid command: {" ".join(_params)}')
+            raise OSError(f'Invalid command: {" ".join(map(str, _params))}')
@@ -0,0 +1,157 @@
+import json
+from bisect import bisect_left
+from threading import Lock, Event, Thread
+from time import monotonic, time
+from typing import Dict, List, Any
+
+# Upper bounds of the latency buckets in seconds, four per doubling from a
+# microsecond to a few minutes, so a quantile is off by at most 19%
+BOUNDS = [1e-6 * 2 ** (i / 4) for i in range(4 * 28)]
+# Where Stats.start appends a snapshot every interval
+STATS_PATH = 'stats_server.log'
+QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+
+class Histogram:
+    """Counts of durations in logarithmic buckets, recording never allocates"""
+    count: int
+    total: float
+    max: float
+    __buckets: List[int]
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.__buckets = [0] * (len(BOUNDS) + 1)
+
+    def record(self, seconds: float) -> None:
+        self.__buckets[bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """The upper bound of the bucket holding the quantile, 0 when empty"""
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.__buckets):
+            seen += n
+            if n > 0 and seen >= rank:
+                return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+        return 0.0
+
+    def summary(self) -> Dict[str, float]:
+        summary = {'count': self.count, 'total': self.total, 'mean': self.total / self.count if self.count else 0.0}
+        for name, q in QUANTILES:
+            summary[name] = self.quantile(q)
+        summary['max'] = self.max
+        return summary
+
+
+class CommandStats:
+    count: int
+    errors: int
+    bytes_in: int
+    bytes_out: int
+    latency: Histogram
+
+    def __init__(self) -> None:
+        self.count = self.errors = self.bytes_in = self.bytes_out = 0
+        self.latency = Histogram()
+
+
+class Stats:
+    """Counters of the requests a server answered, cheap enough to always keep
+
+    Latencies run from reading a request to having sent its reply. Lock
+    waits only count acquisitions that had to wait for another thread
+    """
+    started: float
+    commands: Dict[str, CommandStats]
+    lock_waits: Histogram
+    saves: Histogram
+    __lock: Lock
+    __stop: Event
+
+    def __init__(self) -> None:
+        self.started = monotonic()
+        self.commands = {}
+        self.lock_waits = Histogram()
+        self.saves = Histogram()
+        self.__lock = Lock()
+        self.__stop = Event()
+
+    def record(self, command: str, seconds: float, bytes_in: int, bytes_out: int, error: bool = False) -> None:
+        with self.__lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = CommandStats()
+            stats.count += 1
+            stats.errors += error
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            stats.latency.record(seconds)
+
+    def waited(self, seconds: float) -> None:
+        with self.__lock:
+            self.lock_waits.record(seconds)
+
+    def saved(self, seconds: float) -> None:
+        with self.__lock:
+            self.saves.record(seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Totals, rates and latency quantiles in seconds since the server started"""
+        with self.__lock:
+            uptime = monotonic() - self.started
+            commands = {
+                name: {
+                    'count': stats.count,
+                    'rate': stats.count / uptime,
+                    'errors': stats.errors,
+                    'bytes_in': stats.bytes_in,
+                    'bytes_out': stats.bytes_out,
+                    'latency': stats.latency.summary(),
+                }
+                for name, stats in sorted(self.commands.items())
+            }
+            requests = sum(stats.count for stats in self.commands.values())
+            return {
+                'time': time(),
+                'uptime': uptime,
+                'requests': requests,
+                'rate': requests / uptime,
+                'bytes_in': sum(stats.bytes_in for stats in self.commands.values()),
+                'bytes_out': sum(stats.bytes_out for stats in self.commands.values()),
+                'commands': commands,
+                'lock_waits': self.lock_waits.summary(),
+                'saves': self.saves.summary(),
+            }
+
+    def start(self, interval: float, path: str = STATS_PATH) -> None:
+        """Append a snapshot as a line of json to the file every interval seconds"""
+        Thread(target=self.__dump, args=(interval, path), name='Stats', daemon=True).start()
+
+    def stop(self) -> None:
+        self.__stop.set()
+
+    def __dump(self, interval: float, path: str) -> None:
+        while not self.__stop.wait(interval):
+            with open(path, 'a+') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
+
+
+def command_of(params: Any) -> str:
+    """The name requests are counted under, the command after 'fs'"""
+    try:
+        if params[0] == 'fs' and len(params) > 1:
+            return str(params[1])
+        return str(params[0])
+    except (TypeError, IndexError):
+        return '?'
+
+
+def size_of(parts: List[Any]) -> int:
+    return sum(memoryview(part).nbytes for part in parts)
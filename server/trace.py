@@ -0,0 +1,95 @@
+import struct
+from dataclasses import dataclass
+from threading import Lock
+from typing import Sequence, Any, Iterator, BinaryIO, Optional, Tuple, List
+
+from models.stub import Stub, Listing
+from network import codec
+
+_SIZE = struct.Struct("!I")
+
+
+@dataclass(frozen=True)
+class Record:
+    """A request as the server answered it, times are in nanoseconds
+
+    Inodes are the path and inode number of every node the reply named,
+    which lets a replay map them to the inodes its own replies name
+    """
+    received: int
+    client: int
+    user: str
+    params: Sequence[Any]
+    latency: int
+    size: int
+    error: bool
+    inodes: Sequence[Tuple[str, int]] = ()
+
+
+class TraceWriter:
+    """Appends every answered request to a trace file, see read_trace
+
+    Records are length prefixed codec messages written in the order the
+    replies were sent, each one reaches the file before the next begins
+    """
+    path: str
+    __file: Optional[BinaryIO]
+    __lock: Lock
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.__file = open(path, 'ab')
+        self.__lock = Lock()
+
+    def record(self, record: Record) -> None:
+        data = codec.encode(
+            record.received, record.client, record.user, list(record.params),
+            record.latency, record.size, record.error, list(record.inodes)
+        )
+        with self.__lock:
+            if self.__file is None:
+                return
+            self.__file.write(_SIZE.pack(len(data)) + data)
+            self.__file.flush()
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+
+def read_trace(path: str) -> Iterator[Record]:
+    """The records of a trace file in the order they were written
+
+    A record cut short by a crash ends the trace
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_SIZE.size)
+            if len(header) < _SIZE.size:
+                return
+            size = _SIZE.unpack(header)[0]
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield Record(*codec.decode(data))
+
+
+def inodes_of(params: Sequence[Any], reply: Any) -> List[Tuple[str, int]]:
+    """The path and inode number of every node the reply to the request names
+
+    The node a stub is about comes first, before its children. A lookup
+    answers with the bare number, it is keyed by an empty path
+    """
+    if len(params) > 1 and params[1] == 'lookup':
+        return [('', reply)] if type(reply) is int else []
+
+    inodes: List[Tuple[str, int]] = []
+    stubs = list(reply.entries) if isinstance(reply, Listing) else [reply] if isinstance(reply, Stub) else []
+    while len(stubs) > 0:
+        stub = stubs.pop()
+        if stub.ino is not None:
+            inodes.append((stub.path, stub.ino))
+        stubs.extend(stub.children or ())
+    return inodes
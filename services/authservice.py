@@ -1,7 +1,9 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Optional
+from threading import local
+from typing import Optional, Iterator
 
-from models.auth import Authentication
+from models.auth import Authentication, ROOT
 
 
 @dataclass
@@ -21,5 +23,28 @@ class AuthService:
 
         return __locator._auth
 
+    @staticmethod
+    @contextmanager
+    def impersonate(auth: Authentication) -> Iterator[None]:
+        """Act as another user on the calling thread, e.g. for a server request"""
+        previous = getattr(_local, 'auth', None)
+        _local.auth = auth
+        try:
+            yield
+        finally:
+            _local.auth = previous
+
+    @staticmethod
+    def current() -> Authentication:
+        auth = getattr(_local, 'auth', None)
+        if auth is not None:
+            return auth
+
+        try:
+            return AuthService.fetch_auth()
+        except (AttributeError, NameError):
+            return ROOT
+
 
 __locator: Optional[AuthService] = None
+_local = local()
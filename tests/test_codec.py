@@ -0,0 +1,77 @@
+import pickle
+import struct
+import unittest
+
+from models.delta import VersionMismatch
+from models.quota import Quota, Usage, QuotaExceeded
+from models.stub import Stub, Listing, FILE, FOLDER
+from network import codec
+
+
+def _sized(tag: int, size: int) -> bytes:
+    return struct.pack('!BI', tag, size)
+
+
+class CodecTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        child = Stub('f', FILE, '/a/f', '/a/', 3, 1, 10, binary=True)
+        folder = Stub('a', FOLDER, '/a/', '/', 2, 4, 10, files=1, children=(child,))
+        values = [
+            None, True, False, 0, -2 ** 63, 2 ** 63 - 1, 1.5, '', 'héllo', b'', b'\x00\xff',
+            [1, [2, (3, None)]], (), {'a': [b'x'], 1: {'b': None}},
+            folder, Listing('/a/', 4, (child,), 'f', 2), Quota(10, None), Usage(3, 1),
+        ]
+        self.assertEqual(codec.decode(codec.encode(*values)), values)
+        self.assertEqual(codec.decode(b''.join(bytes(part) for part in codec.encode_parts(*values))), values)
+
+    def test_buffers_decode_as_bytes(self) -> None:
+        self.assertEqual(codec.decode(codec.encode(bytearray(b'ab'), memoryview(b'cd'))), [b'ab', b'cd'])
+
+    def test_errors(self) -> None:
+        for error in (FileNotFoundError('x'), QuotaExceeded('q'), VersionMismatch('v'), KeyError('k')):
+            decoded = codec.decode(codec.encode(error))[0]
+            self.assertIs(type(decoded), type(error))
+            self.assertEqual(decoded.args, error.args)
+
+        # Unknown types arrive as an OSError naming them
+        decoded = codec.decode(codec.encode(RecursionError('deep')))[0]
+        self.assertIs(type(decoded), OSError)
+        self.assertIn('RecursionError', str(decoded))
+
+    def test_unencodable(self) -> None:
+        for value in (object(), 2 ** 64, {1, 2}):
+            with self.assertRaises(TypeError):
+                codec.encode(value)
+
+    def test_malformed(self) -> None:
+        version = bytes([codec.VERSION])
+        messages = {
+            'empty': b'',
+            'version': bytes([codec.VERSION + 1]) + bytes([0]),
+            'pickle': pickle.dumps(['fs', 'stat', '/']),
+            'truncated int': version + bytes([3, 0, 0]),
+            'truncated str': version + _sized(4, 10) + b'abc',
+            'utf-8': version + _sized(4, 2) + b'\xff\xfe',
+            'unknown tag': version + _sized(99, 0),
+            'short list': version + _sized(6, 3) + bytes([0]),
+            'error fields': version + _sized(10, 3) + bytes([0, 0, 0]),
+            'error name': version + _sized(10, 2) + bytes([0]) + _sized(6, 0),
+            'error args': version + _sized(10, 2) + _sized(4, 1) + b'x' + bytes([0]),
+            'record fields': version + _sized(11, 1) + bytes([0]),
+            'dict key': version + _sized(9, 1) + _sized(6, 0) + bytes([0]),
+            'nested': version + _sized(6, 1) * 100000 + bytes([0]),
+            'nested dict': version + (_sized(9, 1) + bytes([0])) * (codec.MAX_DEPTH + 1) + bytes([0]),
+        }
+        for name, message in messages.items():
+            with self.assertRaises(IOError, msg=name):
+                codec.decode(message)
+
+    def test_depth_limit(self) -> None:
+        value: list = []
+        for _ in range(codec.MAX_DEPTH - 1):
+            value = [value]
+        self.assertEqual(codec.decode(codec.encode(value)), [value])
+
+
+if __name__ == '__main__':
+    unittest.main()
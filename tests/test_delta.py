@@ -0,0 +1,71 @@
+import random
+import unittest
+from typing import Union, Sequence
+
+from models.delta import diff, Splice, VersionMismatch
+from models.file import File
+
+
+def _patch(old: Union[str, bytes], splices: Sequence[Splice]) -> Union[str, bytes]:
+    for start, end, contents in reversed(splices):
+        old = old[:start] + contents + old[end:]
+    return old
+
+
+class DeltaTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        rand = random.Random(1)
+        for binary in (False, True):
+            for _ in range(200):
+                old = self._text(rand, rand.randint(0, 600), binary)
+                new = self._edit(rand, old, binary)
+                block = rand.choice((1, 4, 16, 64))
+                splices = diff(old, new, block)
+                self.assertEqual(_patch(old, splices), new)
+                offsets = [offset for start, end, _ in splices for offset in (start, end)]
+                self.assertEqual(offsets, sorted(offsets))
+
+    def test_identical(self) -> None:
+        self.assertEqual(diff('same', 'same'), [])
+
+    def test_moved_block_is_not_resent(self) -> None:
+        block = ''.join(chr(ord('a') + i % 26) for i in range(64))
+        old = block + 'x' * 20
+        new = 'y' * 20 + block
+        splices = diff(old, new, 64)
+        self.assertEqual(_patch(old, splices), new)
+        self.assertLess(sum(len(contents) for _, _, contents in splices), len(new) - 32)
+
+    def test_file_patch(self) -> None:
+        rand = random.Random(2)
+        for binary in (False, True):
+            old = self._text(rand, 300, binary)
+            file = File('f', None, old, binary=binary)
+            new = self._edit(rand, old, binary)
+            version = file.patch(diff(old, new, 8), file.version)
+            read = file.read()
+            self.assertEqual(read if isinstance(read, str) else bytes(read), new)
+            with self.assertRaises(VersionMismatch):
+                file.patch(diff(new, old, 8), version - 1)
+
+    def test_invalid_block(self) -> None:
+        with self.assertRaises(ValueError):
+            diff('a', 'b', 0)
+
+    @staticmethod
+    def _text(rand: random.Random, size: int, binary: bool) -> Union[str, bytes]:
+        # Few distinct values, so blocks repeat and match in several places
+        values = [rand.randrange(4) for _ in range(size)]
+        return bytes(values) if binary else ''.join(chr(ord('a') + value) for value in values)
+
+    def _edit(self, rand: random.Random, old: Union[str, bytes], binary: bool) -> Union[str, bytes]:
+        new = old
+        for _ in range(rand.randint(0, 5)):
+            start = rand.randint(0, len(new))
+            end = rand.randint(start, min(len(new), start + 50))
+            new = new[:start] + self._text(rand, rand.randint(0, 30), binary) + new[end:]
+        return new
+
+
+if __name__ == '__main__':
+    unittest.main()
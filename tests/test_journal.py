@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from models import FileSystem
+from models.durability import Durability
+from models.journal import journal_path
+
+
+class JournalReplayTest(unittest.TestCase):
+    """Images and journals as a crash at each step of a checkpoint leaves them"""
+
+    def setUp(self) -> None:
+        self.scratch = tempfile.mkdtemp()
+        self.path = os.path.join(self.scratch, 'fs.dat')
+        self.fs = FileSystem.load(path=self.path, durability=Durability.immediate())
+        self.loaded = []
+
+    def tearDown(self) -> None:
+        for fs in [self.fs, *self.loaded]:
+            fs.close()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def test_replays_after_crash(self) -> None:
+        self._append(3)
+        self.assertEqual(self._recover(self._copy()), 'xxx')
+
+    def test_crash_before_image_rename(self) -> None:
+        self._append(2)
+        crashed = self._copy()
+        # The new image was written in full but never replaced the old one
+        with open(os.path.join(crashed, 'fs.dat.tmp'), 'wb') as f:
+            f.write(b'\x80\x03partial')
+        self.assertEqual(self._recover(crashed), 'xx')
+
+    def test_crash_before_journal_discard(self) -> None:
+        self._append(2)
+        with open(journal_path(self.path), 'rb') as f:
+            journal = f.read()
+        self.fs.save()
+        self._append(1)
+        crashed = self._copy()
+        # The image already holds the first records, the journal still has
+        # them and the shortened journal was never renamed over it
+        path = journal_path(os.path.join(crashed, 'fs.dat'))
+        with open(path, 'r+b') as f:
+            tail = f.read()
+            f.seek(0)
+            f.write(journal + tail)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(tail)
+        self.assertEqual(self._recover(crashed), 'xxx')
+
+    def test_torn_tail(self) -> None:
+        self._append(2)
+        crashed = self._copy()
+        with open(journal_path(os.path.join(crashed, 'fs.dat')), 'ab') as f:
+            f.write(b'\xff\x00\x00\x00torn')
+        self.assertEqual(self._recover(crashed), 'xx')
+
+    def _append(self, count: int) -> None:
+        for _ in range(count):
+            with self.fs.root.open_file('log', 'a') as handle:
+                handle.write('x')
+
+    def _copy(self) -> str:
+        """The files on disk as they are now, like after a kill"""
+        crashed = tempfile.mkdtemp(dir=self.scratch)
+        for path in (self.path, journal_path(self.path)):
+            if os.path.exists(path):
+                shutil.copy(path, crashed)
+        return crashed
+
+    def _recover(self, crashed: str) -> str:
+        fs = FileSystem.load(path=os.path.join(crashed, 'fs.dat'), durability=Durability.immediate())
+        self.loaded.append(fs)
+        return fs.root.get_file('log').read()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from threading import Thread, Event
+from typing import List
+
+from models import FileSystem
+from models.durability import Durability
+from models.lock import NodeLock, IS, IX, S, X
+
+
+def _acquire(lock: NodeLock, mode: str, acquired: Event, release: Event) -> Thread:
+    def hold() -> None:
+        lock.acquire(mode)
+        acquired.set()
+        release.wait()
+        lock.release(mode)
+
+    thread = Thread(target=hold, daemon=True)
+    thread.start()
+    return thread
+
+
+class NodeLockTest(unittest.TestCase):
+    def test_compatibility(self) -> None:
+        pairs = {
+            (IS, IS): True, (IS, IX): True, (IS, S): True, (IS, X): False,
+            (IX, IX): True, (IX, S): False, (IX, X): False,
+            (S, S): True, (S, X): False,
+            (X, X): False,
+        }
+        for (held, wanted), compatible in pairs.items():
+            for first, second in ((held, wanted), (wanted, held)):
+                lock = NodeLock()
+                acquired, release = Event(), Event()
+                thread = _acquire(lock, first, acquired, release)
+                acquired.wait()
+                self.assertEqual(lock.acquire(second, blocking=False), compatible, (first, second))
+                if compatible:
+                    lock.release(second)
+                release.set()
+                thread.join()
+
+    def test_reentrant(self) -> None:
+        lock = NodeLock()
+        lock.acquire(S)
+        self.assertTrue(lock.acquire(X, blocking=False))
+        lock.release(X)
+        lock.release(S)
+        self.assertFalse(lock.locked())
+
+    def test_waiting_blocks_newcomers(self) -> None:
+        lock = NodeLock()
+        acquired, release = Event(), Event()
+        writer = _acquire(lock, IX, acquired, release)
+        acquired.wait()
+
+        # A shared request waits for the writer, later writers queue behind it
+        shared, release_shared = Event(), Event()
+        reader = _acquire(lock, S, shared, release_shared)
+        while not self._waiting(lock):
+            pass
+        self.assertFalse(lock.acquire(IX, blocking=False))
+        self.assertTrue(lock.acquire(IS, blocking=False))
+        lock.release(IS)
+
+        release.set()
+        writer.join()
+        self.assertTrue(shared.wait(5))
+        release_shared.set()
+        reader.join()
+        self.assertTrue(lock.acquire(IX, blocking=False))
+        lock.release(IX)
+
+    def test_timeout_leaves_queue(self) -> None:
+        lock = NodeLock()
+        acquired, release = Event(), Event()
+        writer = _acquire(lock, X, acquired, release)
+        acquired.wait()
+        self.assertFalse(lock.acquire(S, timeout=0.05))
+        self.assertFalse(self._waiting(lock))
+        release.set()
+        writer.join()
+
+    @staticmethod
+    def _waiting(lock: NodeLock) -> bool:
+        return len(getattr(lock, '_NodeLock__waiting')) > 0
+
+
+class SaveUnderWritersTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.scratch = tempfile.mkdtemp()
+        self.fs = FileSystem.load(path=os.path.join(self.scratch, 'fs.dat'), durability=Durability.group())
+
+    def tearDown(self) -> None:
+        self.fs.close()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def test_save_completes(self) -> None:
+        stop = Event()
+
+        def write(i: int) -> None:
+            # Every writer holds its file for a while, together they keep an
+            # intent lock on the root at all times
+            with self.fs.root.open_file(f'f{i}', 'w') as handle:
+                while not stop.is_set():
+                    with handle.writing():
+                        handle.write('x' * 64)
+                        time.sleep(0.005)
+
+        writers: List[Thread] = [Thread(target=write, args=(i,), daemon=True) for i in range(4)]
+        for thread in writers:
+            thread.start()
+        try:
+            saver = Thread(target=self.fs.save, daemon=True)
+            saver.start()
+            saver.join(10)
+            self.assertFalse(saver.is_alive(), 'save starved by the writers')
+        finally:
+            stop.set()
+            for thread in writers:
+                thread.join()
+        self.assertTrue(os.path.exists(self.fs.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
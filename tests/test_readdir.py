@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from typing import List, Optional
+
+from models import FileSystem
+from models.durability import Durability
+
+
+class ReaddirTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.scratch = tempfile.mkdtemp()
+        self.fs = FileSystem.load(path=os.path.join(self.scratch, 'fs.dat'), durability=Durability.group())
+        self.fs.create_directory('/d')
+        for i in range(25):
+            self.fs.create_file('/d', f'f{i:02}')
+
+    def tearDown(self) -> None:
+        self.fs.close()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def test_pages(self) -> None:
+        names: List[str] = []
+        cursor: Optional[str] = None
+        pages = 0
+        while True:
+            listing = self.fs.readdir('/d', cursor, 10)
+            names.extend(entry.name for entry in listing.entries)
+            pages += 1
+            cursor = listing.cursor
+            if cursor is None:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(names, [f'f{i:02}' for i in range(25)])
+
+    def test_unchanged(self) -> None:
+        listing = self.fs.readdir('/d', limit=5)
+        self.assertIsNone(self.fs.readdir('/d', limit=5, version=listing.version, ino=listing.ino))
+
+    def test_changes_below_bump_the_version(self) -> None:
+        self.fs.create_directory('/d/sub')
+        listing = self.fs.readdir('/d')
+        self.fs.create_file('/d/sub', 'deep')
+        self.assertIsNotNone(self.fs.readdir('/d', version=listing.version, ino=listing.ino))
+
+        listing = self.fs.readdir('/d')
+        with self.fs.get_folder('/d').open_file('f00', 'w') as handle:
+            handle.write('changed')
+        self.assertIsNotNone(self.fs.readdir('/d', version=listing.version, ino=listing.ino))
+
+    def test_recreated_folder(self) -> None:
+        self.fs.create_directory('/e')
+        listing = self.fs.readdir('/e')
+        self.fs.delete('/e')
+        self.fs.create_directory('/e')
+        # The new folder starts at the same version, only the inode differs
+        self.assertIsNone(self.fs.readdir('/e', version=listing.version))
+        self.assertIsNotNone(self.fs.readdir('/e', version=listing.version, ino=listing.ino))
+
+    def test_invalid_limit(self) -> None:
+        with self.assertRaises(IOError):
+            self.fs.readdir('/d', limit=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import random
+import unittest
+from typing import Union
+
+from models.buffer import Buffer
+from models.rope import Rope
+
+
+class RopeModelTest(unittest.TestCase):
+    """Random edits of a rope checked against the same edits of a str"""
+
+    def test_text(self) -> None:
+        self._check(Rope, 'abcdefghijklmnopqrstuvwxyz', random.Random(1))
+
+    def test_bytes(self) -> None:
+        self._check(Rope, b'abcdefghijklmnopqrstuvwxyz', random.Random(2))
+
+    def test_buffer(self) -> None:
+        self._check(Buffer, b'abcdefghijklmnopqrstuvwxyz', random.Random(3))
+
+    def test_snapshot(self) -> None:
+        for cls, contents in ((Rope, 'hello world'), (Rope, b'hello world'), (Buffer, b'hello world')):
+            rope = cls(contents)
+            copy = rope.snapshot()
+            rope.replace(0, 5, contents[6:])
+            copy.insert(0, contents[:1])
+            self.assertEqual(self._slice(rope, 0, len(rope)), contents[6:] + contents[5:])
+            self.assertEqual(self._slice(copy, 0, len(copy)), contents[:1] + contents)
+
+    def _check(self, cls: type, alphabet: Union[str, bytes], rand: random.Random) -> None:
+        model = alphabet[:0]
+        rope = cls(model)
+        for step in range(2000):
+            size = len(model)
+            start = rand.randint(0, size)
+            end = rand.randint(start, size)
+            op = rand.choice(('insert', 'replace', 'copy', 'truncate', 'slice'))
+            if op == 'insert':
+                contents = self._text(alphabet, rand)
+                rope.insert(start, contents)
+                model = model[:start] + contents + model[start:]
+            elif op == 'replace':
+                contents = self._text(alphabet, rand)
+                rope.replace(start, end, contents)
+                model = model[:start] + contents + model[end:]
+            elif op == 'copy':
+                target = rand.randint(0, size)
+                chunk = model[start:end]
+                rope.copy(start, end, target)
+                model = model[:target] + chunk + model[target + len(chunk):]
+            elif op == 'truncate' and rand.random() < 0.1:
+                rope.truncate(start)
+                model = model[:start]
+            else:
+                self.assertEqual(self._slice(rope, start, end), model[start:end], step)
+
+            self.assertEqual(len(rope), len(model), (step, op))
+        self.assertEqual(self._slice(rope, 0, len(rope)), model)
+
+    @staticmethod
+    def _text(alphabet: Union[str, bytes], rand: random.Random) -> Union[str, bytes]:
+        return alphabet[:0].join(alphabet[i:i + 1] for i in rand.choices(range(len(alphabet)), k=rand.randint(0, 8)))
+
+    @staticmethod
+    def _slice(rope, start: int, end: int) -> Union[str, bytes]:
+        data = rope.slice(start, end)
+        return data if isinstance(data, (str, bytes)) else bytes(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,15 @@
 import logging
 from concurrent.futures import ThreadPoolExecutor
-from io import StringIO
+from io import StringIO, SEEK_END
 from tkinter import *
 from tkinter import ttk, messagebox, simpledialog
-from typing import Dict, Optional, List, Callable
+from typing import Dict, Optional, List, Callable, Union
 
 from exttypes import asserttype
 from interpreter.interpreter import Interpreter
-from models import FileSystem, Node, Folder, File, Memory
+from models import FileSystem, Node, Folder, File, Memory, delta
+from models.delta import VersionMismatch
+from models.file import FileHandle
 from services.memservice import MemoryService
 
 log = logging.getLogger('Gui')
@@ -42,6 +44,7 @@ class FileManager:
         self.tree.bind('<Double-1>', self.open_notepad)
         self.tree.insert('', 'end', root.path(), text='/', tags=('root', root.path()), open=True)
         self.tree.set(root.path(), 'type', 'root')
+        self.tree.set(root.path(), 'size', f'{root.total_size} bytes')
         self._load_nodes(root, root.nodes)
 
     def configure_menu(self):
@@ -74,8 +77,7 @@ class FileManager:
         name = simpledialog.askstring(title='New File', prompt='Enter new file name')
         if name is not None:
             log.debug(f'Creating file at {item["tags"][1]}: {name}')
-            self.fs.change_directory(item['tags'][1]).create_file(name)
-            self.fs.save()
+            self.fs.create_file(item['tags'][1], name)
         else:
             messagebox.showerror(title='Error', message='Invalid name entered')
 
@@ -153,28 +155,32 @@ class FileManager:
                 self.tree.insert(parent.path(), 'end', node.path(), text=node.name, tags=('folder', node.path()),
                                  open=True)
                 self.tree.set(node.path(), 'type', 'folder')
+                self.tree.set(node.path(), 'size', f'{node.total_size} bytes')
                 self._load_nodes(node, node.nodes)
             else:
                 self.tree.insert(parent.path(), 'end', node.path(), text=node.name, tags=('file', node.path()))
                 self.tree.set(node.path(), 'type', 'file')
-                self.tree.set(node.path(), 'size', f'{len(asserttype(File, node).read())} bytes')
+                self.tree.set(node.path(), 'size', f'{asserttype(File, node).size()} bytes')
 
 
 class Notepad:
-    file: File
+    file: FileHandle
     fs: FileSystem
     root: Toplevel
     menu: Menu
     text: Text
+    # The contents as last read or saved and the version of the file they belong to
+    saved: Union[str, bytes] = ''
+    version: Optional[int] = None
 
-    def __init__(self, top: Toplevel, fs: FileSystem, file: File) -> None:
+    def __init__(self, top: Toplevel, fs: FileSystem, file: FileHandle) -> None:
         self.fs = fs
         self.file = file
         self.root = top
         self.menu = Menu(self.root)
         self.text = Text(self.root)
 
-        MemoryService.fetch_memory().open(file)
+        MemoryService.fetch_memory().open(file.file)
         if len(MemoryService.fetch_memory()) > MAX_OPENED_FILES:
             messagebox.showerror(f'Error opening {self.file.name}',
                                  f'Exceeded max opened files limit {MAX_OPENED_FILES}')
@@ -189,7 +195,7 @@ class Notepad:
         self.root['menu'] = self.menu
         self.text.grid(column=0, row=0, sticky=(N, W, E, S))
 
-        self.text.insert('1.0', self.file.read())
+        self.text.insert('1.0', self._contents())
         self.configure_menu()
 
     def configure_menu(self):
@@ -201,26 +207,48 @@ class Notepad:
         file.add_command(label='Exit', command=self.close)
 
     def save_file(self):
-        self.file.truncate(0)
-        self.file.write(self.text.get('1.0', 'end'))
-        self.fs.save()
+        text = self.text.get('1.0', 'end')
+        try:
+            self._patch(text)
+        except VersionMismatch:
+            if not messagebox.askyesno(title='File changed', message=f'{self.file.name} changed, overwrite it?'):
+                return
+            self._contents()
+            self._patch(text)
+
+    def _patch(self, text: str) -> None:
+        # Only the edited ranges are sent, the file itself checks that they
+        # were computed against the contents it still has
+        new = text.encode('utf-8') if isinstance(self.saved, bytes) else text
+        self.version = self.fs.patch_file(asserttype(File, self.file.file), delta.diff(self.saved, new), self.version)
+        self.saved = new
 
     def truncate(self):
         size = simpledialog.askinteger(title='Number of bytes', prompt='Enter number of bytes')
-        if size is not None and int(size) < len(self.file.read()):
+        if size is not None and int(size) < self.file.seek(0, SEEK_END):
             log.debug(f'Truncating file: {self.file.name}')
             self.file.truncate(int(size))
             self.text.delete('1.0', 'end')
-            self.text.insert('1.0', self.file.read())
+            self.text.insert('1.0', self._contents())
         else:
             messagebox.showerror(title='Error', message='Invalid number entered')
 
         self.fs.save()
 
     def close(self):
-        MemoryService.fetch_memory().close(self.file)
+        MemoryService.fetch_memory().close(self.file.file)
+        self.file.close()
         self.root.destroy()
 
+    def _contents(self) -> str:
+        # The version is taken first, a change in between makes the next save conflict
+        self.version = self.fs.stat(asserttype(File, self.file.file).path()).version
+        self.file.seek(0)
+        data = self.file.read()
+        # Binary files are diffed as bytes, the offsets of the splices count bytes
+        self.saved = data if isinstance(data, str) else bytes(data)
+        return data if isinstance(data, str) else self.saved.decode('utf-8', errors='replace')
+
 
 class MemoryView:
     memory: Memory